@@ -18,17 +18,55 @@ import argparse
 import functools
 import operator
 import tempfile
+import traceback
+import json
+import hashlib
+import marshal
+import types
+import time
+import ast
+import io
+import zipfile
+import atexit
+import threading
+import socket
+import select
+import signal
+import array
+import struct
+from xml.sax.saxutils import escape as xml_escape, quoteattr as xml_quoteattr
 try:
     import ConfigParser as configparser
 except ImportError:
     import configparser
+try:
+    import importlib.machinery as importlib_machinery
+except ImportError:
+    importlib_machinery = None
+try:
+    import multiprocessing
+    import multiprocessing.pool
+except ImportError:
+    # Not available in some implementations (e.g. IronPython).
+    multiprocessing = None
 
 
 __all__ = [
+    'ExtPathSet',
     'PathEnvironment',
     'LibraryEnvironment',
     'ConfiguredLibraryEnvironment',
+    'SitelibIndexFinder',
+    'ImportTimer',
     'TestProxy',
+    'TestSummary',
+    'ImportGraph',
+    'ProjectConfig',
+    'ForkServer',
+    'Reporter',
+    'ConsoleReporter',
+    'JSONLReporter',
+    'JUnitReporter',
     'TestRunner',
     'ConfiguredTestRunner',
 ]
@@ -49,16 +87,92 @@ def create_logger(level=logging.INFO):
 logger = create_logger()
 
 
+class ExtPathSet(tuple):
+    """
+    Immutable set of extension paths in the declared order, deduplicated
+    on their real paths (the first declared kept). With `strict`, paths
+    not found are dropped with a warning. Concatenated into another set.
+    """
+
+    def __new__(cls, paths=tuple(), strict=True):
+        if isinstance(paths, ExtPathSet) and not strict:
+            return paths
+        resolved = []
+        real_paths = set()
+        for path in paths:
+            real_path = os.path.normcase(os.path.realpath(path))
+            if real_path in real_paths:
+                continue
+            if strict and not os.path.exists(path):
+                logger.warning('extension path not found: "{}"'.format(path))
+                continue
+            real_paths.add(real_path)
+            resolved.append(path)
+        return tuple.__new__(cls, resolved)
+
+    def __add__(self, other):
+        return ExtPathSet(tuple(self) + tuple(other), strict=False)
+
+    def __radd__(self, other):
+        return ExtPathSet(tuple(other) + tuple(self), strict=False)
+
+    def __reduce__(self):
+        return (_restore_ext_paths, (tuple(self),))
+
+    def __repr__(self):
+        return 'ExtPathSet({!r})'.format(list(self))
+
+
+def _restore_ext_paths(paths):
+    """`ExtPathSet` of paths already resolved in another, not resolved again."""
+    return tuple.__new__(ExtPathSet, paths)
+
+
+def _module_in_paths(module, dir_paths):
+    """Whether the module (or package) is loaded from any of the directories."""
+    locations = []
+    module_file = getattr(module, '__file__', None)
+    if module_file:
+        locations.append(module_file)
+    else:
+        # Namespace packages.
+        try:
+            locations.extend(getattr(module, '__path__', None) or ())
+        except TypeError:
+            pass
+    for location in locations:
+        location = os.path.abspath(location)
+        for dir_path in dir_paths:
+            if location.startswith(dir_path):
+                return True
+    return False
+
+
 class PathEnvironment(object):
-    """Context manager base to extend sys.path."""
+    """
+    Context manager base to extend sys.path.
+    With `isolate`, modules loaded from the paths while entered are dropped
+    from `sys.modules` on exit (kept in `unloaded`), & the modules they
+    replaced are restored. With `isolate_importers`, `sys.path_importer_cache`
+    & `sys.meta_path` are also rolled back.
+    """
 
-    def __init__(self, ext_paths):
-        self._ext_paths = ext_paths
+    def __init__(self, ext_paths, isolate=False, isolate_importers=False):
+        self._ext_paths = ExtPathSet(ext_paths, strict=False)
+        self._isolate = isolate
+        self._isolate_importers = isolate_importers
+        self.unloaded = {}
 
     def __enter__(self):
         # Copy the original sys.path & switch.
         self._orig_paths = sys.path[:]
-        sys.path.extend(self._ext_paths)
+        orig_paths = set(self._orig_paths)
+        sys.path.extend(path for path in self._ext_paths if path not in orig_paths)
+        if self._isolate:
+            self._orig_modules = dict(sys.modules)
+        if self._isolate_importers:
+            self._orig_importer_cache = dict(sys.path_importer_cache)
+            self._orig_meta_path = sys.meta_path[:]
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -66,6 +180,29 @@ class PathEnvironment(object):
         sys.path = self._orig_paths[:]
         self._orig_paths = None
         del self._orig_paths
+        if self._isolate:
+            self._rollback_modules()
+        if self._isolate_importers:
+            sys.path_importer_cache.clear()
+            sys.path_importer_cache.update(self._orig_importer_cache)
+            sys.meta_path[:] = self._orig_meta_path
+            del self._orig_importer_cache, self._orig_meta_path
+
+    def _rollback_modules(self):
+        dir_paths = [os.path.join(os.path.abspath(path), '') for path in self._ext_paths]
+        unloaded = {}
+        for module_name, module in list(sys.modules.items()):
+            orig_module = self._orig_modules.get(module_name)
+            if module is orig_module or not _module_in_paths(module, dir_paths):
+                continue
+            unloaded[module_name] = module
+            if orig_module is None:
+                del sys.modules[module_name]
+            else:
+                sys.modules[module_name] = orig_module
+        logger.debug('unload {} modules'.format(len(unloaded)))
+        self.unloaded = unloaded
+        del self._orig_modules
 
     @property
     def ext_paths(self):
@@ -100,19 +237,27 @@ def _load_extdir(ext_dir, rcfile_encoding, rc_filename):
     if rcfile_path is None:
         logger.error('{} in "{}" not found'.format(rc_filename, ext_dir))
         return []
-    # Read out rc.
+    return ExtPathSet(ProjectConfig.get().extdir_paths(rcfile_path, rcfile_encoding))
+
+def _read_extdir(rcfile_path, rcfile_encoding):
+    """Read out rc & resolve import paths listed, in order."""
+    ext_dir = os.path.dirname(rcfile_path)
     library_paths = []
     with open(rcfile_path, 'rb') as rcfile:
         for line in rcfile:
             library_paths.append(_resolve_rcpath(line.decode(rcfile_encoding),
                                                  ext_dir))
-    return list(set(library_paths))
+    return library_paths
 
 def semicolon_to_dirlist(notation):
     """Semi-colon separated string to a directory list."""
     return [os.path.abspath(d.strip().replace('/', os.sep))
             for d in notation.split(';')]
 
+def semicolon_to_list(notation):
+    """Semi-colon separated string to a list of names."""
+    return [name.strip() for name in notation.split(';') if name.strip()]
+
 BOOLEAN_STATES = {'1': True, 'yes': True, 'true': True, 'on': True,
                   '0': False, 'no': False, 'false': False, 'off': False}
 
@@ -122,6 +267,197 @@ def state_to_boolean(notation):
         raise ValueError('Not a boolean: {}'.format(notation))
     return BOOLEAN_STATES[notation.lower()]
 
+def shard_notation(notation):
+    """'INDEX/COUNT' string to a shard (index, count), 1-based."""
+    try:
+        index, count = [int(n) for n in notation.split('/')]
+    except ValueError:
+        raise ValueError('Not a shard: {}'.format(notation))
+    if not 1 <= index <= count:
+        raise ValueError('Not a shard: {}'.format(notation))
+    return index, count
+
+def to_abspath(notation):
+    """Path string to an absolute path."""
+    return os.path.abspath(notation.strip().replace('/', os.sep))
+
+
+# Default directory to keep caches in.
+CACHE_DIR = './.ipyenvcache'
+
+def _cache_path(cache_dir, name):
+    return os.sep.join((cache_dir, name))
+
+def _load_cache(cache_dir, name):
+    """Load a JSON cache, or None if missing or broken."""
+    if cache_dir is None:
+        return None
+    try:
+        with open(_cache_path(cache_dir, name), 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        return None
+
+def _write_atomic(path, data):
+    """Write bytes to a file via a temporary one, to be never seen half-written."""
+    dir_path = os.path.dirname(path)
+    if not os.path.isdir(dir_path):
+        try:
+            os.makedirs(dir_path)
+        except OSError:
+            # Made by another process.
+            if not os.path.isdir(dir_path):
+                raise
+    tempf = tempfile.NamedTemporaryFile(mode='wb', delete=False, dir=dir_path)
+    try:
+        tempf.write(data)
+        tempf.close()
+        if hasattr(os, 'replace'):
+            os.replace(tempf.name, path)
+        else:
+            if os.path.exists(path):
+                os.unlink(path)
+            os.rename(tempf.name, path)
+    except:
+        tempf.close()
+        if os.path.exists(tempf.name):
+            os.unlink(tempf.name)
+        raise
+
+def _save_cache(cache_dir, name, data):
+    """Save a JSON cache, only warned on failure."""
+    if cache_dir is None:
+        return
+    try:
+        _write_atomic(_cache_path(cache_dir, name),
+                      json.dumps(data).encode('utf-8'))
+    except (IOError, OSError) as ex:
+        logger.warning('failed to save cache "{}": {}'.format(name, ex))
+
+def _file_stamp(path):
+    """[mtime, size] of the file, or None if missing."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime, stat.st_size]
+
+def _read_options(config_path):
+    """All options in the configuration file, formed {'section.attribute': value}."""
+    parser = configparser.ConfigParser()
+    if not parser.read(config_path):
+        return None
+    options = {}
+    for section in parser.sections():
+        for attribute in parser.options(section):
+            try:
+                options['.'.join((section, attribute))] = parser.get(section, attribute)
+            except configparser.Error as ex:
+                logger.error('invalid option "{}.{}": {}'.format(section, attribute, ex))
+    return options
+
+# Cache name of the resolved configuration.
+CONFIG_CACHE = 'config.json'
+
+class ProjectConfig(object):
+    """
+    Resolved project configuration: options of `.ipyenvrc` & paths listed
+    in `.sitelibs`/`.testfor`, built once per process (see `get`) & cached
+    in `cache_dir` on exit. Each entry is validated by the mtime & size
+    of its rc file, & resolved again only if changed.
+    The cache is formed:
+        {'version': __version__,
+         'options': {config path: [stamp, {'section.attribute': value} or None]},
+         'extdirs': {rc file path: [stamp, encoding, paths]}}
+    """
+
+    # Instance of this process.
+    _instance = None
+
+    # Cache directory of the instance, if not given to `get`.
+    _unspecified = object()
+
+    # Whether the instance is saved on exit.
+    _saved_on_exit = False
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self._cache_dir = None if cache_dir is None else os.path.abspath(cache_dir)
+        cache = _load_cache(self._cache_dir, CONFIG_CACHE)
+        if not isinstance(cache, dict) or cache.get('version') != __version__:
+            cache = {}
+        self._options = cache.get('options', {})
+        self._extdirs = cache.get('extdirs', {})
+        self._updated = False
+
+    @classmethod
+    def get(cls, cache_dir=_unspecified):
+        """
+        The instance of this process, saved on exit into `cache_dir` (None
+        for no cache). Only kept in memory until an entry point gives the
+        directory, as it may be configured by options read with the instance
+        (see `relocate`).
+        """
+        if cls._instance is None:
+            cls._instance = cls(None if cache_dir is cls._unspecified else cache_dir)
+        elif cache_dir is not cls._unspecified:
+            cls._instance.relocate(cache_dir)
+        if cache_dir is not cls._unspecified and cache_dir is not None \
+                and not cls._saved_on_exit:
+            atexit.register(cls._save_instance)
+            cls._saved_on_exit = True
+        return cls._instance
+
+    @classmethod
+    def _save_instance(cls):
+        if cls._instance is not None:
+            cls._instance.save()
+
+    def relocate(self, cache_dir):
+        """Save the cache into `cache_dir` instead, or never if None."""
+        cache_dir = None if cache_dir is None else os.path.abspath(cache_dir)
+        if cache_dir != self._cache_dir:
+            self._cache_dir = cache_dir
+            self._updated = True
+
+    def options(self, config_path):
+        """Options of the configuration file, or None if not found."""
+        config_path = os.path.abspath(config_path)
+        stamp = _file_stamp(config_path)
+        entry = self._options.get(config_path)
+        if entry is None or entry[0] != stamp:
+            entry = [stamp, None if stamp is None else _read_options(config_path)]
+            self._options[config_path] = entry
+            self._updated = True
+        return entry[1]
+
+    def extdir_paths(self, rcfile_path, rcfile_encoding):
+        """Paths listed in the rc file (`.sitelibs`, `.testfor`)."""
+        rcfile_path = os.path.abspath(rcfile_path)
+        stamp = _file_stamp(rcfile_path)
+        entry = self._extdirs.get(rcfile_path)
+        if entry is None or entry[0] != stamp or entry[1] != rcfile_encoding:
+            entry = [stamp, rcfile_encoding, _read_extdir(rcfile_path, rcfile_encoding)]
+            self._extdirs[rcfile_path] = entry
+            self._updated = True
+        # Copied, not to be modified by callers.
+        return list(entry[2])
+
+    def save(self):
+        """Save the cache if updated, dropping entries of rc files removed."""
+        if not self._updated or self._cache_dir is None:
+            return
+        for entries in (self._options, self._extdirs):
+            for path in list(entries):
+                if entries[path][0] is not None and _file_stamp(path) is None:
+                    del entries[path]
+        _save_cache(self._cache_dir, CONFIG_CACHE, {
+            'version': __version__,
+            'options': self._options,
+            'extdirs': self._extdirs,
+        })
+        self._updated = False
+
+
 def configured(args_from_config=None, post_processors=tuple()):
     """
     Makes a wrapper for some environment class to instantiate with given
@@ -134,20 +470,16 @@ def configured(args_from_config=None, post_processors=tuple()):
             logger.warn('no arguments from configuration are set')
             return lambda klass, **kwargs: klass(**kwargs)
         def instantiate(config_path='./.ipyenvrc', **given_args):
-            parser = configparser.ConfigParser()
-            if not parser.read(config_path):
+            options = ProjectConfig.get().options(config_path)
+            if options is None:
                 logger.warn('configuration file not found: "{}"'.format(config_path))
                 return klass(**given_args)
             kwargs_from_config = {}
             for config_opt in args_from_config:
-                section, attribute = config_opt.split('.')
+                if config_opt not in options:
+                    continue
                 name, converter = args_from_config[config_opt]
-                try:
-                    kwargs_from_config[name] = converter(parser.get(section, attribute))
-                except configparser.NoSectionError:
-                    pass
-                except configparser.NoOptionError:
-                    pass
+                kwargs_from_config[name] = converter(options[config_opt])
             # Given arguments precede.
             kwargs_from_config.update(given_args)
             # Apply post processors.
@@ -159,28 +491,376 @@ def configured(args_from_config=None, post_processors=tuple()):
     return _wrapper
 
 
+def _scan_importable_names(ext_paths):
+    """
+    Index top-level modules/packages importable from the paths,
+    formed {name: path}, in precedence of the path order.
+    Namespace packages are left to the ordinary path search.
+    """
+    suffixes = sorted(importlib_machinery.all_suffixes(), key=len, reverse=True)
+    # Never shadow the standard library.
+    excluded = set(sys.builtin_module_names)
+    excluded.update(getattr(sys, 'stdlib_module_names', ()))
+    index = {}
+    for ext_path in ext_paths:
+        try:
+            entries = os.listdir(ext_path)
+        except OSError:
+            continue
+        for entry in entries:
+            entry_path = os.sep.join((ext_path, entry))
+            name = None
+            if os.path.isdir(entry_path):
+                for suffix in suffixes:
+                    if os.path.isfile(os.sep.join((entry_path, '__init__' + suffix))):
+                        name = entry
+                        break
+            else:
+                for suffix in suffixes:
+                    if entry.endswith(suffix):
+                        name = entry[:-len(suffix)]
+                        break
+            if not name or '.' in name or name in excluded:
+                continue
+            index.setdefault(name, ext_path)
+    return index
+
+def _mtimes_of(paths):
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = os.stat(path).st_mtime
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+def _load_index_lock(lock_path, ext_paths):
+    """Load an index from the lock file, or None if missing or stale."""
+    try:
+        with open(lock_path, 'rb') as f:
+            lock = json.loads(f.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        return None
+    # Directory mtimes change on adding/removing entries.
+    if lock.get('paths') != _mtimes_of(ext_paths):
+        return None
+    return lock.get('modules')
+
+def _save_index_lock(lock_path, ext_paths, index):
+    # Create first, as the lock file may change mtime of a library path.
+    if not os.path.exists(lock_path):
+        open(lock_path, 'wb').close()
+    lock = {'paths': _mtimes_of(ext_paths), 'modules': index}
+    with open(lock_path, 'wb') as f:
+        f.write(json.dumps(lock, indent=1, sort_keys=True).encode('utf-8'))
+
+
+class SitelibIndexFinder(object):
+    """
+    Meta path finder resolving top-level modules/packages from the index
+    of library paths, instead of probing every path in turn.
+    Names not in the index, or provided by paths of `sys.path` other than
+    `ext_paths` prior to the one indexed, are left to the ordinary path
+    search, not to change which module is imported.
+    """
+
+    def __init__(self, index, ext_paths=tuple()):
+        self._index = index
+        self._ext_paths = set(ext_paths)
+
+    def find_spec(self, fullname, path=None, target=None):
+        if path is not None:
+            # Submodules are found in their package paths.
+            return None
+        ext_path = self._index.get(fullname)
+        if ext_path is None:
+            return None
+        # Library paths prior to the one indexed never provide the name.
+        prior_paths = []
+        for sys_path in sys.path:
+            if sys_path == ext_path:
+                break
+            if sys_path not in self._ext_paths:
+                prior_paths.append(sys_path)
+        if prior_paths and \
+           importlib_machinery.PathFinder.find_spec(fullname, prior_paths, target) is not None:
+            return None
+        return importlib_machinery.PathFinder.find_spec(fullname, [ext_path], target)
+
+    def install(self):
+        """Insert into `sys.meta_path`, prior to the path based finder."""
+        position = 0
+        for i, finder in enumerate(sys.meta_path):
+            if finder is importlib_machinery.PathFinder:
+                position = i
+                break
+        sys.meta_path.insert(position, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    @property
+    def index(self):
+        """Not to modify manually this property."""
+        return self._index
+
+
+class LazySitelibFinder(object):
+    """
+    Meta path finder consulted after the others fail to find a top-level
+    module/package, which activates (appends to `sys.path`) the first
+    library path providing it. Library paths are kept off `sys.path` until.
+    """
+
+    def __init__(self, ext_paths):
+        self._ext_paths = list(ext_paths)
+        self._activated = []
+
+    def find_spec(self, fullname, path=None, target=None):
+        if path is not None:
+            # Submodules are found in their package paths.
+            return None
+        for ext_path in self._ext_paths:
+            if ext_path in self._activated:
+                continue
+            spec = importlib_machinery.PathFinder.find_spec(fullname, [ext_path], target)
+            if spec is not None:
+                logger.debug('activate "{}" for "{}"'.format(ext_path, fullname))
+                self._activated.append(ext_path)
+                sys.path.append(ext_path)
+                return spec
+        return None
+
+    def install(self):
+        """Append to `sys.meta_path`, after all the others."""
+        self._activated = []
+        sys.meta_path.append(self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    @property
+    def activated(self):
+        """Library paths activated in order, not to modify manually."""
+        return self._activated
+
+
 class LibraryEnvironment(PathEnvironment):
     """
     Context manager for appending on the fly
     modules/packeges import paths.
+    With `indexed`, top-level modules/packages in the paths are indexed
+    (or loaded from `.sitelibs.lock` if up to date) & imported by
+    `SitelibIndexFinder`.
+    With `lazy`, the paths are put on `sys.path` only when they provide
+    modules/packages not found otherwise, by `LazySitelibFinder`.
     """
 
-    def __init__(self, sitelib_paths=('./sitelib',), rcfile_encoding='utf-8'):
+    def __init__(self, sitelib_paths=('./sitelib',), rcfile_encoding='utf-8',
+                 indexed=False, lazy=False):
         # Load .sitelib files.
         library_paths = []
+        self._sitelib_groups = []   # (sitelib directory, library paths)
         for sitelib_dir in sitelib_paths:
-            library_paths.extend(_load_extdir(sitelib_dir, rcfile_encoding, '.sitelibs'))
+            group_paths = _load_extdir(sitelib_dir, rcfile_encoding, '.sitelibs')
+            self._sitelib_groups.append((os.path.abspath(sitelib_dir), group_paths))
+            library_paths.extend(group_paths)
         PathEnvironment.__init__(self, library_paths)
+        self._finder = None
+        if indexed and importlib_machinery is None:
+            logger.warning('importlib not available: sitelib index disabled')
+        elif indexed:
+            self._finder = SitelibIndexFinder(self._build_index(), library_paths)
+        self._lazy_finder = None
+        if lazy and importlib_machinery is None:
+            logger.warning('importlib not available: lazy sitelib activation disabled')
+        elif lazy:
+            self._lazy_finder = LazySitelibFinder(library_paths)
+
+    # Lock file name of the index, put next to .sitelibs.
+    INDEX_LOCK = '.sitelibs.lock'
+
+    def _build_index(self):
+        index = {}
+        self._group_indices = []
+        for sitelib_dir, group_paths in self._sitelib_groups:
+            lock_path = os.sep.join((sitelib_dir, self.INDEX_LOCK))
+            group_index = _load_index_lock(lock_path, group_paths)
+            if group_index is None:
+                logger.debug('scan sitelib paths in "{}"'.format(sitelib_dir))
+                group_index = _scan_importable_names(group_paths)
+            self._group_indices.append(group_index)
+            for name, ext_path in group_index.items():
+                index.setdefault(name, ext_path)
+        return index
+
+    def save_index(self):
+        """Save the index into `.sitelibs.lock` files, to skip scans later."""
+        if self._finder is None:
+            raise RuntimeError('sitelib index disabled')
+        for (sitelib_dir, group_paths), group_index in zip(self._sitelib_groups,
+                                                           self._group_indices):
+            lock_path = os.sep.join((sitelib_dir, self.INDEX_LOCK))
+            logger.info('save sitelib index: "{}"'.format(lock_path))
+            _save_index_lock(lock_path, group_paths, group_index)
+
+    def __enter__(self):
+        PathEnvironment.__enter__(self)
+        if self._lazy_finder is not None:
+            # Library paths are put on sys.path only when activated.
+            sys.path[:] = self._orig_paths
+            self._lazy_finder.install()
+        # Library paths are kept for names missing in the index.
+        if self._finder is not None:
+            self._finder.install()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._finder is not None:
+            self._finder.uninstall()
+        if self._lazy_finder is not None:
+            self._lazy_finder.uninstall()
+            logger.info('activated {} of {} library paths'.format(
+                len(self._lazy_finder.activated), len(self.ext_paths)))
+        PathEnvironment.__exit__(self, exc_type, exc_value, traceback)
+
+    @property
+    def finder(self):
+        """`SitelibIndexFinder` if indexed, else None."""
+        return self._finder
+
+    @property
+    def lazy_finder(self):
+        """`LazySitelibFinder` if lazy, else None."""
+        return self._lazy_finder
 
 
 @configured(args_from_config={
                 'libext.extdirs': ('sitelib_paths', semicolon_to_dirlist),
+                'libext.indexed': ('indexed', state_to_boolean),
+                'libext.lazy': ('lazy', state_to_boolean),
             })
 class ConfiguredLibraryEnvironment(LibraryEnvironment):
     """LibraryEnvironment configured with .ipyenvrc."""
     pass
 
 
+class _TimedLoader(object):
+    """Loader proxy measuring `exec_module` with `ImportTimer`."""
+
+    def __init__(self, loader, timer, name, origin):
+        self._loader = loader
+        self._timer = timer
+        self._name = name
+        self._origin = origin
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        self._timer.enter(self._name, self._origin)
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._timer.exit()
+
+
+class ImportTimer(object):
+    """
+    Meta path finder wrapping loaders found by the other finders, to
+    measure self & cumulative time of each import, nested as imported.
+    Each record is formed:
+        {'name': module name, 'origin': path, 'path': library path or None,
+         'self': seconds, 'cumulative': seconds, 'children': [records]}
+    """
+
+    def __init__(self, ext_paths=tuple()):
+        self._ext_paths = set(ext_paths)
+        self._top_paths = {}    # top-level name => library path
+        self._stack = []
+        self._finding = set()
+        self.records = []
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname in self._finding:
+            return None
+        self._finding.add(fullname)
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, 'find_spec'):
+                    continue
+                spec = finder.find_spec(fullname, path, target)
+                if spec is not None:
+                    break
+            else:
+                return None
+        finally:
+            self._finding.discard(fullname)
+        if hasattr(spec.loader, 'exec_module'):
+            spec.loader = _TimedLoader(spec.loader, self, fullname, spec.origin)
+            self._library_path_of(fullname, spec)
+        return spec
+
+    def _library_path_of(self, fullname, spec):
+        """Library path which the top-level module/package is found in."""
+        top_name = fullname.partition('.')[0]
+        if top_name not in self._top_paths:
+            path = None
+            if top_name == fullname and spec.origin and spec.has_location:
+                path = os.path.dirname(spec.origin)
+                if spec.submodule_search_locations is not None:
+                    path = os.path.dirname(path)
+            self._top_paths[top_name] = path if path in self._ext_paths else None
+        return self._top_paths[top_name]
+
+    def enter(self, name, origin):
+        self._stack.append({
+            'name': name,
+            'origin': origin,
+            'path': self._top_paths.get(name.partition('.')[0]),
+            'children': [],
+            'started': _timer(),
+        })
+
+    def exit(self):
+        record = self._stack.pop()
+        record['cumulative'] = _timer() - record.pop('started')
+        record['self'] = record['cumulative'] - sum(child['cumulative']
+                                                   for child in record['children'])
+        if self._stack:
+            self._stack[-1]['children'].append(record)
+        else:
+            self.records.append(record)
+
+    def __enter__(self):
+        sys.meta_path.insert(0, self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def report(self, stream=None):
+        """Print records as a tree, sorted by cumulative time."""
+        stream = sys.stdout if stream is None else stream
+        stream.write('{:>12} {:>12}  {}\n'.format('cumulative', 'self', 'module [library path]'))
+        if not self.records:
+            stream.write('    (no modules newly imported)\n')
+        def write_records(records, depth):
+            for record in sorted(records, key=lambda r: -r['cumulative']):
+                stream.write('{:10.2f}ms {:10.2f}ms  {}{}{}\n'.format(
+                    record['cumulative'] * 1000, record['self'] * 1000,
+                    '  ' * depth, record['name'],
+                    ' [{}]'.format(record['path']) if record['path'] else ''))
+                write_records(record['children'], depth + 1)
+        write_records(self.records, 0)
+
+
 def _get_module_from_path(target_filename, env):
 
     path_components = os.path.split(target_filename)
@@ -196,11 +876,172 @@ def _get_module_from_path(target_filename, env):
     return module
 
 
-def _execute_file(target_filename, env=None, load_module=True):
+def _load_source_module(module_name, target_filename):
+    """
+    Load the source file as a new module of the name, registered
+    in `sys.modules` (removed again if failed).
+    """
+    try:
+        import importlib.util
+        spec_from_file_location = importlib.util.spec_from_file_location
+        module_from_spec = importlib.util.module_from_spec
+    except (ImportError, AttributeError):
+        import imp
+        sys.modules.pop(module_name, None)  # not to be reused
+        return imp.load_source(module_name, target_filename)
+    spec = spec_from_file_location(module_name, target_filename)
+    module = module_from_spec(spec)
+    sys.modules[module_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except:
+        sys.modules.pop(module_name, None)
+        raise
+    return module
+
+
+class _TestModuleLoader(object):
+    """
+    Loader of test files, each named by its path relative to its context
+    (e.g. `sub__test_inner` for `tests/sub/test_inner.py`), not to collide
+    with ones of the same file name. Names are flat (without dots), to be
+    imported again by themselves (as by `pickle`) with no parent packages.
+    Extension paths are expected on `sys.path` already, while the directory
+    of a test file is put on it only during its load (after the others,
+    as `_get_module_from_path`).
+    """
+
+    # Separator of directories in module names.
+    SEPARATOR = '__'
+
+    def __init__(self, testfile_paths, contexts=None):
+        contexts = contexts or {}
+        self._names = {}
+        taken = set()
+        for testfile_path in testfile_paths:
+            context = contexts.get(testfile_path) or os.path.dirname(testfile_path)
+            name = _module_name_of(testfile_path, context) or \
+                os.path.splitext(os.path.basename(testfile_path))[0]
+            name = name.replace('.', self.SEPARATOR)
+            unique_name, index = name, 1
+            while unique_name in taken:
+                index += 1
+                unique_name = '{}_{}'.format(name, index)
+            taken.add(unique_name)
+            self._names[testfile_path] = unique_name
+
+    def module_name(self, testfile_path):
+        return self._names[testfile_path]
+
+    def load(self, testfile_path):
+        module_name = self._names[testfile_path]
+        module_file = getattr(sys.modules.get(module_name), '__file__', None)
+        if module_file:
+            if module_file.endswith(('.pyc', '.pyo')):
+                module_file = module_file[:-1]
+            if os.path.normcase(os.path.abspath(module_file)) == \
+               os.path.normcase(os.path.abspath(testfile_path)):
+                # Already loaded from the file.
+                return sys.modules[module_name]
+        dir_path = os.path.dirname(testfile_path)
+        added = dir_path not in sys.path
+        if added:
+            sys.path.append(dir_path)
+        try:
+            return _load_source_module(module_name, testfile_path)
+        finally:
+            if added and dir_path in sys.path:
+                sys.path.remove(dir_path)
+
+
+def _bytecode_magic():
+    """Magic number of the interpreter's bytecode."""
+    try:
+        import importlib.util
+        return importlib.util.MAGIC_NUMBER
+    except (ImportError, AttributeError):
+        import imp
+        return imp.get_magic()
+
+# Cache subdirectory for code objects of files executed.
+BYTECODE_CACHE = 'bytecode'
+
+def _compile_file(target_filename, cache_dir=None):
+    """
+    Compile the target file, via the marshal-based code object cache
+    in `cache_dir` validated by path, size, mtime & bytecode magic number.
+    """
+    if cache_dir is None:
+        with open(target_filename) as f:
+            return compile(f.read(), target_filename, 'exec')
+    abs_path = os.path.abspath(target_filename)
+    stat = os.stat(abs_path)
+    key = hashlib.sha1(abs_path.encode('utf-8')).hexdigest()
+    cache_path = os.sep.join((cache_dir, BYTECODE_CACHE, key))
+    header = _bytecode_magic() + '{}:{!r}:{}\n'.format(
+        stat.st_size, stat.st_mtime, target_filename).encode('utf-8')
+    try:
+        with open(cache_path, 'rb') as f:
+            data = f.read()
+        if data.startswith(header):
+            return marshal.loads(data[len(header):])
+    except (IOError, OSError, ValueError, EOFError, TypeError):
+        pass
+    with open(target_filename) as f:
+        code = compile(f.read(), target_filename, 'exec')
+    try:
+        _write_atomic(cache_path, header + marshal.dumps(code))
+    except (IOError, OSError, ValueError) as ex:
+        # Code objects may not be marshalled in some implementations.
+        logger.debug('bytecode not cached for "{}": {}'.format(target_filename, ex))
+    return code
+
+
+def _execute_as_main(target_filename, cache_dir=None, keep_main=False):
+    """
+    Execute the target file only once as `__main__`, which is also
+    visible under its module name (for pickling, `unittest.main`, etc.)
+    unless the name is taken. The new module replaces
+    `sys.modules['__main__']` while executed (or for good with
+    `keep_main`, running as the program of the process), & is returned.
+    """
+    dir_path, local_name = os.path.split(target_filename)
+    module_name = os.path.splitext(local_name)[0]
+
+    main = types.ModuleType('__main__')
+    main.__file__ = target_filename
+    main.sys = sys
+    orig_main = sys.modules.get('__main__')
+    aliased = module_name not in sys.modules
+    sys.modules['__main__'] = main
+    if aliased:
+        sys.modules[module_name] = main
+    try:
+        with PathEnvironment(ext_paths=[dir_path]):
+            exec(_compile_file(target_filename, cache_dir), main.__dict__)
+    finally:
+        if not keep_main:
+            if orig_main is None:
+                sys.modules.pop('__main__', None)
+            else:
+                sys.modules['__main__'] = orig_main
+            if aliased and sys.modules.get(module_name) is main:
+                del sys.modules[module_name]
+    return main
+
+
+def _execute_file(target_filename, env=None, load_module=True, cache_dir=None,
+                  single_exec=False, keep_main=False):
     """
     Execute the target file via `exec`/`execfile`,
     along with the current sys.path environment.
+    Compiled code is cached in `cache_dir` if given.
+    With `single_exec`, executed once by `_execute_as_main` (see
+    `keep_main`) instead of preloading as module (`load_module`) &
+    executing again.
     """
+    if single_exec:
+        return _execute_as_main(target_filename, cache_dir=cache_dir, keep_main=keep_main)
     if load_module:
         # Almost all objects in the target module
         # are visible from `__main__`.
@@ -215,12 +1056,111 @@ def _execute_file(target_filename, env=None, load_module=True):
         '__name__': '__main__',
         '__file__': target_filename,
     }
-    if hasattr(__builtins__, 'execfile'):
+    if cache_dir is None and hasattr(__builtins__, 'execfile'):
         execfile(target_filename, global_vars)
     else:
-        exec(compile(open(target_filename).read(),
-                     target_filename, 'exec'),
-             global_vars)
+        exec(_compile_file(target_filename, cache_dir), global_vars)
+
+
+# Module name of the target script in bundles.
+BUNDLE_MAIN = '__ipyenv_main__'
+
+# Entry of bundles recording the content hash, etc.
+BUNDLE_INFO = '__ipyenv_bundle__.json'
+
+# Entry stub of bundles, run by `python bundle.pyz`.
+BUNDLE_STUB = (
+    "import runpy\n"
+    "runpy.run_module('{}', run_name='__main__', alter_sys=True)\n"
+).format(BUNDLE_MAIN)
+
+# Extension modules, never imported from zip archives.
+BUNDLE_EXCLUDED_SUFFIXES = ('.pyc', '.pyo', '.so', '.pyd', '.dll', '.dylib')
+
+def _bundle_files(target_filename, ext_paths):
+    """
+    List (archive name, file path) of the target script as `BUNDLE_MAIN`
+    & files under the paths, in precedence of the path order.
+    """
+    files = {BUNDLE_MAIN + '.py': os.path.abspath(target_filename)}
+    for ext_path in ext_paths:
+        for dir_path, dirnames, filenames in os.walk(ext_path):
+            dirnames[:] = sorted(name for name in dirnames
+                                 if not name.startswith('.') and name != '__pycache__')
+            for filename in sorted(filenames):
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(dir_path, filename)
+                if filename.endswith(BUNDLE_EXCLUDED_SUFFIXES):
+                    if not filename.endswith(('.pyc', '.pyo')):
+                        logger.warning('extension module not bundled: "{}"'.format(path))
+                    continue
+                arcname = os.path.relpath(path, ext_path).replace(os.sep, '/')
+                files.setdefault(arcname, path)
+    return sorted(files.items())
+
+def _bundle_hash(files):
+    """Content hash of the files to bundle, with the bytecode magic number."""
+    digest = hashlib.sha1(_bytecode_magic())
+    for arcname, path in files:
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest.update(arcname.encode('utf-8') + b'\0')
+        digest.update(hashlib.sha1(content).digest())
+    return digest.hexdigest()
+
+def _pyc_header():
+    """Header of `.pyc` files for `zipimport`, with no source mtime checked."""
+    if sys.version_info >= (3, 7):
+        # Magic number, flags, mtime & source size.
+        return _bytecode_magic() + b'\0' * 12
+    if sys.version_info >= (3, 3):
+        return _bytecode_magic() + b'\0' * 8
+    return _bytecode_magic() + b'\0' * 4
+
+def _read_bundle_info(bundle_path):
+    """Recorded info of the bundle, or None if not a bundle."""
+    try:
+        with zipfile.ZipFile(bundle_path) as bundle:
+            return json.loads(bundle.read(BUNDLE_INFO).decode('utf-8'))
+    except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile):
+        return None
+
+def _build_bundle(target_filename, ext_paths, bundle_path):
+    """
+    Write a zip archive importable by `zipimport`, of the target script
+    & files under the paths, byte-compiled (sources kept only if not
+    compiled), with `__main__.py` running the target.
+    Return the recorded info.
+    """
+    files = _bundle_files(target_filename, ext_paths)
+    info = {
+        'hash': _bundle_hash(files),
+        'target': os.path.abspath(target_filename),
+        'files': len(files),
+        'version': __version__,
+    }
+    header = _pyc_header()
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as bundle:
+        def write(arcname, data):
+            # Fixed timestamps, for the same content to make the same archive.
+            bundle.writestr(zipfile.ZipInfo(arcname, (1980, 1, 1, 0, 0, 0)), data)
+        for arcname, path in files:
+            with open(path, 'rb') as f:
+                content = f.read()
+            if arcname.endswith('.py'):
+                try:
+                    code = compile(content, path, 'exec', 0, True)
+                    write(arcname + 'c', header + marshal.dumps(code))
+                    continue
+                except (SyntaxError, ValueError, TypeError) as ex:
+                    logger.warning('not byte-compiled: "{}": {}'.format(path, ex))
+            write(arcname, content)
+        write('__main__.py', BUNDLE_STUB.encode('utf-8'))
+        write(BUNDLE_INFO, json.dumps(info, sort_keys=True).encode('utf-8'))
+    _write_atomic(os.path.abspath(bundle_path), buf.getvalue())
+    return info
 
 
 class RWFreeNamedTempFile(object):
@@ -246,13 +1186,27 @@ class RWFreeNamedTempFile(object):
         self._tempf_name = tempf.name
         return tempf.name
 
+    # Retries to remove the file still locked by another process,
+    # with the exponential backoff from `UNLINK_BACKOFF` seconds.
+    UNLINK_RETRIES = 8
+    UNLINK_BACKOFF = 0.01
+
     def __exit__(self, exc_type, exc_value, traceback):
-        while True:
+        backoff = self.UNLINK_BACKOFF
+        for _ in range(self.UNLINK_RETRIES):
             try:
                 os.unlink(self._tempf_name)
-                break
+                return
             except OSError:
-                continue
+                if not os.path.exists(self._tempf_name):
+                    return
+            time.sleep(backoff)
+            backoff *= 2
+        logger.warning('failed to remove temporary file: "{}"'.format(self._tempf_name))
+
+    @property
+    def source(self):
+        return self._source
 
 
 class TestProxy(RWFreeNamedTempFile):
@@ -269,7 +1223,8 @@ class TestProxy(RWFreeNamedTempFile):
 import ipyenv
 import os
 import sys
-test_env = ipyenv.PathEnvironment(ext_paths={ext_paths})
+ipyenv._install_event_hook()
+test_env = ipyenv.PathEnvironment(ext_paths=ipyenv._restore_ext_paths({ext_paths!r}))
 {exec_stmt}\
 """
     )
@@ -280,7 +1235,8 @@ target = '{target_filepath}'
 sys.argv = [target.split(os.sep)[-1]]
 append_main = {append_main}
 with test_env as te:
-    ipyenv._execute_file(target, te)
+    ipyenv._execute_file(target, te, cache_dir={cache_dir},
+                         single_exec={single_exec}, keep_main=True)
     if append_main:
         import unittest
         unittest.main(verbosity={verbosity})\
@@ -288,13 +1244,18 @@ with test_env as te:
     )
 
     def __init__(self, target_filepath, ext_paths=tuple(),
-                 append_main=False, verbosity=1):
+                 append_main=False, verbosity=1, cache_dir=None,
+                 single_exec=False):
         # All paths are desired to be absolute.
-        ext_paths = [path for path in ext_paths]  # accept iterator, etc.
+        ext_paths = tuple(ExtPathSet(ext_paths, strict=False))  # accept iterator, etc.
+        if cache_dir is not None:
+            cache_dir = os.path.abspath(cache_dir)
         exec_stmt = self.PROXY_FORMAT_EXEC.format(
             target_filepath=target_filepath,
             append_main=append_main,
             verbosity=verbosity,
+            cache_dir=repr(cache_dir),
+            single_exec=single_exec,
         )
         script = self.PROXY_FORMAT_COMMON.format(
             ext_paths=ext_paths,
@@ -302,137 +1263,2130 @@ with test_env as te:
         )
         RWFreeNamedTempFile.__init__(self, source=script)
 
+    # Longer scripts are not passed by command-line,
+    # which is limited to 32767 characters in Windows.
+    INLINE_SCRIPT_LIMIT = 30000
 
-class TestRunner(object):
+    def command(self, executable=sys.executable):
+        """
+        Command-line to execute the proxy script given by `-c`,
+        or None if too long to give.
+        """
+        if len(self.source) > self.INLINE_SCRIPT_LIMIT:
+            return None
+        return [executable, '-c', self.source]
+
+
+def _exit_code_of(system_exit):
+    """Exit status to be given by `SystemExit`."""
+    code = system_exit.code
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    sys.stderr.write('{}\n'.format(code))
+    return 1
+
+def _run_test_script(target, ext_paths=tuple(), append_main=False, verbosity=1,
+                     cache_dir=None, single_exec=False):
     """
-    Implements test runner functionality.
-    Uses PathEnvironment as environment supplyer.
+    Same as the script made by `TestProxy`, run in the current process.
+    Returns the exit status.
     """
+    sys.argv = [target.split(os.sep)[-1]]
+    _install_event_hook()
+    try:
+        with PathEnvironment(ext_paths=ext_paths) as te:
+            _execute_file(target, te, cache_dir=cache_dir,
+                          single_exec=single_exec, keep_main=True)
+            if append_main:
+                import unittest
+                unittest.main(verbosity=verbosity)
+    except SystemExit as ex:
+        return _exit_code_of(ex)
+    except:
+        traceback.print_exc()
+        return 1
+    return 0
 
-    def __init__(self, test_paths=('./tests',), sitelib_paths=('./sitelib',),
-                 rcfile_encoding='utf-8', append_main=False, verbosity=1,
-                 suite_autoload=True):
-        # Extend common library pahts.
-        self._library_paths = []
-        for sitelib_dir in sitelib_paths:
-            self._library_paths.extend(_load_extdir(sitelib_dir, rcfile_encoding, '.sitelibs'))
-        # Find tests with extension config. recursively.
-        self._tests = {}        # context => tests
-        self._ext_paths = {}    # context => extension paths(test target paths)
-        for test_dir in test_paths:
-            if not (os.path.exists(test_dir) and os.path.isdir(test_dir)):
-                logger.error('tests directory "{}" not found'.format(test_dir))
-                continue
-            test_dir = os.path.abspath(test_dir)
-            self._tests[test_dir] = self._find_tests(test_dir)
-            self._ext_paths[test_dir] = _load_extdir(test_dir, rcfile_encoding, '.testfor')
-        # Save extra arguments.
-        if append_main is True and suite_autoload is True:
-            raise RuntimeError('confusing auto-exec options')
-        self._append_main = append_main
-        self._suite_autoload = suite_autoload
-        self._verbosity = verbosity
+def _wait_status_to_returncode(status):
+    """`os.waitpid` status to a return code as `subprocess` does."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
 
-    # Test script filename patterns.
-    RE_TEST_SCRIPT_NAME = re.compile('^[Tt]est.*\.py$')
 
-    def _find_tests(self, test_dir):
-        """Find recursively test scripts under the given path."""
-        test_paths = []
-        for root, dirs, files in os.walk(test_dir):
-            for filename in files:
-                if self.RE_TEST_SCRIPT_NAME.search(filename):
-                    test_paths.append(os.sep.join((root, filename)))
-        return test_paths
+class _ChildWatch(object):
+    """
+    Waiter of a child process (`process` if a `subprocess.Popen`), killing
+    its process group (led by the child) if still running after `timeout`,
+    & measuring its resource usage (see `wait`).
+    """
 
-    def execute_all(self):
-        """Execute all tests found."""
-        library_paths = self._library_paths
-        for context, tests in self._tests.items():
-            # Setup full extension paths set.
-            ext_paths = self._ext_paths[context]
-            ext_paths.extend(library_paths)
-            if self._suite_autoload:
-                self._run_testsuites(
-                    tests,
-                    ext_paths=ext_paths,
-                    verbosity=self._verbosity,
-                )
-            else:
-                # Iterate over tests.
-                for testfile_path in tests:
-                    self._execute_test(testfile_path, ext_paths=ext_paths,
-                                       append_main=self._append_main,
-                                       verbosity=self._verbosity)
+    def __init__(self, pid, timeout=None, process=None, group=True):
+        self._pid = pid
+        self._process = process
+        self._group = group and hasattr(os, 'killpg')
+        self._started = _timer()
+        self.timed_out = False
+        self._timer = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
 
-    def execute_by_path(self, testfile_path):
-        """Execute a specifiv test by given path."""
-        abs_testfile_path = os.path.abspath(testfile_path.replace('/', os.sep))
-        for context, tests in self._tests.items():
-            # Find given path.
-            for test_path in tests:
-                if test_path == abs_testfile_path:
-                    # Setup full extension paths set.
-                    ext_paths = self._ext_paths[context]
-                    ext_paths.extend(self._library_paths)
-                    if self._suite_autoload:
-                        self._run_testsuites(
-                            [test_path],
-                            ext_paths=ext_paths,
-                            verbosity=self._verbosity,
-                        )
-                    else:
-                        self._execute_test(abs_testfile_path, ext_paths=ext_paths,
-                                           append_main=self._append_main,
-                                           verbosity=self._verbosity)
-                    return
-            # If the path not found.
-            logger.error('test not found: "{}"'.format(abs_testfile_path))
+    def _expire(self):
+        self.timed_out = True
+        self.kill()
 
-    def _escape_path(self, path):
-        """Path separator escaping in Windows."""
-        return path.replace('\\', '\\\\')
+    def kill(self):
+        """Kill the child, with its process group if led by it."""
+        try:
+            if self._group:
+                os.killpg(self._pid, signal.SIGKILL)
+            elif self._process is not None:
+                self._process.kill()
+            else:
+                os.kill(self._pid, signal.SIGKILL)
+        except OSError:
+            pass    # already exited
 
-    def _execute_test(self, testfile_path, ext_paths=tuple(),
-                      append_main=False, verbosity=1):
+    def wait(self):
         """
-        Execute test script, with invoking executable
-        & given paths extension by subprocessing.
+        Wait for the child & return (exit status, resources), where resources
+        are {'wall': seconds, 'cpu': seconds, 'maxrss': bytes}, or only
+        {'wall': seconds} if not available. Interrupted, the child is killed.
         """
-        logger.info('will execute test: "{}"'.format(testfile_path))
-        ext_paths = [path for path in ext_paths]  # accept iterator, etc.
-        # `_escape_path` only applied to  `testfile_path`:
-        #     Built-in `open` never accepts unescaped special characters,
-        #     while a sequence of `list.__repr__` -> `str.format` does.
-        with TestProxy(self._escape_path(testfile_path),
-                       ext_paths=ext_paths,
-                       append_main=append_main,
-                       verbosity=verbosity) as proxy_filename:
-            subprocess.call([sys.executable, proxy_filename])
+        try:
+            if hasattr(os, 'wait4'):
+                _, status, rusage = os.wait4(self._pid, 0)
+                returncode = _wait_status_to_returncode(status)
+                if self._process is not None:
+                    self._process.returncode = returncode
+                resources = {
+                    'cpu': rusage.ru_utime + rusage.ru_stime,
+                    # Kilobytes except in OS X.
+                    'maxrss': rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+                }
+            elif self._process is not None:
+                returncode = self._process.wait()
+                resources = {}
+            else:
+                returncode = _wait_status_to_returncode(os.waitpid(self._pid, 0)[1])
+                resources = {}
+        except KeyboardInterrupt:
+            if self._group:
+                self.kill()     # not given SIGINT by the terminal
+            raise
+        finally:
+            if self._timer is not None:
+                self._timer.cancel()
+        resources['wall'] = _timer() - self._started
+        return returncode, resources
 
-    def _run_testsuites(self, testfile_paths, ext_paths=tuple(), verbosity=1):
-        """
-        Execute tests, by aggregating test suites from target scripts,
-        & running with given paths extension.
-        """
+
+# Timer to measure durations.
+_timer = getattr(time, 'perf_counter', time.time)
+
+_timing_result_class = None
+
+def _get_timing_result_class():
+    """`unittest.TextTestResult` subclass measuring durations of each test."""
+    global _timing_result_class
+    if _timing_result_class is None:
+        import unittest
+
+        class TimingTestResult(unittest.TextTestResult):
+
+            def __init__(self, *args, **kwargs):
+                unittest.TextTestResult.__init__(self, *args, **kwargs)
+                self.durations = {}     # test id => seconds
+                self._started = None
+
+            def startTest(self, test):
+                self._started = _timer()
+                unittest.TextTestResult.startTest(self, test)
+
+            def stopTest(self, test):
+                unittest.TextTestResult.stopTest(self, test)
+                if self._started is not None:
+                    self.durations[test.id()] = _timer() - self._started
+                    self._started = None
+
+        _timing_result_class = TimingTestResult
+    return _timing_result_class
+
+
+# Environment variables telling children the pipe to emit test events to,
+# & whether to keep quiet (events reported on the console by the parent).
+EVENTS_FD_ENV = 'IPYENV_EVENTS_FD'
+EVENTS_QUIET_ENV = 'IPYENV_EVENTS_QUIET'
+
+# Test events passed over pipes to children, by inherited file descriptors.
+EVENT_PIPES_SUPPORTED = os.name == 'posix' and hasattr(os, 'pipe')
+
+# Held from creating a pipe of test events until the write end given to the
+# child & closed, so that children started by other threads (`jobs`) never
+# inherit it, keeping the reader from EOF until they exit.
+_event_pipe_lock = threading.Lock()
+
+def _in_main_thread():
+    main_thread = getattr(threading, 'main_thread', None)
+    if main_thread is not None:
+        return threading.current_thread() is main_thread()
+    return threading.current_thread().name == 'MainThread'
+
+
+class _NullStream(object):
+    """Stream discarding written text."""
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+class _PipeEmitter(object):
+    """Writer of test events into a pipe, a JSON object per line."""
+
+    def __init__(self, fd):
+        self._fd = fd
+        self._lock = threading.Lock()
+
+    def emit(self, event):
+        data = (json.dumps(event) + '\n').encode('utf-8')
+        with self._lock:
+            while data:
+                data = data[os.write(self._fd, data):]
+
+
+# Created on demand, `unittest` is imported lazily.
+_event_result_class = None
+
+def _get_event_result_class():
+    """
+    `TimingTestResult` subclass emitting test events by `emit` (set on
+    subclasses), with output of each test captured (in the main thread).
+    Events are formed:
+        {'event': 'start', 'test': test id}
+        {'event': 'pass'|'fail'|'error'|'skip'|'xfail'|'xpass', 'test': test id,
+         'duration': seconds, 'message': traceback or reason, 'output': captured}
+    """
+    global _event_result_class
+    if _event_result_class is None:
+
+        class EventTestResult(_get_timing_result_class()):
+
+            emit = None
+            quiet = False
+
+            def __init__(self, *args, **kwargs):
+                _get_timing_result_class().__init__(self, *args, **kwargs)
+                self._current = None
+                self._outcome = None
+                self._captured = None
+
+            def startTest(self, test):
+                self._current = test
+                self._outcome = None
+                self.emit({'event': 'start', 'test': test.id()})
+                if _in_main_thread():
+                    # Each stream replayed into its own, & reported combined.
+                    output = _BufferStream()
+                    self._captured = (sys.stdout, sys.stderr, output,
+                                      _BufferStream(output), _BufferStream(output))
+                    sys.stdout, sys.stderr = self._captured[3:]
+                _get_timing_result_class().startTest(self, test)
+
+            def stopTest(self, test):
+                _get_timing_result_class().stopTest(self, test)
+                output = ''
+                if self._captured is not None:
+                    sys.stdout, sys.stderr, buf, out, err = self._captured
+                    self._captured = None
+                    output = buf.getvalue()
+                    if output and not self.quiet:
+                        sys.stdout.write(out.getvalue())
+                        sys.stderr.write(err.getvalue())
+                event = self._outcome or {'event': 'pass'}
+                event.update(test=test.id(), duration=self.durations.get(test.id()),
+                             output=output)
+                self.emit(event)
+                self._current = None
+
+            def _record(self, status, test, message=None):
+                event = {'event': status, 'message': message}
+                if test is not self._current:
+                    # Errors out of tests, as of class/module fixtures.
+                    event['test'] = test.id()
+                    self.emit(event)
+                elif self._outcome is None or self._outcome['event'] in ('pass', 'skip'):
+                    self._outcome = event
+
+            def addSuccess(self, test):
+                _get_timing_result_class().addSuccess(self, test)
+                self._record('pass', test)
+
+            def addFailure(self, test, err):
+                _get_timing_result_class().addFailure(self, test, err)
+                self._record('fail', test, self._exc_info_to_string(err, test))
+
+            def addError(self, test, err):
+                _get_timing_result_class().addError(self, test, err)
+                self._record('error', test, self._exc_info_to_string(err, test))
+
+            def addSkip(self, test, reason):
+                _get_timing_result_class().addSkip(self, test, reason)
+                self._record('skip', test, reason)
+
+            def addExpectedFailure(self, test, err):
+                _get_timing_result_class().addExpectedFailure(self, test, err)
+                self._record('xfail', test)
+
+            def addUnexpectedSuccess(self, test):
+                _get_timing_result_class().addUnexpectedSuccess(self, test)
+                self._record('xpass', test)
+
+            def addSubTest(self, test, subtest, err):
+                _get_timing_result_class().addSubTest(self, test, subtest, err)
+                if err is not None:
+                    failed = issubclass(err[0], test.failureException)
+                    self._record('fail' if failed else 'error', test,
+                                 self._exc_info_to_string(err, test))
+
+        _event_result_class = EventTestResult
+    return _event_result_class
+
+def _event_result_class_for(emit, quiet=False):
+    return type('EventTestResult', (_get_event_result_class(),),
+                {'emit': staticmethod(emit), 'quiet': quiet})
+
+# Environment variable telling children seconds each test may run for.
+TEST_TIMEOUT_ENV = 'IPYENV_TEST_TIMEOUT'
+
+class _TestWatchdog(object):
+    """
+    Thread killing the process group of this process (or only this
+    process if not leading a group) when a test armed runs over `timeout`.
+    """
+
+    def __init__(self, timeout):
+        self._timeout = timeout
+        self._condition = threading.Condition()
+        self._deadline = None
+        self._test_id = None
+        thread = threading.Thread(target=self._watch, name='ipyenv-watchdog')
+        thread.daemon = True
+        thread.start()
+
+    def arm(self, test_id):
+        with self._condition:
+            self._deadline = _timer() + self._timeout
+            self._test_id = test_id
+            self._condition.notify()
+
+    def disarm(self):
+        with self._condition:
+            self._deadline = None
+            self._condition.notify()
+
+    def _watch(self):
+        with self._condition:
+            while True:
+                if self._deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = self._deadline - _timer()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                self._expire(self._test_id)
+
+    def _expire(self, test_id):
+        sys.stderr.write('ipyenv: test {} timed out after {}s\n'.format(test_id, self._timeout))
+        sys.stderr.flush()
+        if hasattr(os, 'killpg') and os.getpgrp() == os.getpid():
+            os.killpg(os.getpid(), signal.SIGKILL)
+        os._exit(1)
+
+def _watched_result_class_for(base, watchdog):
+    """Subclass of the test result class arming `watchdog` while each test runs."""
+    def startTest(self, test):
+        watchdog.arm(test.id())
+        base.startTest(self, test)
+    def stopTest(self, test):
+        base.stopTest(self, test)
+        watchdog.disarm()
+    return type('WatchedTestResult', (base,), {'startTest': startTest, 'stopTest': stopTest})
+
+def _install_event_hook():
+    """
+    In children given a pipe by the runner, make `unittest` runners
+    (as of `unittest.main`) emit test events into it. Given a test
+    timeout, tests running over it kill the process group as well.
+    """
+    fd = os.environ.pop(EVENTS_FD_ENV, None)
+    quiet = os.environ.pop(EVENTS_QUIET_ENV, None) == '1'
+    test_timeout = os.environ.pop(TEST_TIMEOUT_ENV, None)
+    if fd is None and test_timeout is None:
+        return
+    import unittest
+    import unittest.runner
+    base = unittest.runner.TextTestRunner
+    if fd is None:
+        result_class = base.resultclass
+    else:
+        result_class = _event_result_class_for(_PipeEmitter(int(fd)).emit, quiet)
+    if test_timeout is not None:
+        result_class = _watched_result_class_for(result_class,
+                                                 _TestWatchdog(float(test_timeout)))
+
+    class EventTestRunner(base):
+
+        resultclass = result_class
+
+        def __init__(self, stream=None, *args, **kwargs):
+            if quiet:
+                stream = _NullStream()
+            base.__init__(self, stream, *args, **kwargs)
+
+    unittest.runner.TextTestRunner = unittest.TextTestRunner = EventTestRunner
+
+
+class Reporter(object):
+    """
+    Base of reporters of test events (see `_get_event_result_class`),
+    each tagged with the test file path, called one at a time.
+    """
+
+    def event(self, testfile_path, event):
+        pass
+
+    def end_file(self, testfile_path, returncode, duration=None):
+        """Called when a test file finished, with its exit status."""
+        pass
+
+    def close(self):
+        pass
+
+
+class ConsoleReporter(Reporter):
+    """Print a line per test, & tracebacks & output of failed ones."""
+
+    LABELS = {'pass': 'ok', 'fail': 'FAIL', 'error': 'ERROR', 'skip': 'skip',
+              'xfail': 'xfail', 'xpass': 'XPASS'}
+
+    def __init__(self, stream=None):
+        self._stream = stream or sys.stdout
+
+    def event(self, testfile_path, event):
+        status = event.get('event')
+        if status not in self.LABELS:
+            return
+        self._stream.write('{:<6} {:8.3f}s  {}\n'.format(
+            self.LABELS[status], event.get('duration') or 0.0, event.get('test')))
+        if status in ('fail', 'error'):
+            for key in ('message', 'output'):
+                if event.get(key):
+                    self._stream.write(event[key].rstrip('\n') + '\n')
+        self._stream.flush()
+
+    def end_file(self, testfile_path, returncode, duration=None):
+        if returncode != 0:
+            self._stream.write('FAILED (exit status {}): {}\n'.format(returncode, testfile_path))
+            self._stream.flush()
+
+
+class JSONLReporter(Reporter):
+    """
+    Write each test event into a file as a JSON line, with the test file
+    path, & {'event': 'file', 'file', 'returncode', 'duration'} per file.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+
+    def _write(self, event):
+        self._file.write((json.dumps(event, sort_keys=True) + '\n').encode('utf-8'))
+        self._file.flush()
+
+    def event(self, testfile_path, event):
+        event = dict(event)
+        event['file'] = testfile_path
+        self._write(event)
+
+    def end_file(self, testfile_path, returncode, duration=None):
+        self._write({'event': 'file', 'file': testfile_path,
+                     'returncode': returncode, 'duration': duration})
+
+    def close(self):
+        self._file.close()
+
+
+# Characters not allowed in XML.
+RE_XML_INVALID = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+class JUnitReporter(Reporter):
+    """
+    Write JUnit XML, a <testsuite> per test file. Test cases are buffered
+    only while events of the same file come in a row, so test files run
+    in parallel may be split into several <testsuite> elements.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._write(u'<?xml version="1.0" encoding="utf-8"?>\n<testsuites>\n')
+        self._file.flush()  # nothing left buffered for forked workers
+        self._current = None    # test file path of cases buffered
+        self._cases = []
+        self._counts = {}
+        self._seen = set()
+
+    def _write(self, text):
+        self._file.write(RE_XML_INVALID.sub(u'', text).encode('utf-8'))
+
+    def _flush(self):
+        if self._current is None:
+            return
+        counts = self._counts
+        self._write(u'<testsuite name={} tests="{}" failures="{}" errors="{}" '
+                    u'skipped="{}" time="{:.3f}">\n'.format(
+                        xml_quoteattr(_shard_key(self._current)), len(self._cases),
+                        counts.get('fail', 0) + counts.get('xpass', 0),
+                        counts.get('error', 0), counts.get('skip', 0),
+                        counts.get('time', 0.0)))
+        for case in self._cases:
+            self._write(case)
+        self._write(u'</testsuite>\n')
+        self._file.flush()
+        self._current = None
+        self._cases = []
+        self._counts = {}
+
+    def event(self, testfile_path, event):
+        status = event.get('event')
+        if status == 'start':
+            return
+        if testfile_path != self._current:
+            self._flush()
+            self._current = testfile_path
+            self._seen.add(testfile_path)
+        test_id = event.get('test') or ''
+        classname, _, name = test_id.rpartition('.')
+        if classname.split('.')[0] == '__main__':
+            # Scripts run as __main__ are named after their files.
+            module_name = os.path.splitext(os.path.basename(testfile_path))[0]
+            classname = module_name + classname[len('__main__'):]
+        duration = event.get('duration') or 0.0
+        self._counts[status] = self._counts.get(status, 0) + 1
+        self._counts['time'] = self._counts.get('time', 0.0) + duration
+        message = event.get('message') or ''
+        if status in ('fail', 'error', 'xpass'):
+            tag = 'error' if status == 'error' else 'failure'
+            first_line = (message.strip().splitlines() or ['unexpected success'])[-1]
+            detail = u'<{0} message={1}>{2}</{0}>'.format(tag, xml_quoteattr(first_line),
+                                                          xml_escape(message))
+        elif status == 'skip':
+            detail = u'<skipped message={}/>'.format(xml_quoteattr(message))
+        else:
+            detail = u''
+        if event.get('output'):
+            detail += u'<system-out>{}</system-out>'.format(xml_escape(event['output']))
+        self._cases.append(u'<testcase classname={} name={} time="{:.3f}">{}</testcase>\n'.format(
+            xml_quoteattr(classname), xml_quoteattr(name), duration, detail))
+
+    def end_file(self, testfile_path, returncode, duration=None):
+        if testfile_path == self._current:
+            self._flush()
+        elif testfile_path not in self._seen and returncode != 0:
+            # Failed with no test reported (as of errors on import).
+            self._flush()
+            self._current = testfile_path
+            self._seen.add(testfile_path)
+            message = 'exit status {}'.format(returncode)
+            self._counts = {'error': 1, 'time': duration or 0.0}
+            self._cases.append(u'<testcase classname={} name="(file)" time="{:.3f}">'
+                               u'<error message={}/></testcase>\n'.format(
+                                   xml_quoteattr(_shard_key(testfile_path)),
+                                   duration or 0.0, xml_quoteattr(message)))
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self._write(u'</testsuites>\n')
+        self._file.close()
+
+
+def _make_reporter(spec):
+    """Reporter by the notation: "console", "jsonl:PATH" or "junit:PATH"."""
+    if isinstance(spec, Reporter):
+        return spec
+    kind, _, path = spec.partition(':')
+    if kind == 'console' and not path:
+        return ConsoleReporter()
+    if kind == 'jsonl' and path:
+        return JSONLReporter(path)
+    if kind == 'junit' and path:
+        return JUnitReporter(path)
+    raise ValueError('invalid reporter: "{}"'.format(spec))
+
+
+class _Reporting(object):
+    """Reporters called one at a time, from threads of the runner."""
+
+    def __init__(self, reporters):
+        self._reporters = reporters
+        self._lock = threading.Lock()
+        self.quiet = any(isinstance(reporter, ConsoleReporter) for reporter in reporters)
+
+    def event(self, testfile_path, event):
+        with self._lock:
+            for reporter in self._reporters:
+                reporter.event(testfile_path, event)
+
+    def end_file(self, testfile_path, returncode, duration=None):
+        with self._lock:
+            for reporter in self._reporters:
+                reporter.end_file(testfile_path, returncode, duration)
+
+    def close(self):
+        for reporter in self._reporters:
+            reporter.close()
+
+
+class _EventCollector(object):
+    """Stand-in of `_Reporting` in pool workers, keeping events to pass to the parent."""
+
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        self.events = []
+
+    def event(self, testfile_path, event):
+        self.events.append(('event', (testfile_path, event)))
+
+    def end_file(self, testfile_path, returncode, duration=None):
+        self.events.append(('end_file', (testfile_path, returncode, duration)))
+
+
+# Created on demand, `unittest` is imported lazily.
+_isolated_suite_class = None
+
+def _get_isolated_suite_class():
+    """`unittest.TestSuite` subclass running tests with their own modules."""
+    global _isolated_suite_class
+    if _isolated_suite_class is None:
+        import unittest
+
+        class IsolatedTestSuite(unittest.TestSuite):
+            """
+            Test suite of a test file loaded in isolation, putting its modules
+            back into `sys.modules` while run & taking them out again after.
+            """
+
+            def __init__(self, tests=(), modules=None):
+                unittest.TestSuite.__init__(self, tests)
+                self.modules = modules or {}
+
+            def run(self, result, *args, **kwargs):
+                orig_modules = dict((name, sys.modules.get(name)) for name in self.modules)
+                sys.modules.update(self.modules)
+                try:
+                    result = unittest.TestSuite.run(self, result, *args, **kwargs)
+                    # Class & module fixtures torn down while the modules are in.
+                    if hasattr(self, '_handleModuleTearDown'):
+                        self._tearDownPreviousClass(None, result)
+                        self._handleModuleTearDown(result)
+                        result._previousTestClass = None
+                    return result
+                finally:
+                    for name, module in orig_modules.items():
+                        if module is None:
+                            sys.modules.pop(name, None)
+                        else:
+                            sys.modules[name] = module
+
+        _isolated_suite_class = IsolatedTestSuite
+    return _isolated_suite_class
+
+
+def _iter_tests(suite):
+    """Flatten nested test suites into test cases."""
+    for test in suite:
+        if hasattr(test, '__iter__'):
+            for inner in _iter_tests(test):
+                yield inner
+        else:
+            yield test
+
+
+def _failure_scope(test_id):
+    """
+    Name of tests a failure of the test id covers (as the id itself, or
+    the prefix of ids before '.'): the test of a sub-test as
+    'module.Class.test (i=1)', or the class/module of a fixture as
+    'setUpClass (module.Class)'.
+    """
+    head, sep, rest = test_id.partition(' (')
+    if not sep or not rest.endswith(')'):
+        return test_id
+    return head if '.' in head else rest[:-1]
+
+def _in_scope(test_id, scope):
+    return test_id == scope or test_id.startswith(scope + '.')
+
+def _test_file_of(test_id, test_files):
+    """
+    Test file path of the test id (also of sub-tests & fixtures, see
+    `_failure_scope`) in `test_files` mapping test ids to paths, or None.
+    """
+    if test_id in test_files:
+        return test_files[test_id]
+    scope = _failure_scope(test_id)
+    for known_id, testfile_path in test_files.items():
+        if _in_scope(known_id, scope):
+            return testfile_path
+    return None
+
+
+# Attribute of test classes/modules to run them serially, not on threads.
+SERIAL_MARKER = '__ipyenv_serial__'
+
+def _thread_units(tests):
+    """
+    Group tests into units run on threads, by test class (or module if
+    it has module fixtures), formed [(tests, whether marked serial)].
+    """
+    units = []
+    positions = {}
+    for test in tests:
+        test_class = test.__class__
+        module = sys.modules.get(test_class.__module__)
+        if hasattr(module, 'setUpModule') or hasattr(module, 'tearDownModule'):
+            key = ('module', test_class.__module__)
+        else:
+            key = ('class', test_class)
+        if key not in positions:
+            serial = getattr(test_class, SERIAL_MARKER, False) or \
+                     getattr(module, SERIAL_MARKER, False)
+            positions[key] = len(units)
+            units.append(([], bool(serial)))
+        units[positions[key]][0].append(test)
+    return units
+
+
+class _BufferStream(object):
+    """Stream keeping written text, to report later (also into `combined` if given)."""
+
+    def __init__(self, combined=None):
+        self._chunks = []
+        self._combined = combined
+
+    def write(self, text):
+        self._chunks.append(text)
+        if self._combined is not None:
+            self._combined.write(text)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return ''.join(self._chunks)
+
+
+# Created on demand, `unittest` is imported lazily.
+_threaded_suite_class = None
+
+def _get_threaded_suite_class():
+    """`unittest.TestSuite` subclass running tests on a thread pool."""
+    global _threaded_suite_class
+    if _threaded_suite_class is None:
+        import unittest
+
+        class ThreadedTestSuite(unittest.TestSuite):
+            """
+            Test suite running units of tests (see `_thread_units`) on
+            `threads` threads, each into its own result, which are merged
+            & reported in the original order. Units marked serial run
+            after the others, one at a time.
+            """
+
+            def __init__(self, tests=(), threads=2):
+                unittest.TestSuite.__init__(self, tests)
+                self.threads = threads
+
+            def run(self, result, debug=False):
+                units = _thread_units(list(_iter_tests(self)))
+                verbosity = 2 if getattr(result, 'showAll', False) else \
+                            1 if getattr(result, 'dots', False) else 0
+
+                def run_unit(tests):
+                    stream = _BufferStream()
+                    unit_result = result.__class__(result.stream.__class__(stream),
+                                                   result.descriptions, verbosity)
+                    unittest.TestSuite(tests).run(unit_result)
+                    return unit_result, stream
+
+                parallel = [tests for tests, serial in units if not serial]
+                pool = multiprocessing.pool.ThreadPool(min(self.threads, len(parallel) or 1))
+                try:
+                    unit_results = iter(pool.map(run_unit, parallel))
+                finally:
+                    pool.close()
+                    pool.join()
+                for tests, serial in units:
+                    unit_result, stream = run_unit(tests) if serial else next(unit_results)
+                    result.stream.write(stream.getvalue())
+                    result.testsRun += unit_result.testsRun
+                    for name in ('failures', 'errors', 'skipped',
+                                 'expectedFailures', 'unexpectedSuccesses'):
+                        if hasattr(result, name):
+                            getattr(result, name).extend(getattr(unit_result, name, ()))
+                    if isinstance(getattr(result, 'durations', None), dict):
+                        result.durations.update(unit_result.durations)
+                    if unit_result.shouldStop:
+                        result.shouldStop = True
+                result.stream.flush()
+                return result
+
+        _threaded_suite_class = ThreadedTestSuite
+    return _threaded_suite_class
+
+
+def _current_rss():
+    """
+    Resident set size of this process in bytes, or the peak of it if
+    not known (but `resource` available), or None.
+    """
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes except in OS X.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _rss_exceeded(max_rss):
+    """Whether this process grows over `max_rss` bytes (never if None)."""
+    if max_rss is None:
+        return False
+    rss = _current_rss()
+    if rss is None or rss <= max_rss:
+        return False
+    import gc
+    # Modules dropped may be only in reference cycles.
+    gc.collect()
+    rss = _current_rss()
+    return rss is not None and rss > max_rss
+
+
+# Created on demand, `unittest` is imported lazily.
+_streaming_suite_class = None
+
+def _get_streaming_suite_class():
+    """`unittest.TestSuite` subclass loading & running test files one by one."""
+    global _streaming_suite_class
+    if _streaming_suite_class is None:
+        import unittest
+
+        class StreamingTestSuite(unittest.TestSuite):
+            """
+            Test suite of test files, each loaded by `load` (returning a
+            test suite which takes its modules out of `sys.modules` after
+            run) just before run & dropped after. Stops when the process
+            grows over `max_rss` bytes, leaving the rest in `pending`.
+            """
+
+            def __init__(self, testfile_paths, load, max_rss=None):
+                unittest.TestSuite.__init__(self)
+                self.pending = list(testfile_paths)
+                self.load = load
+                self.max_rss = max_rss
+
+            def run(self, result, debug=False):
+                # Entered as the top level (as `unittest.TestSuite.run`), so
+                # that fixtures are torn down only by each suite loaded.
+                top_level = not getattr(result, '_testRunEntered', False)
+                if top_level:
+                    result._testRunEntered = True
+                try:
+                    while self.pending and not result.shouldStop:
+                        testfile_path = self.pending.pop(0)
+                        suite = self.load(testfile_path)
+                        suite(result)
+                        del suite
+                        if self.pending and _rss_exceeded(self.max_rss):
+                            logger.info('RSS over the limit: {} test files left'.format(
+                                len(self.pending)))
+                            break
+                finally:
+                    if top_level:
+                        result._testRunEntered = False
+                return result
+
+        _streaming_suite_class = StreamingTestSuite
+    return _streaming_suite_class
+
+
+class TestSummary(object):
+    """
+    Pass/fail results of executed test files,
+    mergeable over contexts & worker processes.
+    """
+
+    def __init__(self):
+        self.executed = []  # test file paths
+        self.tests_run = 0  # counted only for suite-loaded tests
+        self.failures = []  # (test file path, test id or None)
+        # Seconds taken by each phase (discovery, import, run),
+        # test file & test (only for suite-loaded tests).
+        self.durations = {'phases': {}, 'files': {}, 'tests': {}}
+        # Test events not reported yet, from pool workers.
+        self.events = []
+        # Test files left to run in a fresh worker, in streaming mode.
+        self.pending = []
+        # Resources used by child processes of test files (see `_ChildWatch`),
+        # & test files killed by timeout.
+        self.resources = {}
+        self.timeouts = []
+
+    def add_file_result(self, testfile_path, returncode, duration=None):
+        """Record a test file executed as a whole, by its exit status."""
+        self.executed.append(testfile_path)
+        if returncode != 0:
+            self.failures.append((testfile_path, None))
+        if duration is not None:
+            self.add_duration('files', testfile_path, duration)
+            self.add_duration('phases', 'run', duration)
+
+    def add_duration(self, kind, name, seconds):
+        durations = self.durations[kind]
+        durations[name] = durations.get(name, 0.0) + seconds
+
+    def add_unittest_result(self, result, testfile_paths, test_files):
+        """
+        Record a `unittest.TestResult` of the test files, with
+        `test_files` mapping test ids to the test file paths.
+        """
+        self.executed.extend(testfile_paths)
+        self.tests_run += result.testsRun
+        for test, _ in result.failures + result.errors:
+            testfile_path = _test_file_of(test.id(), test_files)
+            if testfile_path is None and len(testfile_paths) == 1:
+                testfile_path = testfile_paths[0]
+            self.failures.append((testfile_path, test.id()))
+
+    def merge(self, other):
+        self.executed.extend(other.executed)
+        self.tests_run += other.tests_run
+        self.failures.extend(other.failures)
+        self.resources.update(other.resources)
+        self.timeouts.extend(other.timeouts)
+        for kind, durations in other.durations.items():
+            for name, seconds in durations.items():
+                self.add_duration(kind, name, seconds)
+        return self
+
+    @property
+    def succeeded(self):
+        return not self.failures
+
+    @property
+    def exit_code(self):
+        return 0 if self.succeeded else 1
+
+    def report(self):
+        """Log the summary."""
+        failed_files = sorted(set(path for path, _ in self.failures
+                                  if path is not None))
+        logger.info('executed {} test files: {} failed'.format(
+            len(self.executed), len(failed_files)))
+        for path, test_id in self.failures:
+            if test_id is None:
+                logger.error('failed: "{}"'.format(path))
+            else:
+                logger.error('failed: {} ("{}")'.format(test_id, path))
+        for path in self.timeouts:
+            logger.error('timed out: "{}"'.format(path))
+
+    def report_durations(self, count):
+        """Print the slowest `count` tests & test files, with all phases."""
+        for kind, title, limit in (('tests', 'tests', count),
+                                   ('files', 'test files', count),
+                                   ('phases', 'phases', None)):
+            durations = sorted(self.durations[kind].items(),
+                               key=lambda item: (-item[1], item[0]))[:limit]
+            if not durations:
+                continue
+            print("")
+            print("slowest {} {}:".format(len(durations), title))
+            print("----------------------------------------------------------------------")
+            for name, seconds in durations:
+                print("    {:10.3f}s  {}".format(seconds, name))
+
+    def report_resources(self, count):
+        """Print test files using the most CPU time & memory, in child processes."""
+        for key, title in (('cpu', 'CPU time'), ('maxrss', 'memory')):
+            usages = sorted(((resources[key], path) for path, resources in self.resources.items()
+                             if key in resources), key=lambda item: (-item[0], item[1]))[:count]
+            if not usages:
+                continue
+            print("")
+            print("test files using the most {} (wall / CPU / max RSS):".format(title))
+            print("----------------------------------------------------------------------")
+            for _, path in usages:
+                resources = self.resources[path]
+                print("    {:10.3f}s {:10.3f}s {:8.1f}MB  {}".format(
+                    resources['wall'], resources['cpu'],
+                    resources['maxrss'] / (1024.0 * 1024.0), path))
+
+
+def _parse_imports(source_path):
+    """
+    Statically parse import statements of the file into
+    (relative level, module name, imported names).
+    """
+    with open(source_path, 'rb') as f:
+        tree = ast.parse(f.read(), source_path)
+    imports = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                imports.append((0, alias.name, ()))
+        elif isinstance(node, ast.ImportFrom):
+            imports.append((node.level or 0, node.module or '',
+                            tuple(alias.name for alias in node.names)))
+    return imports
+
+def _resolve_source(base_path, module_name):
+    """
+    Source files executed to import the module from the base path,
+    from parent packages to the module itself, or [] if not found.
+    """
+    sources = []
+    path = base_path
+    parts = module_name.split('.') if module_name else []
+    for i, part in enumerate(parts):
+        package_init = os.sep.join((path, part, '__init__.py'))
+        module_path = os.sep.join((path, part + '.py'))
+        if os.path.isfile(package_init):
+            sources.append(package_init)
+            path = os.sep.join((path, part))
+        elif i == len(parts) - 1 and os.path.isfile(module_path):
+            sources.append(module_path)
+        else:
+            return []
+    return sources
+
+def _resolve_imports(source_path, search_paths):
+    """Source files imported by the file, found in search paths."""
+    resolved = set()
+    for level, module_name, names in _parse_imports(source_path):
+        if level:
+            # Relative to the package.
+            base_path = os.path.dirname(source_path)
+            for _ in range(level - 1):
+                base_path = os.path.dirname(base_path)
+            bases = [base_path]
+        else:
+            # The top-level module/package is found in the first path.
+            top_name = module_name.partition('.')[0]
+            bases = [path for path in search_paths
+                     if _resolve_source(path, top_name)][:1]
+        for base_path in bases:
+            resolved.update(_resolve_source(base_path, module_name))
+            # Submodules imported by `from package import module`.
+            for name in names:
+                submodule_name = '.'.join((module_name, name)) if module_name else name
+                resolved.update(_resolve_source(base_path, submodule_name))
+    resolved.discard(source_path)
+    return resolved
+
+
+class ImportGraph(object):
+    """
+    Import graph of test files & source files reachable from them,
+    statically parsed with `ast` & updated incrementally by mtimes.
+    The cache is formed:
+        {'files': {path: [mtime, imported paths]},
+         'snapshot': {path: mtime at the last recorded run} or None}
+    """
+
+    def __init__(self, cache=None):
+        cache = cache or {}
+        self._files = cache.get('files', {})
+        self._snapshot = cache.get('snapshot')
+
+    def update(self, entry_paths, ext_paths):
+        """
+        Update the graph with files reachable from the entries, parsing
+        only files changed. Each file is resolved in its directory
+        & `ext_paths` (possibly more imports than actual, never less).
+        """
+        ext_paths = [path for path in ext_paths]
+        files = {}
+        pending = list(entry_paths)
+        while pending:
+            path = pending.pop()
+            if path in files:
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            entry = self._files.get(path)
+            if entry is None or entry[0] != mtime:
+                try:
+                    imported = _resolve_imports(path, [os.path.dirname(path)] + ext_paths)
+                except (SyntaxError, ValueError, IOError, OSError) as ex:
+                    logger.debug('imports not parsed from "{}": {}'.format(path, ex))
+                    imported = set()
+                entry = [mtime, sorted(imported)]
+            files[path] = entry
+            pending.extend(entry[1])
+        self._files = files
+
+    def changed(self):
+        """
+        Files changed or removed since the last recorded run, or None if
+        never recorded. Files removed are still listed by their importers.
+        """
+        if self._snapshot is None:
+            return None
+        changed = set(path for path, entry in self._files.items()
+                      if self._snapshot.get(path) != entry[0])
+        return changed | (set(self._snapshot) - set(self._files))
+
+    def record(self):
+        """Record mtimes of the files as the last run."""
+        self._snapshot = dict((path, entry[0]) for path, entry in self._files.items())
+
+    def dependents(self, changed_paths):
+        """Files importing any of the changed files transitively, including themselves."""
+        importers = {}
+        for path, entry in self._files.items():
+            for imported in entry[1]:
+                importers.setdefault(imported, []).append(path)
+        affected = set()
+        pending = list(changed_paths)
+        while pending:
+            path = pending.pop()
+            if path in affected:
+                continue
+            affected.add(path)
+            pending.extend(importers.get(path, ()))
+        return affected
+
+    def to_cache(self):
+        return {'files': self._files, 'snapshot': self._snapshot}
+
+
+def _shard_key(testfile_path):
+    """Key of the test file common to machines, relative to the current directory."""
+    return os.path.relpath(testfile_path).replace(os.sep, '/')
+
+def _select_shard(testfile_paths, shard, durations=None):
+    """
+    Select test files of the shard (index, count), balanced by durations
+    (known by test file paths) if any, else by a stable hash of paths.
+    Every machine selects the same given the same paths & durations.
+    """
+    index, count = shard
+    keys = dict((path, _shard_key(path)) for path in testfile_paths)
+    durations = dict((_shard_key(path), seconds)
+                     for path, seconds in (durations or {}).items())
+    known = [durations[key] for key in keys.values() if key in durations]
+    if not known:
+        return [path for path in testfile_paths
+                if int(hashlib.md5(keys[path].encode('utf-8')).hexdigest(), 16) % count == index - 1]
+    # Longest processing time first, unknown ones as the average.
+    average = sum(known) / len(known)
+    cost = dict((path, durations.get(keys[path], average)) for path in testfile_paths)
+    loads = [0.0] * count
+    selected = set()
+    for path in sorted(testfile_paths, key=lambda path: (-cost[path], keys[path])):
+        lightest = min(range(count), key=lambda i: (loads[i], i))
+        loads[lightest] += cost[path]
+        if lightest == index - 1:
+            selected.add(path)
+    return [path for path in testfile_paths if path in selected]
+
+
+def _module_name_of(source_path, library_path):
+    """Dotted module name of the source file in the library path, or None if not in it."""
+    try:
+        relpath = os.path.relpath(source_path, library_path)
+    except ValueError:
+        # On another drive.
+        return None
+    if relpath.startswith(os.pardir) or os.path.isabs(relpath):
+        return None
+    names = os.path.splitext(relpath)[0].split(os.sep)
+    if names[-1] == '__init__':
+        names.pop()
+    return '.'.join(names) or None
+
+def _unload_modules(source_paths):
+    """Remove modules loaded from the source files from `sys.modules`."""
+    source_paths = set(os.path.normcase(path) for path in source_paths)
+    if not source_paths:
+        return
+    for module_name, module in list(sys.modules.items()):
+        module_file = getattr(module, '__file__', None)
+        if not module_file:
+            continue
+        if module_file.endswith(('.pyc', '.pyo')):
+            module_file = module_file[:-1]
+        if os.path.normcase(os.path.abspath(module_file)) in source_paths:
+            logger.debug('unload module: "{}"'.format(module_name))
+            del sys.modules[module_name]
+
+
+# Runner of the current worker process in `TestRunner` process pools.
+_pool_runner = None
+
+# Queue of test files for pool workers limited by RSS, ended by None.
+_pool_queue = None
+
+def _init_pool_worker(runner, log_level=None, queue=None):
+    global _pool_runner, _pool_queue
+    if log_level is not None:
+        logger.setLevel(log_level)
+    if isinstance(runner._reporting, _Reporting):
+        # Forked with reporters of the parent, never to be written to.
+        runner._reporting = _EventCollector(runner._reporting.quiet)
+    _pool_runner = runner
+    _pool_queue = queue
+
+def _run_pool_job(job):
+    """Call a method of the worker's runner by (name, args, kwargs)."""
+    method_name, args, kwargs = job
+    return getattr(_pool_runner, method_name)(*args, **kwargs)
+
+
+def _restore_runner(cls, state):
+    """Unpickle a `TestRunner`."""
+    runner = cls.__new__(cls)
+    runner.__dict__.update(state)
+    return runner
+
+
+class TestRunner(object):
+    """
+    Implements test runner functionality.
+    Uses PathEnvironment as environment supplyer.
+    """
+
+    def __init__(self, test_paths=('./tests',), sitelib_paths=('./sitelib',),
+                 rcfile_encoding='utf-8', append_main=False, verbosity=1,
+                 suite_autoload=True, jobs=1, fork_worker=False, preload=tuple(),
+                 cache_dir=CACHE_DIR, single_exec=None, inline_proxy=True,
+                 durations=0, durations_file=None, affected=None,
+                 shard=None, shard_durations=None, last_failed=False, failed_first=False,
+                 isolate=False, threads=1, reporters=tuple(), streaming=False, max_rss=None,
+                 timeout=None, test_timeout=None):
+        self._cache_dir = cache_dir
+        # The resolved configuration is cached with the others.
+        ProjectConfig.get(cache_dir)
+        # Extend common library pahts.
+        library_paths = []
+        for sitelib_dir in sitelib_paths:
+            library_paths.extend(_load_extdir(sitelib_dir, rcfile_encoding, '.sitelibs'))
+        self._library_paths = ExtPathSet(library_paths, strict=False)
+        # Find tests with extension config. recursively.
+        self._test_paths = test_paths
+        self._rcfile_encoding = rcfile_encoding
+        self._discover()
+        # Save extra arguments.
+        if append_main is True and suite_autoload is True:
+            raise RuntimeError('confusing auto-exec options')
+        self._append_main = append_main
+        # Test scripts appended `unittest.main` are executed once by default.
+        self._single_exec = append_main if single_exec is None else single_exec
+        self._suite_autoload = suite_autoload
+        self._verbosity = verbosity
+        self._inline_proxy = inline_proxy
+        self._durations = durations
+        self._durations_file = durations_file
+        # Changed paths to select tests by, [] for since the last run.
+        self._affected = affected
+        # (index, count) & JSON file of durations to balance shards by, shared
+        # by all machines (not the cache of each, to split the same anywhere).
+        self._shard = shard
+        self._shard_durations = shard_durations
+        self._last_failed = last_failed
+        self._failed_first = failed_first
+        self._failed = {}   # test file => test ids failed (if known) in the last run
+        # Load each test file with its own modules in auto-exec.
+        self._isolate = isolate
+        # Threads to run tests on in auto-exec.
+        if threads < 1:
+            raise ValueError('invalid number of threads: {}'.format(threads))
+        if threads > 1 and multiprocessing is None:
+            logger.warning('multiprocessing not available: run tests in a thread')
+            threads = 1
+        self._threads = threads
+        # Load, run & unload test files one by one in auto-exec, handing
+        # the rest over to a fresh worker when RSS grows over `max_rss` MB.
+        if max_rss is not None:
+            if max_rss <= 0:
+                raise ValueError('invalid RSS limit: {}'.format(max_rss))
+            streaming = True
+        self._streaming = streaming
+        self._max_rss = None if max_rss is None else max_rss * 1024 * 1024
+        # Seconds each test file & test may run for in child processes,
+        # killing their process groups (see `_ChildWatch` & `_TestWatchdog`).
+        for name, seconds in (('timeout', timeout), ('test timeout', test_timeout)):
+            if seconds is not None and seconds <= 0:
+                raise ValueError('invalid {}: {}'.format(name, seconds))
+        if (timeout is not None or test_timeout is not None) and suite_autoload:
+            logger.warning('timeouts apply only to test scripts run in child processes')
+        self._timeout = timeout
+        self._test_timeout = test_timeout
+        # Reporters of test events, or their notations (see `_make_reporter`).
+        self._reporters = list(reporters)
+        self._reporting = None
+        if jobs < 0:
+            raise ValueError('invalid number of jobs: {}'.format(jobs))
+        if jobs == 0:
+            jobs = multiprocessing.cpu_count() if multiprocessing else 1
+        if jobs > 1 and multiprocessing is None:
+            logger.warning('multiprocessing not available: run tests serially')
+            jobs = 1
+        self._jobs = jobs
+        if fork_worker and not hasattr(os, 'fork'):
+            logger.warning('fork not available: execute tests by subprocessing')
+            fork_worker = False
+        self._fork_worker = fork_worker
+        self._preload = list(preload)
+        self._preloaded = False
+
+    def _discover(self):
+        """Find tests & extension paths of each context (test directory)."""
+        self._tests = {}        # context => tests
+        self._ext_paths = {}    # context => extension paths(test target paths)
+        self._contexts = {}     # test => context
+        started = _timer()
+        discovery = self._load_discovery_index()
+        self._discovery_updated = False
+        for test_dir in self._test_paths:
+            if not (os.path.exists(test_dir) and os.path.isdir(test_dir)):
+                logger.error('tests directory "{}" not found'.format(test_dir))
+                continue
+            test_dir = os.path.abspath(test_dir)
+            index = discovery['contexts'].setdefault(test_dir, {})
+            self._tests[test_dir] = self._find_tests(test_dir, index)
+            self._ext_paths[test_dir] = _load_extdir(test_dir, self._rcfile_encoding, '.testfor')
+            for test_path in self._tests[test_dir]:
+                self._contexts.setdefault(test_path, test_dir)
+        if self._discovery_updated:
+            _save_cache(self._cache_dir, self.DISCOVERY_CACHE, discovery)
+        self._discovery_time = _timer() - started
+
+    def __getstate__(self):
+        # Reporters stay in the parent, events are kept in pool workers.
+        state = dict(self.__dict__)
+        if self._reporting is not None:
+            state['_reporting'] = _EventCollector(self._reporting.quiet)
+        return state
+
+    def __reduce__(self):
+        # Configured classes (see `configured`) are not importable by name.
+        cls = self.__class__
+        if getattr(sys.modules.get(cls.__module__), cls.__name__, None) is not cls:
+            cls = TestRunner
+        return (_restore_runner, (cls, self.__getstate__()))
+
+    def _start_reporting(self):
+        if self._reporters and self._reporting is None:
+            self._reporting = _Reporting([_make_reporter(spec) for spec in self._reporters])
+
+    # Test script filename patterns.
+    RE_TEST_SCRIPT_NAME = re.compile('^[Tt]est.*\.py$')
+
+    # Cache name of the discovery index.
+    DISCOVERY_CACHE = 'discovery.json'
+
+    def _load_discovery_index(self):
+        """
+        Load the discovery index formed:
+            {'pattern': RE_TEST_SCRIPT_NAME.pattern,
+             'contexts': {context: {directory: [mtime, test filenames, subdirectories]}}}
+        """
+        discovery = _load_cache(self._cache_dir, self.DISCOVERY_CACHE)
+        if not isinstance(discovery, dict) or \
+           discovery.get('pattern') != self.RE_TEST_SCRIPT_NAME.pattern:
+            discovery = {'pattern': self.RE_TEST_SCRIPT_NAME.pattern, 'contexts': {}}
+        return discovery
+
+    def _find_tests(self, test_dir, index=None):
+        """
+        Find recursively test scripts under the given path.
+        Directories whose mtime unchanged from `index` are not listed again,
+        while `index` is updated with ones listed.
+        """
+        if index is None:
+            index = {}
+        updated = False
+        scanned = {}
+        test_paths = []
+        pending = [test_dir]
+        while pending:
+            dir_path = pending.pop()
+            try:
+                mtime = os.stat(dir_path).st_mtime
+            except OSError:
+                continue
+            entry = index.get(dir_path)
+            if entry is None or entry[0] != mtime:
+                updated = True
+                filenames, subdirs = [], []
+                for name in sorted(os.listdir(dir_path)):
+                    path = os.sep.join((dir_path, name))
+                    if os.path.isdir(path):
+                        # Symbolic links not followed, as `os.walk`.
+                        if not os.path.islink(path):
+                            subdirs.append(name)
+                    elif self.RE_TEST_SCRIPT_NAME.search(name):
+                        filenames.append(name)
+                entry = [mtime, filenames, subdirs]
+            scanned[dir_path] = entry
+            for filename in entry[1]:
+                test_paths.append(os.sep.join((dir_path, filename)))
+            for subdir in reversed(entry[2]):
+                pending.append(os.sep.join((dir_path, subdir)))
+        if updated or len(scanned) != len(index):
+            index.clear()
+            index.update(scanned)
+            self._discovery_updated = True
+        return test_paths
+
+    def execute_all(self):
+        """Execute all tests found & return the `TestSummary`."""
+        self._start_reporting()
+        summary = TestSummary()
+        library_paths = self._library_paths
+        graphs = None
+        if self._affected is not None:
+            graphs = _load_cache(self._cache_dir, self.IMPORT_GRAPH_CACHE) or {}
+        shard_tests = None
+        if self._shard is not None:
+            shard_tests = set(self._select_shard())
+        if self._last_failed or self._failed_first:
+            self._failed = self._load_failures()
+            if self._last_failed and not self._failed:
+                logger.info('no failures recorded: execute all tests')
+        for context, tests in self._tests.items():
+            # Setup full extension paths set.
+            ext_paths = self._ext_paths[context] + library_paths
+            if shard_tests is not None:
+                tests = [test for test in tests if test in shard_tests]
+                if not tests:
+                    continue
+            if graphs is not None:
+                tests = self._select_affected(context, tests, ext_paths, graphs)
+                if not tests:
+                    continue
+            if self._failed:
+                tests = self._select_failed(tests)
+                if not tests:
+                    continue
+            summary.merge(self._execute_tests(tests, ext_paths))
+        if graphs is not None:
+            _save_cache(self._cache_dir, self.IMPORT_GRAPH_CACHE, graphs)
+        return self._finish(summary)
+
+    # Cache name of tests failed.
+    FAILURES_CACHE = 'lastfailed.json'
+
+    def _load_failures(self):
+        failed = _load_cache(self._cache_dir, self.FAILURES_CACHE)
+        return failed if isinstance(failed, dict) else {}
+
+    def _save_failures(self, summary):
+        """
+        Update the cache of tests failed formed:
+            {test file path: [test ids failed, or none if not known]}
+        """
+        if self._cache_dir is None:
+            return
+        failed = self._load_failures()
+        for testfile_path in summary.executed:
+            failed.pop(testfile_path, None)
+        unknown = False
+        for testfile_path, test_id in summary.failures:
+            if testfile_path is None:
+                logger.warning('test file of failure unknown: {}'.format(test_id))
+                unknown = True
+                continue
+            test_ids = failed.setdefault(testfile_path, [])
+            if test_id is not None and test_id not in test_ids:
+                test_ids.append(test_id)
+        if unknown:
+            # Not known where: all test files executed, as a whole.
+            for testfile_path in summary.executed:
+                failed[testfile_path] = []
+        _save_cache(self._cache_dir, self.FAILURES_CACHE, failed)
+
+    def _select_failed(self, tests):
+        """Select or reorder tests by failures in the last run."""
+        failed = [test for test in tests if test in self._failed]
+        if self._last_failed:
+            return failed
+        return failed + [test for test in tests if test not in self._failed]
+
+    def _select_shard(self):
+        """Select test files of the shard, out of all found."""
+        durations = None
+        if self._shard_durations is not None:
+            try:
+                with open(self._shard_durations, 'rb') as f:
+                    durations = json.loads(f.read().decode('utf-8'))
+            except (IOError, OSError, ValueError) as ex:
+                logger.error('failed to load durations: {}'.format(ex))
+        if not isinstance(durations, dict):
+            durations = {}
+        all_tests = []
+        for context in sorted(self._tests):
+            all_tests.extend(self._tests[context])
+        selected = _select_shard(all_tests, self._shard, durations.get('files'))
+        logger.info('shard {}/{}: {} of {} tests'.format(
+            self._shard[0], self._shard[1], len(selected), len(all_tests)))
+        return selected
+
+    # Cache name of import graphs.
+    IMPORT_GRAPH_CACHE = 'importgraph.json'
+
+    def _select_affected(self, context, tests, ext_paths, graphs):
+        """
+        Select tests importing (transitively) files changed, either
+        given or since the last run recorded in `graphs` (updated).
+        """
+        graph = ImportGraph(graphs.get(context))
+        graph.update(tests, ext_paths)
+        if self._affected:
+            changed = set(os.path.abspath(path) for path in self._affected)
+        else:
+            changed = graph.changed()
+            graph.record()
+        graphs[context] = graph.to_cache()
+        if changed is None:
+            logger.info('no run recorded for "{}": select all tests'.format(context))
+            return tests
+        affected = graph.dependents(changed)
+        selected = [test for test in tests if test in affected]
+        logger.info('{} of {} tests affected in "{}"'.format(
+            len(selected), len(tests), context))
+        return selected
+
+    def execute_by_path(self, testfile_path):
+        """Execute a specifiv test by given path & return the `TestSummary`."""
+        abs_testfile_path = os.path.abspath(testfile_path.replace('/', os.sep))
+        context = self._contexts.get(abs_testfile_path)
+        if context is None:
+            # If the path not found.
+            logger.error('test not found: "{}"'.format(abs_testfile_path))
+            summary = TestSummary()
+            summary.add_file_result(abs_testfile_path, 1)
+            return summary
+        # Setup full extension paths set.
+        ext_paths = self._ext_paths[context] + self._library_paths
+        self._start_reporting()
+        summary = self._execute_tests([abs_testfile_path], ext_paths)
+        return self._finish(summary)
+
+    def watch(self, interval=1.0, runs=None):
+        """
+        Execute tests, then poll mtimes of test files & files they import
+        (in test, `.testfor` & `.sitelibs` directories) every `interval`
+        seconds, & rerun tests changed or importing files changed.
+        Library modules imported by tests are kept loaded in this process,
+        & each run is forked from it if possible.
+        Return the exit code of the last run, after `runs` runs if given
+        or an interruption.
+        """
+        graphs = {}     # context => ImportGraph
+        returncode = 0
+        done = 0
+        try:
+            while runs is None or done < runs:
+                self._discover()
+                selection = []
+                changed = set()
+                for context, tests in self._tests.items():
+                    ext_paths = self._ext_paths[context] + self._library_paths
+                    graph = graphs.setdefault(context, ImportGraph())
+                    graph.update(tests, ext_paths)
+                    changed_here = graph.changed()
+                    graph.record()
+                    if changed_here is None:
+                        selected = tests
+                    else:
+                        affected = graph.dependents(changed_here)
+                        selected = [test for test in tests if test in affected]
+                        changed.update(affected)
+                    if selected:
+                        selection.append((context, selected, ext_paths))
+                if not selection:
+                    time.sleep(interval)
+                    continue
+                _unload_modules(changed)
+                for graph in graphs.values():
+                    self._warm_libraries(graph)
+                returncode = self._watched_run(selection, graphs)
+                done += 1
+                logger.info('watching changes (exit code of the last run: {})'.format(returncode))
+        except KeyboardInterrupt:
+            pass
+        return returncode
+
+    def _warm_libraries(self, graph):
+        """Import modules of library files in the import graph, not to reload them each run."""
+        module_names = set()
+        for path in graph.to_cache()['files']:
+            for library_path in self._library_paths:
+                module_name = _module_name_of(path, library_path)
+                if module_name is not None:
+                    module_names.add(module_name)
+                    break
+        module_names = sorted(name for name in module_names if name not in sys.modules)
+        if not module_names:
+            return
+        with PathEnvironment(ext_paths=list(self._library_paths)):
+            for module_name in module_names:
+                try:
+                    __import__(module_name)
+                except Exception as ex:
+                    logger.debug('library "{}" not warmed: {}'.format(module_name, ex))
+
+    def _watched_run(self, selection, graphs):
+        """Execute selected tests in a child forked if possible, else in this process."""
+        def run():
+            summary = TestSummary()
+            for context, tests, ext_paths in selection:
+                summary.merge(self._execute_tests(tests, ext_paths))
+            return self._finish(summary).exit_code
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if hasattr(os, 'fork'):
+            pid = os.fork()
+            if pid == 0:
+                returncode = 1
+                try:
+                    returncode = run()
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(returncode)
+            _, status = os.waitpid(pid, 0)
+            return _wait_status_to_returncode(status)
+        if hasattr(importlib_machinery, 'PathFinder'):
+            importlib_machinery.PathFinder.invalidate_caches()
+        try:
+            return run()
+        finally:
+            # Tests & their targets are imported again next run.
+            for graph in graphs.values():
+                _unload_modules(path for path in graph.to_cache()['files']
+                                if not any(_module_name_of(path, library_path)
+                                           for library_path in self._library_paths))
+
+    # Cache name of durations.
+    DURATIONS_CACHE = 'durations.json'
+
+    def _finish(self, summary):
+        """Report the summary & save durations."""
+        if self._reporting is not None:
+            self._reporting.close()
+            self._reporting = None
+        summary.add_duration('phases', 'discovery', self._discovery_time)
+        summary.report()
+        if self._durations:
+            summary.report_durations(self._durations)
+        if summary.resources:
+            summary.report_resources(self._durations or self.RESOURCES_REPORT_COUNT)
+        self._save_durations(summary)
+        self._save_failures(summary)
+        return summary
+
+    # Test files reported by their resources (without `durations`).
+    RESOURCES_REPORT_COUNT = 5
+
+    def _save_durations(self, summary):
+        """
+        Save durations of the run into `durations_file` if given, & into
+        the cache formed:
+            {'files': {test file path: seconds of the latest run},
+             'last_run': {'finished': time, 'phases': ..., 'files': ..., 'tests': ...,
+                          'resources': {test file path: resources} (if any)}}
+        """
+        last_run = {'finished': time.time()}
+        last_run.update(summary.durations)
+        if summary.resources:
+            last_run['resources'] = summary.resources
+        if self._durations_file is not None:
+            try:
+                _write_atomic(os.path.abspath(self._durations_file),
+                              json.dumps(last_run, indent=1, sort_keys=True).encode('utf-8'))
+            except (IOError, OSError) as ex:
+                logger.error('failed to write durations: {}'.format(ex))
+        if self._cache_dir is None:
+            return
+        cached = _load_cache(self._cache_dir, self.DURATIONS_CACHE)
+        files = cached.get('files', {}) if isinstance(cached, dict) else {}
+        files.update(summary.durations['files'])
+        _save_cache(self._cache_dir, self.DURATIONS_CACHE,
+                    {'files': files, 'last_run': last_run})
+
+    def _execute_tests(self, testfile_paths, ext_paths):
+        """
+        Execute tests in a context by the configured mode,
+        spreading test files over `jobs` workers.
+        """
+        summary = TestSummary()
+        if self._fork_worker and not self._suite_autoload:
+            self._preload_modules(ext_paths)
+        if self._jobs > 1 and len(testfile_paths) > 1:
+            for result in self._execute_parallel(testfile_paths, ext_paths):
+                summary.merge(result)
+        elif self._suite_autoload:
+            result = self._run_testsuites(
+                testfile_paths,
+                ext_paths=ext_paths,
+                verbosity=self._verbosity,
+            )
+            summary.merge(result)
+            while result.pending:
+                result = self._run_in_fresh_worker(result.pending, ext_paths)
+                summary.merge(result)
+        else:
+            # Iterate over tests.
+            for testfile_path in testfile_paths:
+                summary.merge(self._subprocess_test(
+                    testfile_path, ext_paths=ext_paths,
+                    append_main=self._append_main,
+                    verbosity=self._verbosity,
+                ))
+        return summary
+
+    def _execute_parallel(self, testfile_paths, ext_paths):
+        """
+        Yield `TestSummary` of each test file executed on the pool.
+        Subprocessing modes only need threads to wait for children,
+        while suite loading mode needs worker processes.
+        """
+        ext_paths = ExtPathSet(ext_paths, strict=False)
+        jobs = min(self._jobs, len(testfile_paths))
+        if self._suite_autoload and self._max_rss is not None:
+            for summary in self._execute_parallel_limited(testfile_paths, ext_paths, jobs):
+                yield summary
+            return
+        if self._suite_autoload:
+            pool = multiprocessing.Pool(jobs, _init_pool_worker, (self,))
+            tasks = [('_run_testsuites', ([testfile_path], ext_paths, self._verbosity), {})
+                     for testfile_path in testfile_paths]
+            job = _run_pool_job
+        else:
+            pool = multiprocessing.pool.ThreadPool(jobs)
+            tasks = testfile_paths
+            job = lambda testfile_path: self._subprocess_test(
+                testfile_path, ext_paths=ext_paths,
+                append_main=self._append_main,
+                verbosity=self._verbosity,
+            )
+        try:
+            for summary in pool.imap_unordered(job, tasks):
+                for method_name, args in summary.events:
+                    getattr(self._reporting, method_name)(*args)
+                summary.events = []
+                yield summary
+        finally:
+            pool.close()
+            pool.join()
+
+    def _execute_parallel_limited(self, testfile_paths, ext_paths, jobs):
+        """
+        Yield `TestSummary` of test files executed on `jobs` workers, each
+        taking test files from a queue until it grows over the RSS limit,
+        then replaced by a fresh one (see `_run_queued_testsuites`).
+        """
+        queue = multiprocessing.Queue()
+        for testfile_path in testfile_paths:
+            queue.put(testfile_path)
+        for _ in range(jobs):
+            queue.put(None)
+        # Workers exit after their task, run as long as they are not over the limit.
+        pool = multiprocessing.Pool(jobs, _init_pool_worker, (self, None, queue),
+                                    maxtasksperchild=1)
+        submit = lambda first: pool.apply_async(_run_pool_job, (
+            ('_run_queued_testsuites', (first, ext_paths, self._verbosity), {}),
+        ))
+        running = [submit(None) for _ in range(jobs)]
+        try:
+            while running:
+                finished = [task for task in running if task.ready()]
+                if not finished:
+                    running[0].wait(0.05)
+                    continue
+                for task in finished:
+                    running.remove(task)
+                    summary = task.get()
+                    if summary.pending:
+                        logger.info('RSS over the limit: replace a worker')
+                        running.append(submit(summary.pending[0]))
+                        summary.pending = []
+                    for method_name, args in summary.events:
+                        getattr(self._reporting, method_name)(*args)
+                    summary.events = []
+                    yield summary
+        finally:
+            pool.close()
+            pool.join()
+
+    def _run_queued_testsuites(self, first, ext_paths, verbosity):
+        """
+        Run test suites of test files from the queue of this pool worker
+        (starting with `first` if given) one by one, until the queue ends
+        or the worker grows over the RSS limit. The next test file left
+        to a fresh worker is returned in `pending` of the summary.
+        """
+        summary = TestSummary()
+        testfile_path = _pool_queue.get() if first is None else first
+        while testfile_path is not None:
+            result = self._run_testsuites([testfile_path], ext_paths, verbosity)
+            summary.merge(result)
+            summary.events.extend(result.events)
+            testfile_path = _pool_queue.get()
+            if testfile_path is not None and _rss_exceeded(self._max_rss):
+                summary.pending = [testfile_path]
+                break
+        return summary
+
+    def _run_in_fresh_worker(self, testfile_paths, ext_paths):
+        """
+        Run test suites of the test files in a new interpreter (forked one
+        shares the memory grown), returning the `TestSummary`.
+        """
+        ext_paths = ExtPathSet(ext_paths, strict=False)
+        get_context = getattr(multiprocessing, 'get_context', None)
+        if get_context is None:
+            logger.warning('spawning workers not available: run tests in this process')
+            return self._run_testsuites(testfile_paths, ext_paths, self._verbosity)
+        logger.info('spawn a worker for {} test files'.format(len(testfile_paths)))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pool = get_context('spawn').Pool(1, _init_pool_worker, (self, logger.level))
+        try:
+            summary = pool.apply(_run_pool_job, (
+                ('_run_testsuites', (testfile_paths, ext_paths, self._verbosity), {}),
+            ))
+        finally:
+            pool.close()
+            pool.join()
+        for method_name, args in summary.events:
+            getattr(self._reporting, method_name)(*args)
+        summary.events = []
+        return summary
+
+    def _preload_modules(self, ext_paths):
+        """
+        Import modules to preload once, to be shared with forked workers.
+        """
+        if self._preloaded:
+            return
+        self._preloaded = True
+        if not self._preload:
+            return
+        with PathEnvironment(ext_paths=ext_paths):
+            for module_name in self._preload:
+                logger.info('preload module: "{}"'.format(module_name))
+                try:
+                    __import__(module_name)
+                except ImportError as ex:
+                    logger.error('failed to preload "{}": {}'.format(module_name, ex))
+
+    def _subprocess_test(self, testfile_path, ext_paths=tuple(),
+                         append_main=False, verbosity=1):
+        """Execute test script in a child process by the configured way."""
+        if self._fork_worker:
+            return self._fork_test(testfile_path, ext_paths=ext_paths,
+                                   append_main=append_main, verbosity=verbosity)
+        return self._execute_test(testfile_path, ext_paths=ext_paths,
+                                  append_main=append_main, verbosity=verbosity)
+
+    def _fork_test(self, testfile_path, ext_paths=tuple(),
+                   append_main=False, verbosity=1):
+        """
+        Execute test script in a child forked from this process,
+        sharing the imported & preloaded modules by copy-on-write.
+        """
+        logger.info('will execute test: "{}"'.format(testfile_path))
+        ext_paths = ExtPathSet(ext_paths, strict=False)  # accept iterator, etc.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        group = self._timeout is not None or self._test_timeout is not None
+        started = _timer()
+        _event_pipe_lock.acquire()
+        try:
+            pipe = os.pipe() if self._reporting is not None else None
+            pid = os.fork()
+            if pid == 0:
+                _event_pipe_lock.release()
+                self._run_forked(testfile_path, ext_paths, append_main, verbosity,
+                                 pipe, group)
+            if pipe is not None:
+                os.close(pipe[1])
+        finally:
+            _event_pipe_lock.release()
+        if group:
+            try:
+                os.setpgid(pid, pid)    # not to kill ours before the child does
+            except OSError:
+                pass
+        watch = _ChildWatch(pid, self._timeout, group=group)
+        try:
+            if pipe is not None:
+                self._read_events(pipe[0], testfile_path)
+            returncode, resources = watch.wait()
+        except KeyboardInterrupt:
+            watch.kill()
+            raise
+        return self._file_summary(testfile_path, returncode, _timer() - started,
+                                  resources, watch.timed_out)
+
+    def _run_forked(self, testfile_path, ext_paths, append_main, verbosity, pipe, group):
+        """Run the test script in the child forked by `_fork_test`, & exit."""
+        returncode = 1
+        try:
+            if group:
+                os.setpgid(0, 0)
+            if pipe is not None:
+                os.close(pipe[0])
+                os.environ.update(self._events_env(pipe[1]))
+            if self._test_timeout is not None:
+                os.environ[TEST_TIMEOUT_ENV] = repr(float(self._test_timeout))
+            returncode = _run_test_script(testfile_path, ext_paths=ext_paths,
+                                          append_main=append_main,
+                                          verbosity=verbosity,
+                                          cache_dir=self._cache_dir,
+                                          single_exec=self._single_exec)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(returncode)
+
+    def _file_summary(self, testfile_path, returncode, duration,
+                      resources=None, timed_out=False):
+        """`TestSummary` of a test file executed as a whole, reported."""
+        if timed_out:
+            logger.error('timed out after {}s: "{}"'.format(self._timeout, testfile_path))
+        if self._reporting is not None:
+            self._reporting.end_file(testfile_path, returncode, duration)
+        summary = TestSummary()
+        summary.add_file_result(testfile_path, returncode, duration=duration)
+        if resources:
+            summary.resources[testfile_path] = resources
+        if timed_out:
+            summary.timeouts.append(testfile_path)
+        return summary
+
+    def _events_env(self, write_fd):
+        """Environment variables for children to emit test events."""
+        env = {EVENTS_FD_ENV: str(write_fd)}
+        if self._reporting.quiet:
+            env[EVENTS_QUIET_ENV] = '1'
+        return env
+
+    def _read_events(self, read_fd, testfile_path):
+        """Report test events from the pipe until all the writers close it."""
+        with os.fdopen(read_fd, 'rb') as pipe:
+            for line in pipe:
+                try:
+                    event = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                self._reporting.event(testfile_path, event)
+
+    def _call_test(self, command, testfile_path):
+        """
+        Call the command of a test script (with a pipe to emit test events
+        into if reporting), & return (exit status, resources, timed out).
+        """
+        env = dict(os.environ)
+        kwargs = {'env': env}
+        read_fd = write_fd = None
+        if self._test_timeout is not None:
+            env[TEST_TIMEOUT_ENV] = repr(float(self._test_timeout))
+        group = (self._timeout is not None or self._test_timeout is not None) and \
+                os.name == 'posix'
+        if group:
+            # Lead a process group, to be killed with its children.
+            if sys.version_info >= (3, 2):
+                kwargs['start_new_session'] = True
+            else:
+                kwargs['preexec_fn'] = os.setsid
+        with _event_pipe_lock:
+            if self._reporting is not None and EVENT_PIPES_SUPPORTED:
+                read_fd, write_fd = os.pipe()
+                env.update(self._events_env(write_fd))
+                if sys.version_info >= (3, 2):
+                    kwargs['pass_fds'] = (write_fd,)
+                else:
+                    kwargs['close_fds'] = False
+            try:
+                process = subprocess.Popen(command, **kwargs)
+            except:
+                if read_fd is not None:
+                    os.close(read_fd)
+                raise
+            finally:
+                if write_fd is not None:
+                    os.close(write_fd)
+        watch = _ChildWatch(process.pid, self._timeout, process, group=group)
+        try:
+            if read_fd is not None:
+                self._read_events(read_fd, testfile_path)
+            returncode, resources = watch.wait()
+        except KeyboardInterrupt:
+            watch.kill()
+            raise
+        return returncode, resources, watch.timed_out
+
+    def _escape_path(self, path):
+        """Path separator escaping in Windows."""
+        return path.replace('\\', '\\\\')
+
+    def _execute_test(self, testfile_path, ext_paths=tuple(),
+                      append_main=False, verbosity=1):
+        """
+        Execute test script, with invoking executable
+        & given paths extension by subprocessing.
+        """
+        logger.info('will execute test: "{}"'.format(testfile_path))
+        ext_paths = ExtPathSet(ext_paths, strict=False)  # accept iterator, etc.
+        # `_escape_path` only applied to  `testfile_path`:
+        #     Built-in `open` never accepts unescaped special characters,
+        #     while a sequence of `list.__repr__` -> `str.format` does.
+        proxy = TestProxy(self._escape_path(testfile_path),
+                          ext_paths=ext_paths,
+                          append_main=append_main,
+                          verbosity=verbosity,
+                          cache_dir=self._cache_dir,
+                          single_exec=self._single_exec)
+        command = proxy.command() if self._inline_proxy else None
+        started = _timer()
+        if command is not None:
+            returncode, resources, timed_out = self._call_test(command, testfile_path)
+        else:
+            with proxy as proxy_filename:
+                returncode, resources, timed_out = self._call_test(
+                    [sys.executable, proxy_filename], testfile_path)
+        return self._file_summary(testfile_path, returncode, _timer() - started,
+                                  resources, timed_out)
+
+    def _run_testsuites(self, testfile_paths, ext_paths=tuple(), verbosity=1):
+        """
+        Execute tests, by aggregating test suites from target scripts,
+        & running with given paths extension. In streaming mode, test
+        files left by the RSS limit are returned in `pending` of the summary.
+        """
         import unittest
-        loader = unittest.TestLoader()
-        ext_paths = [path for path in ext_paths]  # accept iterator, etc.
-        with PathEnvironment(ext_paths=ext_paths) as env:
-            suites = []
+        ext_paths = ExtPathSet(ext_paths, strict=False)  # accept iterator, etc.
+        summary = TestSummary()
+        test_files = {}     # test id => test file path
+        module_loader = _TestModuleLoader(testfile_paths, self._contexts)
+        with PathEnvironment(ext_paths=ext_paths):
+            load = lambda testfile_path: self._load_testsuite(
+                testfile_path, module_loader, ext_paths, summary, test_files)
+            if self._streaming:
+                aggregated = _get_streaming_suite_class()(testfile_paths, load, self._max_rss)
+            else:
+                suites = [load(testfile_path) for testfile_path in testfile_paths]
+                if self._threads > 1 and not self._isolate:
+                    aggregated = _get_threaded_suite_class()(suites, self._threads)
+                else:
+                    aggregated = unittest.TestSuite(suites)
+            reporting = self._reporting
+            runner_kwargs = {'resultclass': _get_timing_result_class()}
+            if reporting is not None:
+                emit = lambda event: reporting.event(_test_file_of(event['test'], test_files),
+                                                     event)
+                runner_kwargs['resultclass'] = _event_result_class_for(emit, reporting.quiet)
+                if reporting.quiet:
+                    runner_kwargs['stream'] = _NullStream()
+            started = _timer()
+            result = unittest.TextTestRunner(verbosity=verbosity, **runner_kwargs).run(aggregated)
+            summary.add_duration('phases', 'run', _timer() - started)
+        if self._streaming:
+            summary.pending = aggregated.pending
+            testfile_paths = testfile_paths[:len(testfile_paths) - len(summary.pending)]
+        summary.add_unittest_result(result, testfile_paths, test_files)
+        for test_id, seconds in result.durations.items():
+            summary.add_duration('tests', test_id, seconds)
+            if test_id in test_files:
+                summary.add_duration('files', test_files[test_id], seconds)
+        if reporting is not None:
+            failed_files = set(path for path, _ in summary.failures)
             for testfile_path in testfile_paths:
-                logger.info('load test suites from: "{}"'.format(testfile_path))
-                test_module = _get_module_from_path(testfile_path, env)
-                suites.append(loader.loadTestsFromModule(test_module))
-            aggregated = unittest.TestSuite(suites)
-            unittest.TextTestRunner(verbosity=verbosity).run(aggregated)
+                reporting.end_file(testfile_path, 1 if testfile_path in failed_files else 0,
+                                   summary.durations['files'].get(testfile_path))
+            if isinstance(reporting, _EventCollector):
+                summary.events, reporting.events = reporting.events, []
+        return summary
+
+    def _load_testsuite(self, testfile_path, module_loader, ext_paths, summary, test_files):
+        """
+        Load the test suite of a test file, recording the import time into
+        `summary` & its test ids into `test_files`. In isolate & streaming
+        modes, its modules are loaded in isolation.
+        """
+        import unittest
+        loader = unittest.TestLoader()
+        logger.info('load test suites from: "{}"'.format(testfile_path))
+        started = _timer()
+        isolate = self._isolate or self._streaming
+        if isolate:
+            # Modules from the test directory & test targets, not libraries.
+            isolation = PathEnvironment(
+                [os.path.dirname(testfile_path)] +
+                [path for path in ext_paths if path not in self._library_paths],
+                isolate=True,
+            )
+            with isolation:
+                test_module = module_loader.load(testfile_path)
+                suite = loader.loadTestsFromModule(test_module)
+        else:
+            test_module = module_loader.load(testfile_path)
+            suite = loader.loadTestsFromModule(test_module)
+        del test_module
+        failed_ids = self._failed.get(testfile_path) if self._last_failed else None
+        if failed_ids:
+            # Only tests failed in the last run (or in classes/modules of fixtures failed).
+            scopes = [_failure_scope(test_id) for test_id in failed_ids]
+            suite = unittest.TestSuite([test for test in _iter_tests(suite)
+                                        if any(_in_scope(test.id(), scope) for scope in scopes)])
+        if isolate:
+            if self._threads > 1:
+                # Threads only within a test file, while its modules are in.
+                suite = _get_threaded_suite_class()(suite, self._threads)
+            suite = _get_isolated_suite_class()(suite, isolation.unloaded)
+        elapsed = _timer() - started
+        summary.add_duration('phases', 'import', elapsed)
+        summary.add_duration('files', testfile_path, elapsed)
+        for test in _iter_tests(suite):
+            test_files[test.id()] = testfile_path
+        return suite
 
     @property
     def ext_paths(self):
         """Not to modify manually this property."""
-        return functools.reduce(operator.add,
-                                [list(dirs) for dirs in self._ext_paths.values()]) \
-               + self._library_paths
+        return functools.reduce(operator.add, self._ext_paths.values(),
+                                ExtPathSet()) + self._library_paths
 
     @staticmethod
     def autoexec_optarrange(options):
@@ -449,6 +3403,21 @@ class TestRunner(object):
                 'test.appendmain': ('append_main', state_to_boolean),
                 'test.autoexec': ('suite_autoload', state_to_boolean),
                 'test.verbosity': ('verbosity', int),
+                'test.jobs': ('jobs', int),
+                'test.forkworker': ('fork_worker', state_to_boolean),
+                'test.preload': ('preload', semicolon_to_list),
+                'test.cachedir': ('cache_dir', to_abspath),
+                'test.singleexec': ('single_exec', state_to_boolean),
+                'test.inlineproxy': ('inline_proxy', state_to_boolean),
+                'test.durations': ('durations', int),
+                'test.durationsfile': ('durations_file', to_abspath),
+                'test.isolate': ('isolate', state_to_boolean),
+                'test.threads': ('threads', int),
+                'test.reporters': ('reporters', semicolon_to_list),
+                'test.streaming': ('streaming', state_to_boolean),
+                'test.maxrss': ('max_rss', int),
+                'test.timeout': ('timeout', float),
+                'test.testtimeout': ('test_timeout', float),
             },
             post_processors=[
                 TestRunner.autoexec_optarrange,
@@ -458,6 +3427,477 @@ class ConfiguredTestRunner(TestRunner):
     pass
 
 
+# Socket of the fork server, in the cache directory.
+SERVER_SOCKET = 'server.sock'
+
+# Fork servers need file descriptors passed over Unix domain sockets.
+FORK_SERVER_SUPPORTED = hasattr(socket, 'AF_UNIX') and hasattr(socket.socket, 'sendmsg') and \
+                        hasattr(os, 'fork') and hasattr(os, 'set_blocking')
+
+def _server_socket_path(cache_dir=CACHE_DIR):
+    return os.path.abspath(os.sep.join((cache_dir, SERVER_SOCKET)))
+
+def _send_message(conn, message, fds=()):
+    """Send a JSON line, with file descriptors if given."""
+    data = (json.dumps(message) + '\n').encode('utf-8')
+    if fds:
+        ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds).tobytes())]
+        sent = conn.sendmsg([data], ancdata)
+        data = data[sent:]
+    conn.sendall(data)
+
+def _recv_chunk(conn, fds, max_fds=0):
+    """Receive bytes (empty at EOF), & file descriptors passed with them into `fds`."""
+    if not max_fds:
+        return conn.recv(4096)
+    chunk, ancdata, _, _ = conn.recvmsg(
+        4096, socket.CMSG_LEN(max_fds * array.array('i').itemsize))
+    for level, kind, fd_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fd_array = array.array('i')
+            fd_array.frombytes(fd_data[:len(fd_data) - len(fd_data) % fd_array.itemsize])
+            fds.extend(fd_array)
+    return chunk
+
+def _recv_message(conn, buffered, max_fds=0):
+    """
+    Receive a JSON line (or None at EOF) & file descriptors passed with
+    it, continuing from & updating `buffered` (a list of the bytes read).
+    """
+    fds = []
+    data = buffered[0]
+    while b'\n' not in data:
+        chunk = _recv_chunk(conn, fds, max_fds)
+        if not chunk:
+            buffered[0] = b''
+            return None, fds
+        data += chunk
+    line, _, buffered[0] = data.partition(b'\n')
+    return json.loads(line.decode('utf-8')), fds
+
+
+def _peer_uid(conn):
+    """User id of the process connected to the Unix domain socket, or None if unknown."""
+    option = getattr(socket, 'SO_PEERCRED', None)
+    if option is None:
+        return None
+    try:
+        credentials = conn.getsockopt(socket.SOL_SOCKET, option, struct.calcsize('3i'))
+    except socket.error:
+        return None
+    _, uid, _ = struct.unpack('3i', credentials)
+    return uid
+
+
+class ForkServer(object):
+    """
+    Server on a Unix domain socket, keeping a library environment entered
+    & modules preloaded, to run `exec`/`shell` requests in children forked
+    from it. Each child gets stdio (passed as file descriptors), argv, cwd
+    & environment variables of the client, whose exit status is returned.
+    The server executes itself again by `reload_argv` (when no child is
+    running) if any rc file or source file of modules loaded from the
+    library paths changed; the others are imported by children anyway.
+    Requests & responses are JSON lines:
+        {'action': 'exec', 'target', 'argv', 'cwd', 'env', 'cache_dir', 'single_exec'}
+        {'action': 'shell', 'argv', 'cwd', 'env'}
+        {'action': 'stop'}
+        => {'returncode': exit status}
+        or {'unavailable': reason} (while reloading or stopping, for
+           clients to run the request by themselves)
+    while clients may send {'signal': number} to the child meanwhile.
+    Requests are read as they arrive, not to wait for one client.
+    """
+
+    # Seconds between checks of changes.
+    POLL_INTERVAL = 1.0
+
+    # Seconds to wait for requests of clients connected.
+    REQUEST_TIMEOUT = 5.0
+
+    def __init__(self, socket_path, lib_env, preload=tuple(),
+                 config_path='./.ipyenvrc', reload_argv=None):
+        if not FORK_SERVER_SUPPORTED:
+            raise RuntimeError('fork server not supported on this platform')
+        self._socket_path = os.path.abspath(socket_path)
+        self._lib_env = lib_env
+        self._preload = list(preload)
+        self._config_path = os.path.abspath(config_path)
+        self._reload_argv = reload_argv
+        self._children = {}     # pid => client connection
+        self._pending = {}      # client connection => [bytes read, fds passed, time connected]
+        self._stopping = False
+        self._changed = False
+
+    def _rc_files(self):
+        rc_files = [self._config_path]
+        for sitelib_dir, _ in self._lib_env._sitelib_groups:
+            rc_files.append(os.sep.join((sitelib_dir, '.sitelibs')))
+            rc_files.append(os.sep.join((sitelib_dir, LibraryEnvironment.INDEX_LOCK)))
+        return rc_files
+
+    def _watched_stamps(self):
+        """Stamps of rc files & sources of modules loaded from the library paths."""
+        paths = set(self._rc_files())
+        dir_paths = [os.path.join(os.path.abspath(path), '') for path in self._lib_env.ext_paths]
+        for module in list(sys.modules.values()):
+            module_file = getattr(module, '__file__', None)
+            if module_file and _module_in_paths(module, dir_paths):
+                if module_file.endswith(('.pyc', '.pyo')):
+                    module_file = module_file[:-1]
+                paths.add(os.path.abspath(module_file))
+        return dict((path, _file_stamp(path)) for path in paths)
+
+    def serve_forever(self):
+        """Serve until stopped, or execute the server again on changes."""
+        with self._lib_env as env:
+            self._env = env
+            for module_name in self._preload:
+                logger.info('preload module: "{}"'.format(module_name))
+                try:
+                    __import__(module_name)
+                except ImportError as ex:
+                    logger.error('failed to preload "{}": {}'.format(module_name, ex))
+            stamps = self._watched_stamps()
+            self._listener = listener = self._listen()
+            # Woken up by children exited.
+            self._wakeup = os.pipe()
+            os.set_blocking(self._wakeup[1], False)
+            orig_handler = signal.signal(signal.SIGCHLD, self._wake_up)
+            try:
+                changed = self._loop(listener, stamps)
+            finally:
+                self._refuse_all(listener)
+                signal.signal(signal.SIGCHLD, orig_handler)
+                for fd in self._wakeup:
+                    os.close(fd)
+                listener.close()
+                if os.path.exists(self._socket_path):
+                    os.unlink(self._socket_path)
+        if changed and self._reload_argv is not None:
+            logger.info('files changed: reload the server')
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.execv(sys.executable, [sys.executable] + list(self._reload_argv))
+
+    def _listen(self):
+        dir_path = os.path.dirname(self._socket_path)
+        if not os.path.isdir(dir_path):
+            # Only for the user, who can run anything in the server.
+            os.makedirs(dir_path, 0o700)
+        if os.path.exists(self._socket_path):
+            # Left by a server not running any more.
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self._socket_path)
+            except socket.error:
+                os.unlink(self._socket_path)
+            else:
+                raise RuntimeError('server already running on "{}"'.format(self._socket_path))
+            finally:
+                probe.close()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            listener.bind(self._socket_path)
+        finally:
+            os.umask(umask)
+        os.chmod(self._socket_path, 0o600)
+        listener.listen(16)
+        logger.info('serve on "{}"'.format(self._socket_path))
+        return listener
+
+    def _loop(self, listener, stamps):
+        """Serve requests, & return whether stopped by changes."""
+        buffers = {}    # client connection => [bytes read]
+        last_checked = _timer()
+        while True:
+            self._reap()
+            self._expire_pending()
+            if self._stopping and not self._children:
+                return False
+            if self._changed and not self._children:
+                return True
+            if not (self._changed or self._stopping) and \
+               _timer() - last_checked >= self.POLL_INTERVAL:
+                last_checked = _timer()
+                self._changed = self._watched_stamps() != stamps
+            connections = [conn for conn in self._children.values() if conn is not None]
+            try:
+                readable = select.select([self._wakeup[0], listener] + list(self._pending) +
+                                         connections, [], [], self.POLL_INTERVAL)[0]
+            except (select.error, OSError, IOError):
+                continue
+            for conn in readable:
+                if conn == self._wakeup[0]:
+                    os.read(conn, 4096)
+                    continue
+                if conn is listener:
+                    self._accept(listener)
+                    continue
+                if conn in self._pending:
+                    self._read_request(conn)
+                    continue
+                # Signals from clients.
+                pid = [pid for pid, child_conn in self._children.items() if child_conn is conn][0]
+                try:
+                    message, _ = _recv_message(conn, buffers.setdefault(conn, [b'']))
+                except (socket.error, ValueError):
+                    message = None
+                if message is None:
+                    # Client gone.
+                    self._kill(pid, signal.SIGTERM)
+                    self._children[pid] = None
+                    buffers.pop(conn, None)
+                    conn.close()
+                elif 'signal' in message:
+                    self._kill(pid, int(message['signal']))
+
+    def _wake_up(self, *args):
+        try:
+            os.write(self._wakeup[1], b'.')
+        except OSError:
+            pass    # already woken up
+
+    def _kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+    def _accept(self, listener):
+        try:
+            conn, _ = listener.accept()
+        except socket.error as ex:
+            logger.error('failed to accept: {}'.format(ex))
+            return
+        uid = _peer_uid(conn)
+        if uid is not None and uid != os.getuid():
+            logger.error('refuse a client of another user: {}'.format(uid))
+            conn.close()
+            return
+        self._pending[conn] = [b'', [], _timer()]
+
+    def _read_request(self, conn):
+        """Read the request of a client as much as arrived, & serve it if all read."""
+        entry = self._pending[conn]
+        try:
+            chunk = _recv_chunk(conn, entry[1], max_fds=3)
+        except socket.error as ex:
+            logger.error('failed to read the request: {}'.format(ex))
+            chunk = b''
+        if not chunk:
+            self._drop_pending(conn)
+            return
+        entry[0] += chunk
+        if b'\n' not in entry[0]:
+            return
+        del self._pending[conn]
+        data, fds = entry[0], entry[1]
+        try:
+            request = json.loads(data.partition(b'\n')[0].decode('utf-8'))
+        except ValueError:
+            request = None
+        self._serve(conn, request, fds)
+
+    def _drop_pending(self, conn):
+        _, fds, _ = self._pending.pop(conn)
+        for fd in fds:
+            os.close(fd)
+        conn.close()
+
+    def _expire_pending(self):
+        for conn, (_, _, connected) in list(self._pending.items()):
+            if _timer() - connected > self.REQUEST_TIMEOUT:
+                logger.error('no request from the client in {}s'.format(self.REQUEST_TIMEOUT))
+                self._drop_pending(conn)
+
+    def _refuse(self, conn, data=b''):
+        """Let the client run the request by itself, after the request read."""
+        fds = []
+        try:
+            if b'\n' not in data:
+                # Unread data would reset the connection, losing the response.
+                conn.settimeout(1.0)
+                _, fds = _recv_message(conn, [data], max_fds=3)
+            reason = 'stopping' if self._stopping else 'reloading'
+            _send_message(conn, {'unavailable': reason})
+        except (socket.error, ValueError):
+            pass
+        finally:
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+
+    def _refuse_all(self, listener):
+        """Refuse clients connected (or waiting to be accepted) on exit."""
+        for conn in list(self._pending):
+            data, fds, _ = self._pending.pop(conn)
+            for fd in fds:
+                os.close(fd)
+            self._refuse(conn, data)
+        listener.setblocking(False)
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except socket.error:
+                break
+            conn.setblocking(True)
+            self._refuse(conn)
+
+    def _serve(self, conn, request, fds):
+        try:
+            if request is None:
+                raise ValueError('empty request')
+            if request.get('action') == 'stop':
+                logger.info('stop the server')
+                self._stopping = True
+                _send_message(conn, {'returncode': 0})
+                conn.close()
+                return
+            if self._stopping or self._changed:
+                logger.debug('refuse: {} in "{}"'.format(request.get('action'),
+                                                         request.get('cwd')))
+                self._refuse(conn, b'\n')
+                return
+            if request.get('action') not in ('exec', 'shell') or len(fds) != 3:
+                raise ValueError('invalid request')
+            logger.debug('request: {} in "{}"'.format(request['action'], request.get('cwd')))
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                self._run_child(request, fds, conn)
+            self._children[pid] = conn
+        except (socket.error, ValueError, KeyError) as ex:
+            logger.error('failed to serve: {}'.format(ex))
+            conn.close()
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def _reap(self):
+        """Send exit status of children exited to their clients."""
+        for pid in list(self._children):
+            try:
+                exited, status = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                exited, status = pid, 255 << 8
+            if exited == 0:
+                continue
+            conn = self._children.pop(pid)
+            if conn is None:
+                continue
+            try:
+                _send_message(conn, {'returncode': _wait_status_to_returncode(status)})
+            except socket.error:
+                pass
+            conn.close()
+
+    def _run_child(self, request, fds, conn):
+        """Run the request in the forked child, with stdio of the client."""
+        returncode = 1
+        try:
+            for fd, std_fd in zip(fds, (0, 1, 2)):
+                os.dup2(fd, std_fd)
+            # Only the server talks with clients.
+            for other_conn in ([self._listener, conn] + list(self._children.values()) +
+                               list(self._pending)):
+                if other_conn is not None:
+                    other_conn.close()
+            # Nor holds stdio of the other clients.
+            for _, other_fds, _ in self._pending.values():
+                for fd in other_fds:
+                    os.close(fd)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            for fd in self._wakeup:
+                os.close(fd)
+            sys.stdin = io.open(0, 'r', closefd=False)
+            sys.stdout = io.open(1, 'w', buffering=1, closefd=False)
+            sys.stderr = io.open(2, 'w', buffering=1, closefd=False)
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            os.environ.update(request['env'])
+            sys.argv = list(request['argv'])
+            try:
+                if request['action'] == 'exec':
+                    _execute_file(request['target'], self._env,
+                                  cache_dir=request.get('cache_dir'),
+                                  single_exec=request.get('single_exec', True),
+                                  keep_main=True)
+                else:
+                    import code
+                    try:
+                        code.InteractiveConsole().interact('(ipyenv interactive shell)')
+                    except SystemExit:
+                        print('(Terminate ipyenv shell)')
+                returncode = 0
+            except SystemExit as ex:
+                returncode = _exit_code_of(ex)
+            except:
+                traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(returncode)
+
+    def stop(self, *args):
+        """Stop serving after the running children exit (as a signal handler too)."""
+        self._stopping = True
+
+
+def _request_server(socket_path, request):
+    """
+    Send the request with the stdio of this process to the fork server,
+    & return the exit status, or None if the server is not available.
+    """
+    if not FORK_SERVER_SUPPORTED:
+        logger.warning('fork server not supported on this platform')
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except socket.error as ex:
+        logger.info('fork server not available on "{}": {}'.format(socket_path, ex))
+        conn.close()
+        return None
+    sys.stdout.flush()
+    sys.stderr.flush()
+    buffered = [b'']
+    try:
+        fds = () if request.get('action') == 'stop' else (0, 1, 2)
+        try:
+            _send_message(conn, request, fds)
+        except socket.error as ex:
+            # Not received: never run by the server.
+            logger.info('fork server not available on "{}": {}'.format(socket_path, ex))
+            return None
+        while True:
+            try:
+                response, _ = _recv_message(conn, buffered)
+                break
+            except KeyboardInterrupt:
+                # Not given to the child in another process group.
+                _send_message(conn, {'signal': int(signal.SIGINT)})
+    except socket.error as ex:
+        logger.error('fork server failed: {}'.format(ex))
+        return 1
+    finally:
+        conn.close()
+    if response is None:
+        logger.error('fork server closed the connection')
+        return 1
+    if 'unavailable' in response:
+        logger.info('fork server not available on "{}": {}'.format(
+            socket_path, response['unavailable']))
+        return None
+    return response['returncode']
+
+
 def shell():
     """Make an interactive shell with given extension paths."""
     # CLI configs.
@@ -467,15 +3907,43 @@ def shell():
     parser.add_argument('shell') # ignore this.
     parser.add_argument('-l', '--libext', help='Library extension paths', nargs='*')
     parser.add_argument('-e', '--encoding', help='.sitelibs file encoding')
+    parser.add_argument('--indexed', action='store_true', default=False,
+                        help='import top-level modules/packages via the index of library paths')
+    parser.add_argument('--lockindex', action='store_true', default=False,
+                        help='save the index of library paths into .sitelibs.lock (implies --indexed)')
+    parser.add_argument('--lazy', action='store_true', default=False,
+                        help='put library paths on sys.path only when they provide modules imported')
+    parser.add_argument('--cachedir', default=CACHE_DIR,
+                        help='directory to cache the resolved configuration in')
+    parser.add_argument('--nocache', action='store_true', default=False,
+                        help='neither use nor save the configuration cache')
+    parser.add_argument('--server', action='store_true', default=False,
+                        help='run the shell in a child of the fork server (see the server action) if running')
+    parser.add_argument('--socket', default=_server_socket_path(),
+                        help='Unix domain socket path of the fork server')
     args = parser.parse_args()
+    if args.server:
+        returncode = _request_server(args.socket, {
+            'action': 'shell', 'argv': [''], 'cwd': os.getcwd(), 'env': dict(os.environ),
+        })
+        if returncode is not None:
+            return returncode
     # Invoke a shell.
     kwargs = {}
     if args.libext:
         kwargs['sitelib_paths'] = args.libext
     if args.encoding:
         kwargs['rcfile_encoding'] = args.encoding
+    if args.indexed or args.lockindex:
+        kwargs['indexed'] = True
+    if args.lazy:
+        kwargs['lazy'] = True
     import code
-    with ConfiguredLibraryEnvironment(**kwargs):
+    ProjectConfig.get(None if args.nocache else args.cachedir)
+    lib_env = ConfiguredLibraryEnvironment(**kwargs)
+    if args.lockindex and lib_env.finder is not None:
+        lib_env.save_index()
+    with lib_env:
         ic = code.InteractiveConsole()
         try:
             ic.interact('(ipyenv interactive shell)')
@@ -492,20 +3960,59 @@ def execute():
     parser.add_argument('target_script')
     parser.add_argument('-l', '--libext', help='Library extension paths', nargs='*')
     parser.add_argument('-e', '--encoding', help='rcfile encoding')
+    parser.add_argument('--indexed', action='store_true', default=False,
+                        help='import top-level modules/packages via the index of library paths')
+    parser.add_argument('--lockindex', action='store_true', default=False,
+                        help='save the index of library paths into .sitelibs.lock (implies --indexed)')
+    parser.add_argument('--lazy', action='store_true', default=False,
+                        help='put library paths on sys.path only when they provide modules imported')
+    parser.add_argument('--cachedir', default=CACHE_DIR,
+                        help='directory to cache compiled code of the target in')
+    parser.add_argument('--nocache', action='store_true', default=False,
+                        help='neither use nor save compiled code caches')
+    parser.add_argument('--exectwice', action='store_true', default=False,
+                        help='preload the target as module & exec again as __main__ '
+                             '(instead of exec once as __main__)')
+    parser.add_argument('--server', action='store_true', default=False,
+                        help='execute the target in a child of the fork server (see the server action) if running')
+    parser.add_argument('--socket', default=_server_socket_path(),
+                        help='Unix domain socket path of the fork server')
     args = parser.parse_args()
     target = args.target_script
     if not os.path.exists(target):
         logger.error('target script not found: "{}"'.format(target))
         return
+    if args.server:
+        returncode = _request_server(args.socket, {
+            'action': 'exec',
+            'target': os.path.abspath(target),
+            'argv': [target.split(os.sep)[-1]],
+            'cwd': os.getcwd(),
+            'env': dict(os.environ),
+            'cache_dir': None if args.nocache else os.path.abspath(args.cachedir),
+            'single_exec': not args.exectwice,
+        })
+        if returncode is not None:
+            return returncode
     # Execute target.
     kwargs = {}
     if args.libext:
         kwargs['sitelib_paths'] = args.libext
     if args.encoding:
         kwargs['rcfile_encoding'] = args.encoding
-    with ConfiguredLibraryEnvironment(**kwargs) as env:
+    if args.indexed or args.lockindex:
+        kwargs['indexed'] = True
+    if args.lazy:
+        kwargs['lazy'] = True
+    cache_dir = None if args.nocache else args.cachedir
+    ProjectConfig.get(cache_dir)
+    lib_env = ConfiguredLibraryEnvironment(**kwargs)
+    if args.lockindex and lib_env.finder is not None:
+        lib_env.save_index()
+    with lib_env as env:
         sys.argv = [target.split(os.sep)[-1]]
-        _execute_file(target, env)
+        _execute_file(target, env, cache_dir=cache_dir,
+                      single_exec=not args.exectwice, keep_main=True)
 
 def test():
     """Execute tests with given extension paths."""
@@ -520,11 +4027,60 @@ def test():
     parser.add_argument('-e', '--encoding', help='rcfile encoding')
     parser.add_argument('--appendmain', action='store_true', default=False,
                         help='auto-exec tests by appending command-line interfaces to test scripts '
-                             '(exec twice if originally provided)')
+                             '(exec once as __main__, see --exectwice)')
     parser.add_argument('-a', '--autoexec', action='store_true', default=False,
                         help='auto-exec tests without command-line interfaces on scripts by test-suites loading '
                              '(exec twice if originally provided)')
     parser.add_argument('-v', '--verbosity', type=int, help='verbosity for unittest.main')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='number of test files executed in parallel (0 for all CPU cores)')
+    parser.add_argument('--forkworker', action='store_true', default=False,
+                        help='execute test scripts in children forked from a pre-warmed process '
+                             'instead of new interpreters (not with autoexec)')
+    parser.add_argument('--preload', nargs='*',
+                        help='modules imported once before forking workers')
+    parser.add_argument('--cachedir', help='directory to keep caches in')
+    parser.add_argument('--nocache', action='store_true', default=False,
+                        help='neither use nor save caches')
+    parser.add_argument('--exectwice', action='store_true', default=False,
+                        help='preload test scripts as module & exec again as __main__ '
+                             '(default without --appendmain)')
+    parser.add_argument('--tempproxy', action='store_true', default=False,
+                        help='launch test scripts via temporary proxy files, instead of `-c`')
+    parser.add_argument('--durations', type=int,
+                        help='print the slowest N tests & test files, with durations of each phase')
+    parser.add_argument('--durationsfile', help='JSON file to write durations into')
+    parser.add_argument('--affected', nargs='*', metavar='PATH',
+                        help='execute only tests importing changed files, '
+                             'given or since the last --affected run')
+    parser.add_argument('--shard', type=shard_notation, metavar='INDEX/COUNT',
+                        help='execute only the INDEX-th (from 1) of COUNT shards of tests, '
+                             'split by hashes of paths unless --sharddurations')
+    parser.add_argument('--sharddurations', metavar='FILE',
+                        help='JSON file of durations (as --durationsfile writes) to balance shards by')
+    parser.add_argument('--lastfailed', '--last-failed', dest='last_failed', action='store_true',
+                        default=False, help='execute only tests failed in the last run')
+    parser.add_argument('--failedfirst', '--failed-first', dest='failed_first', action='store_true',
+                        default=False, help='execute tests failed in the last run first')
+    parser.add_argument('--report', nargs='+', metavar='REPORTER',
+                        help='report test events by reporters: console, jsonl:PATH or junit:PATH')
+    parser.add_argument('--threads', type=int,
+                        help='number of threads to run test classes on in autoexec')
+    parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                        help='kill test scripts (with their process groups) running over this '
+                             '(not with autoexec)')
+    parser.add_argument('--testtimeout', type=float, metavar='SECONDS',
+                        help='kill test scripts (with their process groups) when a test runs '
+                             'over this (not with autoexec)')
+    parser.add_argument('--streaming', action='store_true', default=False,
+                        help='load, run & unload test files one by one in autoexec')
+    parser.add_argument('--max-rss', '--maxrss', dest='max_rss', type=int, metavar='MB',
+                        help='run the rest of test files in a fresh worker over this RSS '
+                             '(implies --streaming)')
+    parser.add_argument('--isolate', action='store_true', default=False,
+                        help='load each test file with its own modules of test targets in autoexec')
+    parser.add_argument('--watch', nargs='?', type=float, const=1.0, metavar='SECONDS',
+                        help='rerun tests affected by changes, polled every SECONDS (default: 1)')
     args = parser.parse_args()
     # Execute target.
     kwargs = {}
@@ -540,12 +4096,60 @@ def test():
         kwargs['suite_autoload'] = args.autoexec
     if args.verbosity:
         kwargs['verbosity'] = args.verbosity
+    if args.jobs is not None:
+        kwargs['jobs'] = args.jobs
+    if args.forkworker:
+        kwargs['fork_worker'] = args.forkworker
+    if args.preload:
+        kwargs['preload'] = args.preload
+    if args.nocache:
+        kwargs['cache_dir'] = None
+    elif args.cachedir:
+        kwargs['cache_dir'] = args.cachedir
+    if 'cache_dir' in kwargs:
+        # Not to use the default one before options read.
+        ProjectConfig.get(kwargs['cache_dir'])
+    if args.exectwice:
+        kwargs['single_exec'] = False
+    if args.tempproxy:
+        kwargs['inline_proxy'] = False
+    if args.durations is not None:
+        kwargs['durations'] = args.durations
+    if args.durationsfile:
+        kwargs['durations_file'] = args.durationsfile
+    if args.affected is not None:
+        kwargs['affected'] = args.affected
+    if args.shard:
+        kwargs['shard'] = args.shard
+    if args.sharddurations:
+        kwargs['shard_durations'] = args.sharddurations
+    if args.last_failed:
+        kwargs['last_failed'] = True
+    if args.failed_first:
+        kwargs['failed_first'] = True
+    if args.isolate:
+        kwargs['isolate'] = True
+    if args.threads is not None:
+        kwargs['threads'] = args.threads
+    if args.report:
+        kwargs['reporters'] = args.report
+    if args.timeout is not None:
+        kwargs['timeout'] = args.timeout
+    if args.testtimeout is not None:
+        kwargs['test_timeout'] = args.testtimeout
+    if args.streaming:
+        kwargs['streaming'] = True
+    if args.max_rss is not None:
+        kwargs['max_rss'] = args.max_rss
     kwargs = TestRunner.autoexec_optarrange(kwargs)
     test_runner = ConfiguredTestRunner(**kwargs)
+    if args.watch is not None:
+        return test_runner.watch(interval=args.watch)
     if args.name:
-        test_runner.execute_by_path(args.name)
+        summary = test_runner.execute_by_path(args.name)
     else:
-        test_runner.execute_all()
+        summary = test_runner.execute_all()
+    return summary.exit_code
 
 def showconfig():
     """Show environment configs being applied."""
@@ -559,6 +4163,10 @@ def showconfig():
                         help='print library extension configuration')
     parser.add_argument('-t', '--test', type=state_to_boolean, default=True,
                         help='print test runner configuration')
+    parser.add_argument('--lazy', action='store_true', default=False,
+                        help='show library extensions activated lazily by importing --imports')
+    parser.add_argument('-i', '--imports', nargs='*', default=[],
+                        help='modules to import with library extensions')
     args = parser.parse_args()
     kwargs = {}
     if args.encoding:
@@ -570,13 +4178,32 @@ def showconfig():
     if args.libext:
         print("")
         print(">>> Load libext configs (for `shell` and `exec`) ...")
-        lib_env = ConfiguredLibraryEnvironment(**kwargs)
+        lib_kwargs = dict(kwargs)
+        if args.lazy:
+            lib_kwargs['lazy'] = True
+        lib_env = ConfiguredLibraryEnvironment(**lib_kwargs)
         ext_paths = lib_env.ext_paths
+        activated = None
+        if args.imports or lib_env.lazy_finder is not None:
+            with lib_env:
+                for module_name in args.imports:
+                    try:
+                        __import__(module_name)
+                    except ImportError as ex:
+                        logger.error('failed to import "{}": {}'.format(module_name, ex))
+                if lib_env.lazy_finder is not None:
+                    activated = list(lib_env.lazy_finder.activated)
         print("configured {} library extensions.".format(len(ext_paths)))
+        if activated is not None:
+            print("activated {} library extensions lazily.".format(len(activated)))
         print("----------------------------------------------------------------------")
         for path in ext_paths:
+            if activated is None:
+                state = ''
+            else:
+                state = ' (activated)' if path in activated else ' (inactive)'
             print(
-              '    + path extension: "{}"'.format(path)
+              '    + path extension: "{}"{}'.format(path, state)
             )
         print("----------------------------------------------------------------------")
         print("<<< finished.")
@@ -614,6 +4241,140 @@ def showconfig():
         print("----------------------------------------------------------------------")
         print("<<< finished.")
 
+def importtime():
+    """Profile imports of a module or script with given extension paths."""
+    # CLI configs.
+    parser = argparse.ArgumentParser(
+        description='ipyenv v{}: Profile imports with a supplied environment'.format(__version__)
+    )
+    parser.add_argument('importtime') # ignore this.
+    parser.add_argument('target', help='module name or script path to import')
+    parser.add_argument('-l', '--libext', help='Library extension paths', nargs='*')
+    parser.add_argument('-e', '--encoding', help='rcfile encoding')
+    parser.add_argument('--indexed', action='store_true', default=False,
+                        help='import top-level modules/packages via the index of library paths')
+    parser.add_argument('--lazy', action='store_true', default=False,
+                        help='put library paths on sys.path only when they provide modules imported')
+    args = parser.parse_args()
+    if importlib_machinery is None:
+        logger.error('importlib not available: cannot profile imports')
+        return 1
+    kwargs = {}
+    if args.libext:
+        kwargs['sitelib_paths'] = args.libext
+    if args.encoding:
+        kwargs['rcfile_encoding'] = args.encoding
+    if args.indexed:
+        kwargs['indexed'] = True
+    if args.lazy:
+        kwargs['lazy'] = True
+    target = args.target
+    returncode = 0
+    with ConfiguredLibraryEnvironment(**kwargs) as env:
+        with ImportTimer(env.ext_paths) as timer:
+            try:
+                if target.endswith('.py') and os.path.isfile(target):
+                    sys.argv = [target.split(os.sep)[-1]]
+                    _execute_file(target, env, single_exec=True)
+                else:
+                    __import__(target)
+            except SystemExit as ex:
+                returncode = _exit_code_of(ex)
+            except:
+                traceback.print_exc()
+                returncode = 1
+    sys.stdout.flush()
+    print("======================================================================")
+    print("  import time of \"{}\"  ".format(target))
+    print("======================================================================")
+    timer.report()
+    return returncode
+
+
+def bundle():
+    """Bundle a script & library extensions into a zip archive."""
+    # CLI configs.
+    parser = argparse.ArgumentParser(
+        description='ipyenv v{}: Bundle a script with a supplied environment'.format(__version__)
+    )
+    parser.add_argument('bundle') # ignore this.
+    parser.add_argument('target_script')
+    parser.add_argument('-o', '--output', help='bundle path (default: the script name + .pyz)')
+    parser.add_argument('-l', '--libext', help='Library extension paths', nargs='*')
+    parser.add_argument('-e', '--encoding', help='rcfile encoding')
+    parser.add_argument('--check', action='store_true', default=False,
+                        help='only check whether the bundle is up to date (exit code 1 if stale)')
+    parser.add_argument('--force', action='store_true', default=False,
+                        help='bundle again even if up to date')
+    args = parser.parse_args()
+    target = args.target_script
+    if not os.path.exists(target):
+        logger.error('target script not found: "{}"'.format(target))
+        return 1
+    output = args.output or os.path.splitext(target)[0] + '.pyz'
+    kwargs = {}
+    if args.libext:
+        kwargs['sitelib_paths'] = args.libext
+    if args.encoding:
+        kwargs['rcfile_encoding'] = args.encoding
+    lib_env = ConfiguredLibraryEnvironment(**kwargs)
+    info = _read_bundle_info(output)
+    up_to_date = info is not None and \
+                 info.get('hash') == _bundle_hash(_bundle_files(target, lib_env.ext_paths))
+    if args.check:
+        print('{}: {}'.format(output, 'up to date' if up_to_date else 'stale'))
+        return 0 if up_to_date else 1
+    if up_to_date and not args.force:
+        logger.info('bundle up to date: "{}"'.format(output))
+        return 0
+    info = _build_bundle(target, lib_env.ext_paths, output)
+    logger.info('bundled {} files into "{}"'.format(info['files'], output))
+    return 0
+
+def server():
+    """Serve exec/shell requests in children forked from a pre-warmed process."""
+    # CLI configs.
+    parser = argparse.ArgumentParser(
+        description='ipyenv v{}: fork server of a supplied environment'.format(__version__)
+    )
+    parser.add_argument('server') # ignore this.
+    parser.add_argument('-l', '--libext', help='Library extension paths', nargs='*')
+    parser.add_argument('-e', '--encoding', help='.sitelibs file encoding')
+    parser.add_argument('--indexed', action='store_true', default=False,
+                        help='import top-level modules/packages via the index of library paths')
+    parser.add_argument('--lazy', action='store_true', default=False,
+                        help='put library paths on sys.path only when they provide modules imported')
+    parser.add_argument('--preload', nargs='*', default=[],
+                        help='modules imported once before forking children')
+    parser.add_argument('--socket', default=_server_socket_path(),
+                        help='Unix domain socket path to serve on')
+    parser.add_argument('--stop', action='store_true', default=False,
+                        help='stop the server running (after its children exit)')
+    args = parser.parse_args()
+    if args.stop:
+        returncode = _request_server(args.socket, {'action': 'stop'})
+        return 1 if returncode is None else returncode
+    if not FORK_SERVER_SUPPORTED:
+        logger.error('fork server not supported on this platform')
+        return 1
+    kwargs = {}
+    if args.libext:
+        kwargs['sitelib_paths'] = args.libext
+    if args.encoding:
+        kwargs['rcfile_encoding'] = args.encoding
+    if args.indexed:
+        kwargs['indexed'] = True
+    if args.lazy:
+        kwargs['lazy'] = True
+    fork_server = ForkServer(args.socket, ConfiguredLibraryEnvironment(**kwargs),
+                             preload=args.preload, reload_argv=sys.argv[:])
+    signal.signal(signal.SIGTERM, fork_server.stop)
+    try:
+        fork_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
 
 if __name__ == '__main__':
     # Command-line interfaces.
@@ -626,16 +4387,22 @@ if __name__ == '__main__':
         'exec',
         'test',
         'showconfig',
+        'importtime',
+        'bundle',
+        'server',
     )
     action_funcs = {
         'shell': shell,
         'exec': execute,
         'test': test,
         'showconfig': showconfig,
+        'importtime': importtime,
+        'bundle': bundle,
+        'server': server,
     }
     parser.add_argument('action',
                         help='ACTION: ( {} )'.format(', '.join(actions)),
                         choices=actions)
     # Parse & execute.
     args = parser.parse_args(sys.argv[1:2])
-    action_funcs[args.action]()
+    sys.exit(action_funcs[args.action]())
@@ -0,0 +1,425 @@
+# encoding: utf-8
+
+"""
+Benchmarks of ipyenv's own overhead, on synthetic project trees.
+
+    $ python run_benchmarks.py run -o results.json
+    $ python run_benchmarks.py compare baseline.json results.json
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import platform
+import subprocess
+import logging
+import argparse
+
+import ipyenv
+
+
+# Create logger only for this script.
+def create_logger(level=logging.INFO):
+    logger = logging.getLogger('ipyenv:benchmarks')
+    logger.setLevel(level)
+    handler = logging.StreamHandler()
+    handler.setLevel(level)
+    formatter = logging.Formatter('ipyenv/benchmarks(%(levelname)s): %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    return logger
+logger = create_logger()
+
+# Cancel logging of ipyenv.
+ipyenv.create_logger(logging.CRITICAL)
+
+# Timer to measure durations.
+timer = ipyenv._timer
+
+# Sizes of the synthetic trees.
+DEFAULT_PARAMS = {
+    'test_files': 10000,    # test files in the tree
+    'files_per_dir': 20,    # test files per directory
+    'fanout': 4,            # subdirectories per directory
+    'deep_nesting': 30,     # depth of a chain of directories, holding a test each
+    'sitelibs': 100,        # entries of `.sitelibs`
+    'testfor_lines': 2000,  # lines of `.testfor`
+    'testfor_dirs': 200,    # directories listed in `.testfor` (repeatedly)
+    'import_files': 200,    # modules imported by `_get_module_from_path` & the loader
+    'proxy_files': 20,      # test files launched by `TestProxy`
+    'mode_files': 100,      # test files run in suite & appendmain modes
+}
+# Sizes in the current run, scaled.
+CURRENT_PARAMS = dict(DEFAULT_PARAMS)
+
+TEST_SOURCE = """\
+# encoding: utf-8
+import unittest
+import lib_mod_{lib}
+
+
+class BenchmarkCase{index}(unittest.TestCase):
+
+    def test_nothing(self):
+        pass
+"""
+
+
+def write_file(path, source):
+    with open(path, 'w') as f:
+        f.write(source)
+
+def write_tests(test_dir, names, sitelibs):
+    """Write test files of the names, nested in directories under `test_dir`."""
+    params = CURRENT_PARAMS
+    dir_paths = [test_dir]
+    pending = [test_dir]
+    children = {}
+    for start in range(0, len(names), params['files_per_dir']):
+        # Directories are made breadth first, `fanout` under each.
+        if start:
+            parent = pending[0]
+            dir_path = os.path.join(parent, 'd{}'.format(len(dir_paths)))
+            os.mkdir(dir_path)
+            dir_paths.append(dir_path)
+            pending.append(dir_path)
+            children[parent] = children.get(parent, 0) + 1
+            if children[parent] == params['fanout']:
+                pending.pop(0)
+        for name in names[start:start + params['files_per_dir']]:
+            index = int(name.split('_')[-1])
+            write_file(os.path.join(dir_paths[-1], 'test_{}.py'.format(name)),
+                       TEST_SOURCE.format(index=index, lib=index % sitelibs))
+
+def write_testfor(test_dir, root):
+    """`.testfor` listing directories under `root` repeatedly."""
+    params = CURRENT_PARAMS
+    lines = [os.path.relpath(os.path.join(root, 'targets', 't{}'.format(i % params['testfor_dirs'])),
+                             test_dir).replace(os.sep, '/')
+             for i in range(params['testfor_lines'])]
+    write_file(os.path.join(test_dir, '.testfor'), '\n'.join(lines) + '\n')
+
+def generate_tree(root):
+    """Generate a synthetic project tree under `root`."""
+    params = CURRENT_PARAMS
+    sitelib = os.path.join(root, 'sitelib')
+    os.mkdir(sitelib)
+    entries = []
+    for i in range(params['sitelibs']):
+        lib_dir = os.path.join(sitelib, 'lib{}'.format(i))
+        os.mkdir(lib_dir)
+        write_file(os.path.join(lib_dir, 'lib_mod_{}.py'.format(i)), 'value = {}\n'.format(i))
+        entries.append('./lib{}'.format(i))
+    write_file(os.path.join(sitelib, '.sitelibs'), '\n'.join(entries) + '\n')
+    os.mkdir(os.path.join(root, 'targets'))
+    for i in range(params['testfor_dirs']):
+        os.mkdir(os.path.join(root, 'targets', 't{}'.format(i)))
+    # Whole tree of tests.
+    tests = os.path.join(root, 'tests')
+    os.mkdir(tests)
+    write_tests(tests, ['b_{}'.format(i) for i in range(params['test_files'])],
+                params['sitelibs'])
+    dir_path = tests
+    for i in range(params['deep_nesting']):
+        dir_path = os.path.join(dir_path, 'n{}'.format(i))
+        os.mkdir(dir_path)
+        write_file(os.path.join(dir_path, 'test_deep_{}.py'.format(i)),
+                   TEST_SOURCE.format(index=i, lib=i % params['sitelibs']))
+    write_testfor(tests, root)
+    # Smaller trees to run tests in.
+    for name, count in (('proxy', params['proxy_files']), ('modes', params['mode_files'])):
+        test_dir = os.path.join(root, name)
+        os.mkdir(test_dir)
+        write_tests(test_dir, ['{}_{}'.format(name, i) for i in range(count)],
+                    params['sitelibs'])
+        write_testfor(test_dir, root)
+    return sitelib, tests
+
+
+def measure(func, repeat, setup=None, number=1):
+    """Seconds taken by `func` per call, in each of `repeat` rounds."""
+    timings = []
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        started = timer()
+        for _ in range(number):
+            func(arg)
+        timings.append((timer() - started) / number)
+    return timings
+
+def summarize(timings, **extra):
+    result = {
+        'best': min(timings),
+        'mean': sum(timings) / len(timings),
+        'repeat': len(timings),
+    }
+    result.update(extra)
+    return result
+
+
+class SilencedOutput(object):
+    """Context manager to redirect stdout & stderr (also of subprocesses) to null."""
+
+    def __enter__(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self._null = os.open(os.devnull, os.O_WRONLY)
+        self._saved = [os.dup(1), os.dup(2)]
+        os.dup2(self._null, 1)
+        os.dup2(self._null, 2)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved in zip((1, 2), self._saved):
+            os.dup2(saved, fd)
+            os.close(saved)
+        os.close(self._null)
+
+
+class ChildEnvironment(object):
+    """
+    Context manager to set `PYTHONPATH` of `os.environ` (returned), for
+    subprocesses (test proxies, etc.) to import ipyenv from here.
+    """
+
+    def __enter__(self):
+        self._orig = os.environ.get('PYTHONPATH')
+        os.environ['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.abspath(ipyenv.__file__))] +
+            [path for path in (self._orig or '').split(os.pathsep) if path])
+        return os.environ
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._orig is None:
+            del os.environ['PYTHONPATH']
+        else:
+            os.environ['PYTHONPATH'] = self._orig
+
+
+class BenchmarkFailed(Exception):
+    """A run measured failed, not to be taken as a result."""
+    pass
+
+
+def bench_find_tests(sitelib, tests, repeat):
+    runner = ipyenv.TestRunner(test_paths=(), sitelib_paths=(), cache_dir=None)
+    found = len(runner._find_tests(tests))
+    cold = measure(lambda arg: runner._find_tests(tests), repeat)
+    index = {}
+    runner._find_tests(tests, index)
+    warm = measure(lambda arg: runner._find_tests(tests, index), repeat)
+    return {
+        'find_tests': summarize(cold, files=found),
+        'find_tests_indexed': summarize(warm, files=found),
+    }
+
+def bench_load_extdir(sitelib, tests, repeat):
+    def fresh_config():
+        ipyenv.ProjectConfig._instance = ipyenv.ProjectConfig(cache_dir=None)
+    def load(arg):
+        ipyenv._load_extdir(sitelib, 'utf-8', '.sitelibs')
+        ipyenv._load_extdir(tests, 'utf-8', '.testfor')
+    cold = measure(load, repeat, setup=fresh_config)
+    fresh_config()
+    load(None)
+    cached = measure(load, repeat)
+    return {
+        'load_extdir': summarize(cold),
+        'load_extdir_cached': summarize(cached),
+    }
+
+def bench_path_environment(sitelib, tests, repeat):
+    ext_paths = ipyenv.LibraryEnvironment(sitelib_paths=(sitelib,)).ext_paths
+    def enter_exit(env):
+        with env:
+            pass
+    results = {}
+    for name, isolate in (('path_environment', False), ('path_environment_isolated', True)):
+        timings = measure(enter_exit, repeat, number=100,
+                          setup=lambda: ipyenv.PathEnvironment(ext_paths, isolate=isolate))
+        results[name] = summarize(timings, paths=len(ext_paths))
+    return results
+
+def bench_get_module(sitelib, tests, repeat):
+    env = ipyenv.LibraryEnvironment(sitelib_paths=(sitelib,))
+    runner = ipyenv.TestRunner(test_paths=(), sitelib_paths=(), cache_dir=None)
+    paths = runner._find_tests(tests)[:CURRENT_PARAMS['import_files']]
+    def unload():
+        for path in paths:
+            sys.modules.pop(os.path.splitext(os.path.basename(path))[0], None)
+        for i in range(CURRENT_PARAMS['sitelibs']):
+            sys.modules.pop('lib_mod_{}'.format(i), None)
+    def import_all(arg):
+        for path in paths:
+            ipyenv._get_module_from_path(path, env)
+    timings = measure(import_all, repeat, setup=unload)
+    unload()
+    loader = ipyenv._TestModuleLoader(paths, dict((path, tests) for path in paths))
+    def unload_qualified():
+        unload()
+        for path in paths:
+            sys.modules.pop(loader.module_name(path), None)
+    def load_all(arg):
+        with ipyenv.PathEnvironment(env.ext_paths):
+            for path in paths:
+                loader.load(path)
+    batch_timings = measure(load_all, repeat, setup=unload_qualified)
+    unload_qualified()
+    return {
+        'get_module_from_path': summarize([t / len(paths) for t in timings],
+                                          files=len(paths)),
+        'test_module_loader': summarize([t / len(paths) for t in batch_timings],
+                                        files=len(paths)),
+    }
+
+def bench_test_proxy(sitelib, tests, repeat):
+    proxy_dir = os.path.join(os.path.dirname(tests), 'proxy')
+    runner = ipyenv.TestRunner(test_paths=(), sitelib_paths=(), cache_dir=None)
+    paths = runner._find_tests(proxy_dir)
+    ext_paths = (ipyenv.LibraryEnvironment(sitelib_paths=(sitelib,)).ext_paths +
+                 ipyenv._load_extdir(proxy_dir, 'utf-8', '.testfor'))
+    def launch_all(arg):
+        for path in paths:
+            proxy = ipyenv.TestProxy(path, ext_paths=ext_paths)
+            command = proxy.command()
+            if command is None:
+                with proxy as proxy_path:
+                    returncode = subprocess.call([sys.executable, proxy_path])
+            else:
+                returncode = subprocess.call(command)
+            if returncode != 0:
+                raise BenchmarkFailed('test proxy exited with {}: "{}"'.format(returncode, path))
+    # Proxies import ipyenv from here.
+    with ChildEnvironment(), SilencedOutput():
+        timings = measure(launch_all, repeat)
+    return {'test_proxy_launch': summarize([t / len(paths) for t in timings],
+                                           files=len(paths))}
+
+def bench_modes(sitelib, tests, repeat):
+    modes_dir = os.path.join(os.path.dirname(tests), 'modes')
+    results = {}
+    for name, kwargs in (('suite_mode', {}),
+                         ('appendmain_mode', {'suite_autoload': False, 'append_main': True})):
+        def run(runner):
+            summary = runner.execute_all()
+            if summary.exit_code != 0:
+                raise BenchmarkFailed('{} failed: {}'.format(name, summary.failures[:3]))
+        def setup():
+            for module_name in list(sys.modules):
+                if module_name.startswith(('test_modes_', 'lib_mod_')):
+                    del sys.modules[module_name]
+            return ipyenv.TestRunner(test_paths=(modes_dir,), sitelib_paths=(sitelib,),
+                                     cache_dir=None, **kwargs)
+        # Test scripts in new interpreters import ipyenv from here.
+        with ChildEnvironment(), SilencedOutput():
+            timings = measure(run, repeat, setup=setup)
+        results[name] = summarize(timings, files=CURRENT_PARAMS['mode_files'])
+    return results
+
+BENCHMARKS = (
+    bench_find_tests,
+    bench_load_extdir,
+    bench_path_environment,
+    bench_get_module,
+    bench_test_proxy,
+    bench_modes,
+)
+
+def run(output=None, repeat=3, scale=1.0, selected=None, keep_tree=False):
+    """Run benchmarks on a tree generated & write results in JSON."""
+    for key, value in DEFAULT_PARAMS.items():
+        CURRENT_PARAMS[key] = max(1, int(value * scale)) \
+            if key not in ('files_per_dir', 'fanout') else value
+    root = tempfile.mkdtemp(prefix='ipyenv-benchmarks-')
+    try:
+        logger.info('generate tree in "{}"'.format(root))
+        sitelib, tests = generate_tree(root)
+        results = {}
+        for bench in BENCHMARKS:
+            name = bench.__name__[len('bench_'):]
+            if selected and name not in selected:
+                continue
+            logger.info('benchmark: {}'.format(name))
+            results.update(bench(sitelib, tests, repeat))
+    finally:
+        if keep_tree:
+            logger.info('tree kept in "{}"'.format(root))
+        else:
+            shutil.rmtree(root)
+    report = {
+        'ipyenv': ipyenv.__version__,
+        'python': platform.python_implementation() + ' ' + platform.python_version(),
+        'platform': platform.platform(),
+        'params': CURRENT_PARAMS,
+        'results': results,
+    }
+    for name in sorted(results):
+        print('{:<28} {:10.6f}s (best of {})'.format(name, results[name]['best'],
+                                                      results[name]['repeat']))
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+def compare(baseline, current, threshold=0.2):
+    """
+    Compare best timings with the baseline, & return the number of
+    regressions (slower than `threshold` as a ratio).
+    """
+    with open(baseline) as f:
+        baseline = json.load(f)
+    with open(current) as f:
+        current = json.load(f)
+    if baseline.get('params') != current.get('params'):
+        logger.warning('benchmarked with different parameters')
+    regressions = 0
+    for name in sorted(set(baseline['results']) | set(current['results'])):
+        if name not in baseline['results'] or name not in current['results']:
+            print('{:<28} {}'.format(name, 'only in ' + (
+                'baseline' if name in baseline['results'] else 'current')))
+            continue
+        before = baseline['results'][name]['best']
+        after = current['results'][name]['best']
+        ratio = after / before if before else float('inf')
+        regressed = ratio > 1.0 + threshold
+        regressions += regressed
+        print('{:<28} {:10.6f}s -> {:10.6f}s  {:+7.1%}{}'.format(
+            name, before, after, ratio - 1.0, '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help='run benchmarks')
+    run_parser.add_argument('-o', '--output', help='JSON file to write results into')
+    run_parser.add_argument('-r', '--repeat', type=int, default=3,
+                            help='rounds of each benchmark, the best taken')
+    run_parser.add_argument('--scale', type=float, default=1.0,
+                            help='scale of the tree (1.0 for 10k test files)')
+    run_parser.add_argument('--keeptree', action='store_true', default=False,
+                            help='keep the tree generated')
+    run_parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                            help='benchmarks to run: ' + ', '.join(
+                                bench.__name__[len('bench_'):] for bench in BENCHMARKS))
+    compare_parser = subparsers.add_parser('compare', help='compare results with a baseline')
+    compare_parser.add_argument('baseline', help='JSON file of the baseline')
+    compare_parser.add_argument('current', help='JSON file of the results to compare')
+    compare_parser.add_argument('-t', '--threshold', type=float, default=0.2,
+                                help='ratio of slowdown flagged as a regression')
+    args = parser.parse_args()
+    if args.command == 'run':
+        try:
+            run(args.output, args.repeat, args.scale, args.benchmarks, args.keeptree)
+        except BenchmarkFailed as ex:
+            logger.error('benchmark aborted: {}'.format(ex))
+            sys.exit(1)
+    elif args.command == 'compare':
+        sys.exit(1 if compare(args.baseline, args.current, args.threshold) else 0)
+    else:
+        parser.print_help()
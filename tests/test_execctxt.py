@@ -3,11 +3,18 @@
 import unittest
 import sys
 import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import zipfile
 
 # Add project root path for our module.
 sys.path.append(os.path.abspath('../')) # works well in IronPython.
 sys.path.append(os.path.abspath('.'))   # works well in the others.
 import ipyenv
+import helper
 
 # Cancel logging.
 import logging
@@ -40,6 +47,63 @@ class RWFreeNamedTempFileTest(unittest.TestCase):
                 self.assertEqual(f.read().decode('utf-8'), my_source)
 
 
+    def test_unlink_retries(self):
+        """Assert removing the temporary file is retried for a while."""
+        unlink = os.unlink
+        failures = []
+        def flaky_unlink(path):
+            if len(failures) < 3:
+                failures.append(path)
+                raise OSError('locked')
+            unlink(path)
+        os.unlink = flaky_unlink
+        try:
+            with ipyenv.RWFreeNamedTempFile(source='', target_dir='./') as filename:
+                pass
+        finally:
+            os.unlink = unlink
+        self.assertEqual(len(failures), 3)
+        self.assertFalse(os.path.exists(filename))
+
+    def test_unlink_bounded(self):
+        """Assert removing the temporary file is given up at last."""
+        unlink, warning = os.unlink, ipyenv.logger.warning
+        failures, warnings = [], []
+        def locked_unlink(path):
+            # Never removed.
+            failures.append(path)
+            raise OSError('locked')
+        os.unlink = locked_unlink
+        ipyenv.logger.warning = warnings.append
+        try:
+            temp_file = ipyenv.RWFreeNamedTempFile(source='', target_dir='./')
+            temp_file.UNLINK_BACKOFF = 0.0
+            with temp_file as filename:
+                pass
+        finally:
+            os.unlink, ipyenv.logger.warning = unlink, warning
+        self.assertEqual(failures, [filename] * temp_file.UNLINK_RETRIES)
+        self.assertEqual(len(warnings), 1)
+        self.assertIn(filename, warnings[0])
+        self.assertTrue(os.path.exists(filename))
+        os.unlink(filename)
+
+
+class TestProxyTest(unittest.TestCase):
+    """Assert `ipyenv.TestProxy` launches without temporary files."""
+
+    def test_command(self):
+        proxy = ipyenv.TestProxy('target.py', ext_paths=['.'])
+        command = proxy.command('python')
+        self.assertEqual(command[:2], ['python', '-c'])
+        self.assertEqual(command[2], proxy.source)
+
+    def test_command_too_long(self):
+        proxy = ipyenv.TestProxy('target.py',
+                                 ext_paths=['.' * ipyenv.TestProxy.INLINE_SCRIPT_LIMIT])
+        self.assertIsNone(proxy.command())
+
+
 class ExecContextTest(unittest.TestCase):
     """
     Assert `ipyenv.py exec` makes a proper context in execution.
@@ -80,5 +144,309 @@ __file__
             ipyenv._execute_file(tempf, dummy_pathenv, load_module=False)
 
 
+class SingleExecTest(unittest.TestCase):
+    """
+    Assert `ipyenv.py exec` executes the target only once as `__main__`.
+    """
+
+    script = """
+# encoding: utf-8
+import os
+import pickle
+import sys
+os.environ['IPYENV_EXECUTED'] = os.environ.get('IPYENV_EXECUTED', '') + '+'
+class Point(object):
+    pass
+module_name = os.path.splitext(os.path.basename(__file__))[0]
+assert sys.modules['__main__'] is sys.modules[module_name]
+point = pickle.loads(pickle.dumps(Point()))
+assert isinstance(point, Point)
+"""
+
+    def setUp(self):
+        self.orig_main = sys.modules['__main__']
+        os.environ.pop('IPYENV_EXECUTED', None)
+
+    def tearDown(self):
+        sys.modules['__main__'] = self.orig_main
+        os.environ.pop('IPYENV_EXECUTED', None)
+
+    def test_executed_once(self):
+        """Top-level statements are executed once."""
+        pathenv = ipyenv.PathEnvironment([])
+        with ipyenv.RWFreeNamedTempFile(source=self.script) as tempf:
+            with pathenv as env:
+                main = ipyenv._execute_file(tempf, env, single_exec=True)
+        self.assertEqual(os.environ['IPYENV_EXECUTED'], '+')
+        self.assertEqual(main.__name__, '__main__')
+        self.assertIsInstance(main.point, main.Point)
+
+    def test_restored(self):
+        """Modules replaced while executed are put back."""
+        with ipyenv.RWFreeNamedTempFile(source=self.script) as tempf:
+            module_name = os.path.splitext(os.path.basename(tempf))[0]
+            main = ipyenv._execute_file(tempf, single_exec=True)
+            self.assertIs(sys.modules['__main__'], self.orig_main)
+            self.assertNotIn(module_name, sys.modules)
+            # Run as the program of the process.
+            main = ipyenv._execute_file(tempf, single_exec=True, keep_main=True)
+            self.assertIs(sys.modules['__main__'], main)
+            self.assertIs(sys.modules.pop(module_name), main)
+
+    def test_name_taken(self):
+        """Modules of the same name are never replaced."""
+        work_dir = tempfile.mkdtemp()
+        try:
+            target = os.path.join(work_dir, 'json.py')
+            with open(target, 'w') as f:
+                f.write('executed = True\n')
+            json_module = sys.modules.setdefault('json', __import__('json'))
+            main = ipyenv._execute_file(target, single_exec=True)
+            self.assertTrue(main.executed)
+            self.assertIs(sys.modules['json'], json_module)
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class BytecodeCacheTest(unittest.TestCase):
+    """
+    Assert code objects of executed files are cached.
+    """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_cached(self):
+        """Code cached is used while the file unchanged."""
+        script = 'result = 1\n'
+        with ipyenv.RWFreeNamedTempFile(source=script) as tempf:
+            ipyenv._compile_file(tempf, self.cache_dir)
+            self.assertTrue(os.listdir(os.path.join(self.cache_dir, 'bytecode')))
+            ipyenv.compile = None   # shadows the built-in, never called
+            try:
+                code = ipyenv._compile_file(tempf, self.cache_dir)
+            finally:
+                del ipyenv.compile
+            global_vars = {}
+            exec(code, global_vars)
+            self.assertEqual(global_vars['result'], 1)
+
+    def test_invalidated(self):
+        """Code is compiled again if the file changed."""
+        with ipyenv.RWFreeNamedTempFile(source='result = 1\n') as tempf:
+            ipyenv._compile_file(tempf, self.cache_dir)
+            with open(tempf, 'w') as f:
+                f.write('result = 100\n')
+            global_vars = {}
+            exec(ipyenv._compile_file(tempf, self.cache_dir), global_vars)
+            self.assertEqual(global_vars['result'], 100)
+
+    def test_execute(self):
+        """Assert executed with the cache."""
+        script = """
+#encoding: utf-8
+sys
+__name__
+__file__
+"""
+        dummy_pathenv = ipyenv.PathEnvironment([])
+        with ipyenv.RWFreeNamedTempFile(source=script) as tempf:
+            for _ in range(2):
+                ipyenv._execute_file(tempf, dummy_pathenv, load_module=False,
+                                     cache_dir=self.cache_dir)
+
+
+class BundleTest(unittest.TestCase):
+    """
+    Assert scripts are bundled with library extensions into zip archives.
+    """
+
+    script = (
+        'import sys\n'
+        'import toplevel_module\n'
+        'from hrch_pkg.subpkg import inner_module\n'
+        'print(toplevel_module.label())\n'
+        'print(inner_module.label())\n'
+        'print(__name__)\n'
+        'sys.exit(int(sys.argv[1]))\n'
+    )
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.target = os.path.join(self.work_dir, 'bundled_script.py')
+        with open(self.target, 'w') as f:
+            f.write(self.script)
+        self.bundle_path = os.path.join(self.work_dir, 'bundled_script.pyz')
+        self.env = ipyenv.LibraryEnvironment(
+            sitelib_paths=(helper.get_abspath_from('sitelib'),)
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_run(self):
+        """Bundles run the target script only from compiled files."""
+        info = ipyenv._build_bundle(self.target, self.env.ext_paths, self.bundle_path)
+        with zipfile.ZipFile(self.bundle_path) as bundle:
+            names = bundle.namelist()
+        self.assertIn('__main__.py', names)
+        self.assertIn('__ipyenv_main__.pyc', names)
+        self.assertIn('hrch_pkg/subpkg/inner_module.pyc', names)
+        self.assertNotIn('toplevel_module.py', names)
+        self.assertEqual(ipyenv._read_bundle_info(self.bundle_path), info)
+        process = subprocess.Popen([sys.executable, self.bundle_path, '3'],
+                                   stdout=subprocess.PIPE)
+        output = process.communicate()[0].decode('utf-8').split()
+        self.assertEqual(process.returncode, 3)
+        self.assertEqual(output[-1], '__main__')
+        self.assertIn('sitelib/hrch/subpkg/inner_module.', output)
+
+    def test_content_hash(self):
+        """Bundles are stale when any file bundled changed."""
+        info = ipyenv._build_bundle(self.target, self.env.ext_paths, self.bundle_path)
+        files = ipyenv._bundle_files(self.target, self.env.ext_paths)
+        self.assertEqual(ipyenv._bundle_hash(files), info['hash'])
+        with open(self.target, 'a') as f:
+            f.write('# changed\n')
+        self.assertNotEqual(ipyenv._bundle_hash(files), info['hash'])
+
+
+
+@unittest.skipUnless(ipyenv.FORK_SERVER_SUPPORTED, 'fork server not supported')
+class ForkServerTest(unittest.TestCase):
+    """
+    Assert scripts are executed in children of the fork server.
+    """
+
+    script = (
+        'import os\n'
+        'import sys\n'
+        'import preloaded\n'
+        'print(preloaded.VALUE)\n'
+        'print(os.getcwd())\n'
+        'sys.exit(int(os.environ["EXIT_CODE"]))\n'
+    )
+
+    def setUp(self):
+        self.work_dir = os.path.realpath(tempfile.mkdtemp())
+        lib_dir = os.path.join(self.work_dir, 'sitelib', 'lib')
+        os.makedirs(lib_dir)
+        with open(os.path.join(self.work_dir, 'sitelib', '.sitelibs'), 'w') as f:
+            f.write('./lib\n')
+        self.preloaded = os.path.join(lib_dir, 'preloaded.py')
+        with open(self.preloaded, 'w') as f:
+            f.write('VALUE = "first"\n')
+        with open(os.path.join(self.work_dir, 'script.py'), 'w') as f:
+            f.write(self.script)
+        self.socket_path = os.path.join(self.work_dir, 'server.sock')
+        self.command = [sys.executable, os.path.abspath(ipyenv.__file__).replace('.pyc', '.py')]
+        self.server = subprocess.Popen(
+            self.command + ['server', '-l', 'sitelib', '--preload', 'preloaded',
+                            '--socket', self.socket_path],
+            cwd=self.work_dir, stderr=subprocess.PIPE,
+        )
+        self.wait_for(lambda: os.path.exists(self.socket_path))
+
+    def tearDown(self):
+        if self.server.poll() is None:
+            self.server.kill()
+            self.server.wait()
+        self.server.stderr.close()
+        shutil.rmtree(self.work_dir)
+
+    def wait_for(self, condition, timeout=10.0):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertTrue(time.time() < deadline, 'timed out')
+            time.sleep(0.05)
+
+    def execute(self, exit_code=0):
+        env = dict(os.environ)
+        env['EXIT_CODE'] = str(exit_code)
+        process = subprocess.Popen(
+            self.command + ['exec', '--server', '--socket', self.socket_path, 'script.py'],
+            cwd=self.work_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        output, errors = process.communicate()
+        return process.returncode, output.decode('utf-8').split(), errors
+
+    def test_execute(self):
+        returncode, output, errors = self.execute(exit_code=3)
+        self.assertNotIn(b'not available', errors)
+        self.assertEqual(returncode, 3)
+        self.assertEqual(output, ['first', self.work_dir])
+        # Reloaded on changes of preloaded modules.
+        with open(self.preloaded, 'w') as f:
+            f.write('VALUE = "second"\n')
+        def reloaded():
+            returncode, output, errors = self.execute()
+            return output[:1] == ['second'] and b'not available' not in errors
+        self.wait_for(reloaded)
+        returncode = subprocess.call(self.command + ['server', '--stop',
+                                                     '--socket', self.socket_path])
+        self.assertEqual(returncode, 0)
+        self.assertEqual(self.server.wait(), 0)
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_stalled_client(self):
+        """Clients sending no request never keep the others waiting."""
+        import socket
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            stalled.connect(self.socket_path)
+            started = time.time()
+            returncode, output, errors = self.execute()
+            self.assertNotIn(b'not available', errors)
+            self.assertEqual(output, ['first', self.work_dir])
+            self.assertTrue(time.time() - started < ipyenv.ForkServer.REQUEST_TIMEOUT)
+        finally:
+            stalled.close()
+
+    def test_refused_while_reloading(self):
+        """Requests while waiting to reload are run by clients themselves."""
+        with open(os.path.join(self.work_dir, 'slow.py'), 'w') as f:
+            f.write('import time\ntime.sleep(4)\n')
+        slow = subprocess.Popen(
+            self.command + ['exec', '--server', '--socket', self.socket_path, 'slow.py'],
+            cwd=self.work_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        try:
+            time.sleep(0.5)
+            with open(self.preloaded, 'w') as f:
+                f.write('VALUE = "second"\n')
+            # Changes found while the slow one running.
+            time.sleep(ipyenv.ForkServer.POLL_INTERVAL * 2)
+            returncode, output, errors = self.execute()
+            self.assertIn(b'not available', errors)
+            self.assertEqual(returncode, 0)
+            self.assertEqual(output, ['second', self.work_dir])
+        finally:
+            slow.communicate()
+        self.assertEqual(slow.returncode, 0)
+
+    def test_owner_only(self):
+        import stat
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket_path).st_mode), 0o600)
+        server = ipyenv.ForkServer(os.path.join(self.work_dir, 'other.sock'), None)
+        listener = server._listen()
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        getuid = os.getuid
+        try:
+            client.connect(server._socket_path)
+            if ipyenv._peer_uid(client) is None:
+                self.skipTest('credentials of peers not available')
+            os.getuid = lambda: getuid() + 1    # as if another user connected
+            server._accept(listener)
+            self.assertEqual(server._pending, {})
+            self.assertEqual(client.recv(1), b'')
+        finally:
+            os.getuid = getuid
+            client.close()
+            listener.close()
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=1)
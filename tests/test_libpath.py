@@ -3,6 +3,8 @@
 import unittest
 import sys
 import os
+import shutil
+import tempfile
 
 
 # Add project root path for our module.
@@ -28,6 +30,94 @@ class BaseEnviromnetTest(unittest.TestCase):
             self.assertIn(pathname, sys.path)
         self.assertFalse(pathname in sys.path)
 
+    def test_isolate(self):
+        """Modules loaded from the paths are dropped on exit."""
+        work_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(work_dir, 'isolated_module.py'), 'w') as f:
+                f.write('value = 1\n')
+            env = ipyenv.PathEnvironment((work_dir, ), isolate=True)
+            with env:
+                import isolated_module
+                import json
+                self.assertIn('isolated_module', sys.modules)
+            self.assertNotIn('isolated_module', sys.modules)
+            self.assertIn('json', sys.modules)
+            self.assertIs(env.unloaded['isolated_module'], isolated_module)
+            self.assertEqual(list(env.unloaded), ['isolated_module'])
+        finally:
+            sys.modules.pop('isolated_module', None)
+            shutil.rmtree(work_dir)
+
+    def test_isolate_importers(self):
+        """Importer caches & meta path hooks are rolled back on exit."""
+        meta_path = sys.meta_path[:]
+        with ipyenv.PathEnvironment(('i am dummy', ), isolate_importers=True):
+            sys.meta_path.append(object())
+            sys.path_importer_cache['i am dummy'] = None
+        self.assertEqual(sys.meta_path, meta_path)
+        self.assertNotIn('i am dummy', sys.path_importer_cache)
+
+
+class ExtPathSetTest(unittest.TestCase):
+    """Assert extension paths are ordered, deduplicated & immutable."""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.work_dir, name) for name in ('z', 'a', 'm')]
+        for path in self.paths:
+            os.mkdir(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_ordered(self):
+        paths = ipyenv.ExtPathSet(self.paths + [self.paths[1], self.paths[0]])
+        self.assertEqual(list(paths), self.paths)
+
+    def test_real_paths(self):
+        alias = os.path.join(self.paths[0], os.pardir, 'z')
+        self.assertEqual(list(ipyenv.ExtPathSet([self.paths[0], alias])), self.paths[:1])
+        if hasattr(os, 'symlink'):
+            link = os.path.join(self.work_dir, 'link')
+            os.symlink(self.paths[2], link)
+            self.assertEqual(list(ipyenv.ExtPathSet([link, self.paths[2]])), [link])
+
+    def test_strict(self):
+        missing = os.path.join(self.work_dir, 'missing')
+        self.assertEqual(list(ipyenv.ExtPathSet([missing] + self.paths)), self.paths)
+        self.assertEqual(list(ipyenv.ExtPathSet([missing], strict=False)), [missing])
+
+    def test_immutable(self):
+        paths = ipyenv.ExtPathSet(self.paths[:2])
+        self.assertFalse(hasattr(paths, 'extend'))
+        joined = paths + self.paths[1:]
+        self.assertIsInstance(joined, ipyenv.ExtPathSet)
+        self.assertEqual(list(joined), self.paths)
+        self.assertEqual(list(paths), self.paths[:2])
+
+    def test_resolved_once(self):
+        """Sets passed on (pickled, to proxy scripts) are not resolved again."""
+        import pickle
+        paths = ipyenv.ExtPathSet(self.paths)
+        realpath = os.path.realpath
+        os.path.realpath = None     # never called
+        try:
+            self.assertEqual(pickle.loads(pickle.dumps(paths)), paths)
+            self.assertIs(ipyenv.PathEnvironment(paths)._ext_paths, paths)
+            proxy = ipyenv.TestProxy('target.py', ext_paths=paths)
+        finally:
+            os.path.realpath = realpath
+        self.assertIn('ipyenv._restore_ext_paths({!r})'.format(tuple(self.paths)),
+                      proxy.source)
+
+    def test_env_no_duplicates(self):
+        """Paths already in sys.path are not added again."""
+        with ipyenv.PathEnvironment(self.paths + self.paths):
+            with ipyenv.PathEnvironment(self.paths[:1]):
+                self.assertEqual(sys.path.count(self.paths[0]), 1)
+        self.assertNotIn(self.paths[0], sys.path)
+
 
 class LibraryEnvironmentTest(unittest.TestCase):
     """
@@ -95,6 +185,154 @@ class LibraryEnvironmentTest(unittest.TestCase):
                              'i am sitelib/hrch/subpkg/inner_module.')
 
 
+class IndexedLibraryEnvironmentTest(LibraryEnvironmentTest):
+    """
+    Assert imports work via the index of library paths.
+    """
+
+    def setUp(self):
+        if ipyenv.importlib_machinery is None:
+            self.skipTest('importlib not available')
+        self.env = ipyenv.LibraryEnvironment(
+            sitelib_paths=(helper.get_abspath_from('sitelib'),),
+            indexed=True,
+        )
+        self.lock_path = helper.get_abspath_from('sitelib/.sitelibs.lock')
+
+    def tearDown(self):
+        LibraryEnvironmentTest.tearDown(self)
+        if os.path.exists(self.lock_path):
+            os.remove(self.lock_path)
+
+    def test_index(self):
+        """Top-level names are indexed in precedence of the path order."""
+        index = self.env.finder.index
+        sitelib_path = helper.get_abspath_from('sitelib')
+        self.assertEqual(index['toplevel_module'], sitelib_path)
+        self.assertEqual(index['flat_pkg'], sitelib_path)
+        first_inner = [path for path in self.env.ext_paths
+                       if os.path.basename(path) in ('flat_pkg', 'hrch_pkg')][0]
+        self.assertEqual(index['inner_module'], first_inner)
+        self.assertEqual(index['subpkg'], os.path.join(sitelib_path, 'hrch_pkg'))
+        with self.env:
+            self.assertIn(self.env.finder, sys.meta_path)
+        self.assertNotIn(self.env.finder, sys.meta_path)
+
+    def test_shadowed(self):
+        """Names provided by prior paths of sys.path are imported from them."""
+        work_dir = tempfile.mkdtemp()
+        orig_paths = sys.path[:]
+        try:
+            for dir_name in ('prior', 'sitelib'):
+                os.mkdir(os.path.join(work_dir, dir_name))
+                with open(os.path.join(work_dir, dir_name, 'shadowed_module.py'), 'w') as f:
+                    f.write('NAME = {!r}\n'.format(dir_name))
+            with open(os.path.join(work_dir, 'sitelib', 'unshadowed_module.py'), 'w') as f:
+                f.write('NAME = "sitelib"\n')
+            with open(os.path.join(work_dir, 'sitelib', '.sitelibs'), 'w') as f:
+                f.write('./\n')
+            sys.path.append(os.path.join(work_dir, 'prior'))
+            env = ipyenv.LibraryEnvironment(
+                sitelib_paths=(os.path.join(work_dir, 'sitelib'),),
+                indexed=True,
+            )
+            self.assertIn('shadowed_module', env.finder.index)
+            with env:
+                import shadowed_module
+                import unshadowed_module
+            self.assertEqual(shadowed_module.NAME, 'prior')
+            self.assertEqual(unshadowed_module.NAME, 'sitelib')
+        finally:
+            sys.path[:] = orig_paths
+            for module_name in ('shadowed_module', 'unshadowed_module'):
+                sys.modules.pop(module_name, None)
+            shutil.rmtree(work_dir)
+
+    def test_lock(self):
+        """The index saved is loaded instead of scanning."""
+        self.env.save_index()
+        self.assertTrue(os.path.exists(self.lock_path))
+        scan = ipyenv._scan_importable_names
+        try:
+            ipyenv._scan_importable_names = None    # never called
+            env = ipyenv.LibraryEnvironment(
+                sitelib_paths=(helper.get_abspath_from('sitelib'),),
+                indexed=True,
+            )
+        finally:
+            ipyenv._scan_importable_names = scan
+        self.assertEqual(env.finder.index, self.env.finder.index)
+
+
+class LazyLibraryEnvironmentTest(LibraryEnvironmentTest):
+    """
+    Assert imports work via library paths activated lazily.
+    """
+
+    def setUp(self):
+        if ipyenv.importlib_machinery is None:
+            self.skipTest('importlib not available')
+        self.env = ipyenv.LibraryEnvironment(
+            sitelib_paths=(helper.get_abspath_from('sitelib'),),
+            lazy=True,
+        )
+
+    def test_activated(self):
+        """Only paths providing modules imported are put on sys.path."""
+        sitelib_path = helper.get_abspath_from('sitelib')
+        with self.env:
+            self.assertEqual(self.env.lazy_finder.activated, [])
+            for ext_path in self.env.ext_paths:
+                self.assertNotIn(ext_path, sys.path)
+            import json
+            self.assertEqual(self.env.lazy_finder.activated, [])
+            import toplevel_module
+            self.assertEqual(self.env.lazy_finder.activated, [sitelib_path])
+            self.assertIn(sitelib_path, sys.path)
+            import flat_pkg.inner_module
+            self.assertEqual(self.env.lazy_finder.activated, [sitelib_path])
+        self.assertNotIn(sitelib_path, sys.path)
+        self.assertNotIn(self.env.lazy_finder, sys.meta_path)
+
+
+class ImportTimerTest(unittest.TestCase):
+    """
+    Assert imports are recorded with their library paths.
+    """
+
+    def setUp(self):
+        self.env = ipyenv.LibraryEnvironment(
+            sitelib_paths=(helper.get_abspath_from('sitelib'),)
+        )
+
+    def tearDown(self):
+        """Remove module entries imported from the library paths."""
+        ext_paths = self.env.ext_paths
+        for module_name in list(sys.modules.keys()):
+            module_source = getattr(sys.modules[module_name], '__file__', None) or ''
+            if any(module_source.startswith(ext_path) for ext_path in ext_paths):
+                del sys.modules[module_name]
+
+    def test_records(self):
+        if ipyenv.importlib_machinery is None:
+            self.skipTest('importlib not available')
+        with self.env:
+            with ipyenv.ImportTimer(self.env.ext_paths) as timer:
+                import hrch_pkg.subpkg.inner_module
+                import toplevel_module
+            self.assertNotIn(timer, sys.meta_path)
+        records = dict((record['name'], record) for record in timer.records)
+        self.assertEqual(sorted(records), ['hrch_pkg', 'hrch_pkg.subpkg',
+                                           'hrch_pkg.subpkg.inner_module',
+                                           'toplevel_module'])
+        sitelib_path = helper.get_abspath_from('sitelib')
+        for record in records.values():
+            self.assertEqual(record['path'], sitelib_path)
+            self.assertTrue(record['cumulative'] >= record['self'] >= 0)
+        # Loaders are still usable.
+        self.assertEqual(toplevel_module.label(), 'i am sitelib/toplevel_module.')
+
+
 class RCTest(LibraryEnvironmentTest):
     """
     Assert .ipyenvrc works with LibraryEnvironment.
@@ -122,5 +360,97 @@ class PartialRCTest(unittest.TestCase):
               )
 
 
+class ProjectConfigTest(unittest.TestCase):
+    """
+    Assert resolved configuration is cached & validated by rc files.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.work_dir, 'cache')
+        self.config_path = os.path.join(self.work_dir, 'ipyenvrc')
+        with open(self.config_path, 'w') as f:
+            f.write('[libext]\nextdirs = ./sitelib\n')
+        self.sitelibs_path = os.path.join(self.work_dir, '.sitelibs')
+        with open(self.sitelibs_path, 'w') as f:
+            f.write('lib\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def resolve(self):
+        config = ipyenv.ProjectConfig(cache_dir=self.cache_dir)
+        resolved = (config.options(self.config_path),
+                    config.extdir_paths(self.sitelibs_path, 'utf-8'))
+        config.save()
+        return resolved
+
+    def test_cached(self):
+        """Resolved again only if rc files changed."""
+        options, paths = self.resolve()
+        self.assertEqual(options, {'libext.extdirs': './sitelib'})
+        self.assertEqual(paths, [os.path.join(self.work_dir, 'lib')])
+        read_options, read_extdir = ipyenv._read_options, ipyenv._read_extdir
+        ipyenv._read_options = ipyenv._read_extdir = None  # never called
+        try:
+            self.assertEqual(self.resolve(), (options, paths))
+        finally:
+            ipyenv._read_options, ipyenv._read_extdir = read_options, read_extdir
+        with open(self.sitelibs_path, 'w') as f:
+            f.write('lib\nanother_lib\n')
+        options, paths = self.resolve()
+        self.assertEqual(sorted(paths), [os.path.join(self.work_dir, 'another_lib'),
+                                         os.path.join(self.work_dir, 'lib')])
+
+    def test_missing(self):
+        config = ipyenv.ProjectConfig(cache_dir=None)
+        self.assertIsNone(config.options(os.path.join(self.work_dir, 'missing')))
+
+    def test_per_process(self):
+        self.assertIs(ipyenv.ProjectConfig.get(), ipyenv.ProjectConfig.get())
+
+    def test_relocate(self):
+        """Saved into the cache directory given, or never if None."""
+        config = ipyenv.ProjectConfig(cache_dir=None)
+        config.options(self.config_path)
+        config.save()
+        self.assertFalse(os.path.exists(self.cache_dir))
+        config.relocate(self.cache_dir)
+        config.save()
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, ipyenv.CONFIG_CACHE)))
+
+    def test_library_use(self):
+        """Saved only into the cache directory of a test runner."""
+        import subprocess
+        os.mkdir(os.path.join(self.work_dir, 'sitelib'))
+        with open(os.path.join(self.work_dir, 'sitelib', '.sitelibs'), 'w') as f:
+            f.write('./\n')
+        script = ('import sys; sys.path.insert(0, {!r}); import ipyenv\n'
+                  'ipyenv.LibraryEnvironment(sitelib_paths=("sitelib",))\n'
+                  'ipyenv.TestRunner(test_paths=(), sitelib_paths=("sitelib",), '
+                  'cache_dir={})\n')
+        ipyenv_dir = os.path.dirname(os.path.abspath(ipyenv.__file__))
+        subprocess.call([sys.executable, '-c', script.format(ipyenv_dir, 'None')],
+                        cwd=self.work_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, '.ipyenvcache')))
+        subprocess.call([sys.executable, '-c', script.format(ipyenv_dir, repr('cache'))],
+                        cwd=self.work_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, '.ipyenvcache')))
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, ipyenv.CONFIG_CACHE)))
+
+    def test_nocache_cli(self):
+        """`--nocache` leaves no cache of the configuration."""
+        import subprocess
+        with open(os.path.join(self.work_dir, '.ipyenvrc'), 'w') as f:
+            f.write('[test]\ntestdirs = ./tests\nextdirs =\n')
+        os.mkdir(os.path.join(self.work_dir, 'tests'))
+        for args in (['test', '--nocache'], ['exec', '--nocache', 'script.py']):
+            with open(os.path.join(self.work_dir, 'script.py'), 'w') as f:
+                f.write('pass\n')
+            subprocess.call([sys.executable, os.path.abspath(ipyenv.__file__)] + args,
+                            cwd=self.work_dir)
+            self.assertFalse(os.path.exists(os.path.join(self.work_dir, '.ipyenvcache')))
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=1)
@@ -3,6 +3,11 @@
 import unittest
 import sys
 import os
+import json
+import shutil
+import tempfile
+import threading
+import time
 
 
 # Add project root path for our module.
@@ -121,6 +126,28 @@ class PartialRCTest(TestEnvironmentTest):
                       )
 
 
+class ParallelJobsTest(TestEnvironmentTest):
+    """
+    Assert TestRunner works with test files spread over workers.
+    """
+
+    def setUp(self):
+        self.test_runner = ipyenv.TestRunner(
+            test_paths=(helper.get_abspath_from('tests'),),
+            sitelib_paths=(helper.get_abspath_from('sitelib'),),
+            suite_autoload=False,
+            jobs=2,
+        )
+
+    def test_merged_summary(self):
+        """Results from all workers are merged into one summary."""
+        summary = self.test_runner.execute_all()
+        os.remove('./testlog')
+        self.assertEqual(len(summary.executed), 7)
+        self.assertTrue(summary.succeeded)
+        self.assertEqual(summary.exit_code, 0)
+
+
 class TestAutoexecMode(unittest.TestCase):
     """Tests for auto-exec mode configuration."""
 
@@ -184,6 +211,49 @@ class TestAppendingMain(unittest.TestCase):
                           executed)
 
 
+class TempProxyAppendingMain(TestAppendingMain):
+    """
+    Testing test scripts launched via temporary proxy files.
+    """
+
+    def setUp(self):
+        self.test_runner = ipyenv.TestRunner(
+            test_paths=(helper.get_abspath_from('nose-like-tests'),),
+            sitelib_paths=(helper.get_abspath_from('sitelib'),),
+            append_main=True,
+            suite_autoload=False,
+            inline_proxy=False,
+        )
+
+
+class ForkWorkerAppendingMain(TestAppendingMain):
+    """
+    Testing test scripts executed in children forked from a pre-warmed runner.
+    """
+
+    def setUp(self):
+        if not hasattr(os, 'fork'):
+            self.skipTest('fork not available')
+        self.test_runner = ipyenv.TestRunner(
+            test_paths=(helper.get_abspath_from('nose-like-tests'),),
+            sitelib_paths=(helper.get_abspath_from('sitelib'),),
+            append_main=True,
+            suite_autoload=False,
+            fork_worker=True,
+            preload=('toplevel_module',),
+        )
+
+    def tearDown(self):
+        sys.modules.pop('toplevel_module', None)
+
+    def test_exit_status(self):
+        """Exit status of forked children is summarized."""
+        summary = self.test_runner.execute_all()
+        os.remove('./testlog')
+        self.assertEqual(len(summary.executed), 2)
+        self.assertEqual(summary.exit_code, 0)
+
+
 class RCTestAppendingMain(TestAppendingMain):
 
     def setUp(self):
@@ -205,6 +275,1020 @@ class TestSuiteAutoload(TestAppendingMain):
         )
 
 
+class ParallelSuiteAutoload(TestAppendingMain):
+    """
+    Tests for test suite auto-loading over worker processes.
+    """
+
+    def setUp(self):
+        self.test_runner = ipyenv.TestRunner(
+            test_paths=(helper.get_abspath_from('nose-like-tests'),),
+            sitelib_paths=(helper.get_abspath_from('sitelib'),),
+            suite_autoload=True,
+            jobs=2,
+        )
+
+    def test_merged_summary(self):
+        """Results from all workers are merged into one summary."""
+        summary = self.test_runner.execute_all()
+        os.remove('./testlog')
+        self.assertEqual(summary.tests_run, 2)
+        self.assertEqual(summary.exit_code, 0)
+
+
+class DiscoveryIndexTest(unittest.TestCase):
+    """Assert test discovery is cached by directory mtimes."""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.test_dir = os.path.join(self.work_dir, 'tests')
+        self.cache_dir = os.path.join(self.work_dir, 'cache')
+        os.makedirs(os.path.join(self.test_dir, 'sub'))
+        for relpath in ('test_a.py', os.path.join('sub', 'test_b.py')):
+            open(os.path.join(self.test_dir, relpath), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def find_tests(self):
+        runner = ipyenv.TestRunner(test_paths=(self.test_dir,),
+                                   sitelib_paths=(),
+                                   cache_dir=self.cache_dir)
+        return sorted(runner._tests[self.test_dir])
+
+    def test_unchanged_directories(self):
+        """Indexed directories are not listed again until changed."""
+        found = self.find_tests()
+        self.assertEqual(found, [os.path.join(self.test_dir, 'sub', 'test_b.py'),
+                                 os.path.join(self.test_dir, 'test_a.py')])
+        index_path = os.path.join(self.cache_dir, 'discovery.json')
+        with open(index_path, 'r') as f:
+            discovery = json.load(f)
+        # Fake the index, to be trusted while mtime unchanged.
+        index = discovery['contexts'][self.test_dir]
+        index[os.path.join(self.test_dir, 'sub')][1] = ['test_fake.py']
+        with open(index_path, 'w') as f:
+            json.dump(discovery, f)
+        self.assertIn(os.path.join(self.test_dir, 'sub', 'test_fake.py'),
+                      self.find_tests())
+
+    def test_changed_directories(self):
+        """Directories changed are listed again."""
+        self.find_tests()
+        os.mkdir(os.path.join(self.test_dir, 'new'))
+        open(os.path.join(self.test_dir, 'new', 'test_c.py'), 'w').close()
+        os.remove(os.path.join(self.test_dir, 'test_a.py'))
+        self.assertEqual(self.find_tests(),
+                         [os.path.join(self.test_dir, 'new', 'test_c.py'),
+                          os.path.join(self.test_dir, 'sub', 'test_b.py')])
+
+
+class DurationsTest(unittest.TestCase):
+    """Assert durations of tests, test files & phases are recorded."""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.durations_file = os.path.join(self.work_dir, 'durations.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_suite_durations(self):
+        test_runner = ipyenv.TestRunner(
+            test_paths=(helper.get_abspath_from('nose-like-tests'),),
+            sitelib_paths=(helper.get_abspath_from('sitelib'),),
+            suite_autoload=True,
+            cache_dir=os.path.join(self.work_dir, 'cache'),
+            durations_file=self.durations_file,
+        )
+        summary = test_runner.execute_all()
+        os.remove('./testlog')
+        with open(self.durations_file, 'r') as f:
+            durations = json.load(f)
+        self.assertEqual(sorted(durations['phases']), ['discovery', 'import', 'run'])
+        self.assertEqual(len(durations['files']), 2)
+        self.assertEqual(len(durations['tests']), 2)
+        self.assertEqual(durations['files'], summary.durations['files'])
+        with open(os.path.join(self.work_dir, 'cache', 'durations.json'), 'r') as f:
+            cached = json.load(f)
+        self.assertEqual(cached['files'], durations['files'])
+
+    def test_file_durations(self):
+        test_runner = ipyenv.TestRunner(
+            test_paths=(helper.get_abspath_from('nose-like-tests'),),
+            sitelib_paths=(helper.get_abspath_from('sitelib'),),
+            append_main=True,
+            suite_autoload=False,
+            cache_dir=None,
+        )
+        summary = test_runner.execute_all()
+        os.remove('./testlog')
+        self.assertEqual(sorted(summary.durations['files']), sorted(summary.executed))
+        self.assertIn('run', summary.durations['phases'])
+
+
+class AffectedTestsTest(unittest.TestCase):
+    """Assert tests are selected by files changed, via the import graph."""
+
+    sources = {
+        'src/aff_mod_a.py': '',
+        'src/aff_mod_b.py': 'import aff_mod_a\n',
+        'src/aff_pkg/__init__.py': '',
+        'src/aff_pkg/sub.py': 'from . import other\n',
+        'src/aff_pkg/other.py': '',
+        'tests/.testfor': '../src\n',
+        'tests/test_aff_a.py': 'import aff_mod_a\n',
+        'tests/test_aff_b.py': 'import aff_mod_b\n',
+        'tests/test_aff_pkg.py': 'from aff_pkg import sub\n',
+        'tests/test_aff_none.py': 'import os\n',
+    }
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        for relpath, source in self.sources.items():
+            path = os.path.join(self.work_dir, *relpath.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(source)
+
+    def tearDown(self):
+        for module_name in list(sys.modules.keys()):
+            module_source = getattr(sys.modules[module_name], '__file__', None) or ''
+            if module_source.startswith(self.work_dir):
+                del sys.modules[module_name]
+        shutil.rmtree(self.work_dir)
+
+    def execute_affected(self, changed_paths=()):
+        test_runner = ipyenv.TestRunner(
+            test_paths=(os.path.join(self.work_dir, 'tests'),),
+            sitelib_paths=(),
+            cache_dir=os.path.join(self.work_dir, 'cache'),
+            affected=[os.path.join(self.work_dir, path) for path in changed_paths],
+        )
+        summary = test_runner.execute_all()
+        return sorted(os.path.basename(path) for path in summary.executed)
+
+    def test_since_last_run(self):
+        self.assertEqual(len(self.execute_affected()), 4)
+        self.assertEqual(self.execute_affected(), [])
+        changed = os.path.join(self.work_dir, 'src', 'aff_mod_a.py')
+        mtime = os.stat(changed).st_mtime + 10
+        os.utime(changed, (mtime, mtime))
+        self.assertEqual(self.execute_affected(),
+                         ['test_aff_a.py', 'test_aff_b.py'])
+        self.assertEqual(self.execute_affected(), [])
+
+    def test_removed(self):
+        self.assertEqual(len(self.execute_affected()), 4)
+        os.remove(os.path.join(self.work_dir, 'src', 'aff_mod_a.py'))
+        self.assertEqual(self.execute_affected(),
+                         ['test_aff_a.py', 'test_aff_b.py'])
+
+    def test_given_paths(self):
+        self.assertEqual(self.execute_affected(['src/aff_pkg/other.py']),
+                         ['test_aff_pkg.py'])
+        self.assertEqual(self.execute_affected(['tests/test_aff_none.py']),
+                         ['test_aff_none.py'])
+
+
+class LastFailedTest(unittest.TestCase):
+    """Assert tests failed in the last run are selected or executed first."""
+
+    failing_source = (
+        'import unittest\n'
+        'class LastFailedCase(unittest.TestCase):\n'
+        '    def test_pass(self):\n'
+        '        pass\n'
+        '    def test_fail(self):\n'
+        '        self.assertTrue({})\n'
+    )
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.work_dir, 'tests'))
+        self.write_test('test_lf_a_pass.py', 'import unittest\n')
+        self.write_test('test_lf_fail.py', self.failing_source.format(False))
+
+    def tearDown(self):
+        for module_name in ('test_lf_a_pass', 'test_lf_fail'):
+            sys.modules.pop(module_name, None)
+        shutil.rmtree(self.work_dir)
+
+    def write_test(self, name, source):
+        path = os.path.join(self.work_dir, 'tests', name)
+        with open(path, 'w') as f:
+            f.write(source)
+        mtime = os.stat(path).st_mtime + 10
+        os.utime(path, (mtime, mtime))
+
+    def execute(self, **kwargs):
+        test_runner = ipyenv.TestRunner(
+            test_paths=(os.path.join(self.work_dir, 'tests'),),
+            sitelib_paths=(),
+            cache_dir=os.path.join(self.work_dir, 'cache'),
+            **kwargs
+        )
+        return test_runner.execute_all()
+
+    def executed_names(self, summary):
+        return [os.path.basename(path) for path in summary.executed]
+
+    def test_suite_last_failed(self):
+        summary = self.execute()
+        self.assertEqual(summary.tests_run, 2)
+        self.assertEqual(len(summary.failures), 1)
+        summary = self.execute(last_failed=True)
+        self.assertEqual(self.executed_names(summary), ['test_lf_fail.py'])
+        self.assertEqual(summary.tests_run, 1)
+        self.assertEqual(summary.exit_code, 1)
+        self.write_test('test_lf_fail.py', self.failing_source.format(True))
+        sys.modules.pop('test_lf_fail', None)
+        summary = self.execute(last_failed=True)
+        self.assertEqual(summary.exit_code, 0)
+        # No failures recorded: execute all.
+        summary = self.execute(last_failed=True)
+        self.assertEqual(len(summary.executed), 2)
+
+    def test_fixture_last_failed(self):
+        self.write_test('test_lf_fail.py', (
+            'import unittest\n'
+            'class LastFailedCase(unittest.TestCase):\n'
+            '    @classmethod\n'
+            '    def setUpClass(cls):\n'
+            '        raise RuntimeError("expected")\n'
+            '    def test_pass(self):\n'
+            '        pass\n'
+        ))
+        summary = self.execute()
+        self.assertEqual([(os.path.basename(path), test_id) for path, test_id in summary.failures],
+                         [('test_lf_fail.py', 'setUpClass (test_lf_fail.LastFailedCase)')])
+        sys.modules.pop('test_lf_fail', None)
+        summary = self.execute(last_failed=True)
+        self.assertEqual(self.executed_names(summary), ['test_lf_fail.py'])
+        self.assertEqual(len(summary.failures), 1)
+
+    def test_failure_scope(self):
+        self.assertEqual(ipyenv._failure_scope('m.C.test'), 'm.C.test')
+        self.assertEqual(ipyenv._failure_scope('m.C.test (i=1)'), 'm.C.test')
+        self.assertEqual(ipyenv._failure_scope('setUpClass (m.C)'), 'm.C')
+        self.assertEqual(ipyenv._failure_scope('setUpModule (m)'), 'm')
+        self.assertEqual(ipyenv._test_file_of('tearDownModule (m)', {'m.C.test': 'path'}), 'path')
+        self.assertEqual(ipyenv._test_file_of('setUpClass (mod.C)', {'m.C.test': 'path'}), None)
+
+    def test_subprocess_failed_first(self):
+        kwargs = dict(suite_autoload=False, append_main=True)
+        summary = self.execute(**kwargs)
+        self.assertEqual(self.executed_names(summary),
+                         ['test_lf_a_pass.py', 'test_lf_fail.py'])
+        self.assertEqual([(os.path.basename(path), test_id) for path, test_id in summary.failures],
+                         [('test_lf_fail.py', None)])
+        summary = self.execute(failed_first=True, **kwargs)
+        self.assertEqual(self.executed_names(summary),
+                         ['test_lf_fail.py', 'test_lf_a_pass.py'])
+        summary = self.execute(last_failed=True, **kwargs)
+        self.assertEqual(self.executed_names(summary), ['test_lf_fail.py'])
+
+
+class WatchTest(unittest.TestCase):
+    """Assert tests affected by changes are rerun in watch mode."""
+
+    test_source = (
+        'import unittest\n'
+        'import {}\n'
+        'class WatchCase(unittest.TestCase):\n'
+        '    def test_log(self):\n'
+        '        with open({!r}, "a") as f:\n'
+        '            f.write(__name__ + "\\n")\n'
+    )
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.work_dir, 'watch.log')
+        sources = {
+            'sitelib/.sitelibs': 'lib\n',
+            'sitelib/lib/watch_lib.py': '',
+            'src/watch_mod.py': '',
+            'tests/.testfor': '../src\n',
+            'tests/test_watch_a.py': self.test_source.format('watch_mod', self.log_path),
+            'tests/test_watch_b.py': self.test_source.format('watch_lib', self.log_path),
+        }
+        for relpath, source in sources.items():
+            path = os.path.join(self.work_dir, *relpath.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(source)
+
+    def tearDown(self):
+        for module_name in ('watch_lib', 'watch_mod', 'test_watch_a', 'test_watch_b'):
+            sys.modules.pop(module_name, None)
+        shutil.rmtree(self.work_dir)
+
+    def logged(self):
+        if not os.path.exists(self.log_path):
+            return []
+        with open(self.log_path, 'r') as f:
+            return f.read().split()
+
+    def touch_after_first_run(self, path):
+        deadline = time.time() + 30
+        while len(self.logged()) < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        mtime = os.stat(path).st_mtime + 10
+        os.utime(path, (mtime, mtime))
+
+    def test_rerun_affected(self):
+        test_runner = ipyenv.TestRunner(
+            test_paths=(os.path.join(self.work_dir, 'tests'),),
+            sitelib_paths=(os.path.join(self.work_dir, 'sitelib'),),
+            cache_dir=None,
+        )
+        toucher = threading.Thread(target=self.touch_after_first_run,
+                                   args=(os.path.join(self.work_dir, 'src', 'watch_mod.py'),))
+        toucher.start()
+        try:
+            returncode = test_runner.watch(interval=0.05, runs=2)
+        finally:
+            toucher.join()
+        self.assertEqual(returncode, 0)
+        self.assertEqual(self.logged(), ['test_watch_a', 'test_watch_b', 'test_watch_a'])
+        # Libraries stay loaded, while tests & their targets are not.
+        self.assertIn('watch_lib', sys.modules)
+        self.assertNotIn('watch_mod', sys.modules)
+
+
+class IsolateTest(unittest.TestCase):
+    """Assert test files are loaded with their own modules in auto-exec."""
+
+    test_source = (
+        'import unittest\n'
+        'import iso_target\n'
+        'def setUpModule():\n'
+        '    iso_target.events.append("setup")\n'
+        'def tearDownModule():\n'
+        '    iso_target.events.append("teardown")\n'
+        'class IsolatedCase(unittest.TestCase):\n'
+        '    def test_fresh(self):\n'
+        '        import iso_target as imported\n'
+        '        self.assertIs(imported, iso_target)\n'
+        '        iso_target.events.append("test")\n'
+        '        self.assertEqual(iso_target.events, ["setup", "test"])\n'
+    )
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        sources = {
+            'src/iso_target.py': 'events = []\n',
+            'tests/.testfor': '../src\n',
+            'tests/test_iso_a.py': self.test_source,
+            'tests/test_iso_b.py': self.test_source,
+        }
+        for relpath, source in sources.items():
+            path = os.path.join(self.work_dir, *relpath.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(source)
+
+    def tearDown(self):
+        for module_name in self.loaded_modules():
+            del sys.modules[module_name]
+        shutil.rmtree(self.work_dir)
+
+    def loaded_modules(self):
+        return [module_name for module_name, module in list(sys.modules.items())
+                if (getattr(module, '__file__', None) or '').startswith(self.work_dir)]
+
+    def execute(self, isolate):
+        test_runner = ipyenv.TestRunner(
+            test_paths=(os.path.join(self.work_dir, 'tests'),),
+            sitelib_paths=(),
+            cache_dir=None,
+            isolate=isolate,
+        )
+        return test_runner.execute_all()
+
+    def test_isolated(self):
+        summary = self.execute(isolate=True)
+        self.assertEqual(summary.tests_run, 2)
+        self.assertEqual(summary.exit_code, 0)
+        self.assertEqual(self.loaded_modules(), [])
+
+    def test_shared(self):
+        summary = self.execute(isolate=False)
+        self.assertEqual(summary.tests_run, 2)
+        self.assertEqual(summary.exit_code, 1)
+
+
+class ThreadsTest(unittest.TestCase):
+    """Assert test classes run on threads in auto-exec."""
+
+    test_source = (
+        'import threading\n'
+        'import unittest\n'
+        'a_started, b_started = threading.Event(), threading.Event()\n'
+        'class ACase(unittest.TestCase):\n'
+        '    def test_a(self):\n'
+        '        a_started.set()\n'
+        '        self.assertTrue(b_started.wait(10))\n'
+        'class BCase(unittest.TestCase):\n'
+        '    def test_b(self):\n'
+        '        b_started.set()\n'
+        '        self.assertTrue(a_started.wait(10))\n'
+        'class SerialCase(unittest.TestCase):\n'
+        '    __ipyenv_serial__ = True\n'
+        '    def test_main_thread(self):\n'
+        '        self.assertEqual(threading.current_thread().name, "MainThread")\n'
+        '    def test_fail(self):\n'
+        '        self.fail("expected")\n'
+    )
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.work_dir, 'tests'))
+        with open(os.path.join(self.work_dir, 'tests', 'test_threads.py'), 'w') as f:
+            f.write(self.test_source)
+
+    def tearDown(self):
+        sys.modules.pop('test_threads', None)
+        shutil.rmtree(self.work_dir)
+
+    def test_threads(self):
+        test_runner = ipyenv.TestRunner(
+            test_paths=(os.path.join(self.work_dir, 'tests'),),
+            sitelib_paths=(),
+            cache_dir=None,
+            threads=4,
+        )
+        summary = test_runner.execute_all()
+        self.assertEqual(summary.tests_run, 4)
+        self.assertEqual([test_id for path, test_id in summary.failures],
+                         ['test_threads.SerialCase.test_fail'])
+        self.assertEqual(len(summary.durations['tests']), 4)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            ipyenv.TestRunner(test_paths=(), sitelib_paths=(), cache_dir=None, threads=0)
+
+
+class TestModuleLoaderTest(unittest.TestCase):
+    """Assert test files of the same name in different directories never collide."""
+
+    test_source = (
+        'import unittest\n'
+        'import sibling\n'
+        'class SameNameCase(unittest.TestCase):\n'
+        '    def test_sibling(self):\n'
+        '        self.assertEqual(sibling.NAME, {!r})\n'
+    )
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        for sub_dir in ('first', 'second'):
+            dir_path = os.path.join(self.work_dir, 'tests', sub_dir)
+            os.makedirs(dir_path)
+            with open(os.path.join(dir_path, 'test_same.py'), 'w') as f:
+                f.write(self.test_source.format(sub_dir))
+            with open(os.path.join(dir_path, 'sibling.py'), 'w') as f:
+                f.write('NAME = {!r}\n'.format(sub_dir))
+
+    def tearDown(self):
+        for module_name in ('first__test_same', 'second__test_same', 'sibling'):
+            sys.modules.pop(module_name, None)
+        shutil.rmtree(self.work_dir)
+
+    def test_module_names(self):
+        context = os.path.join(self.work_dir, 'tests')
+        path = os.path.join(context, 'first', 'test_same.py')
+        loader = ipyenv._TestModuleLoader([path], {path: context})
+        self.assertEqual(loader.module_name(path), 'first__test_same')
+        orig_paths = sys.path[:]
+        module = loader.load(path)
+        self.assertEqual(sys.path, orig_paths)
+        self.assertIs(sys.modules['first__test_same'], module)
+        self.assertIs(loader.load(path), module)
+
+    def test_pickle(self):
+        """Classes in nested test files are pickled by their module names."""
+        import pickle
+        context = os.path.join(self.work_dir, 'tests')
+        path = os.path.join(context, 'first', 'test_same.py')
+        module = ipyenv._TestModuleLoader([path], {path: context}).load(path)
+        pickled = pickle.dumps(module.SameNameCase('test_sibling'))
+        self.assertIsInstance(pickle.loads(pickled), module.SameNameCase)
+
+    def test_unique_names(self):
+        context = os.path.join(self.work_dir, 'tests')
+        paths = [os.path.join(context, 'first', 'test_same.py'),
+                 os.path.join(context, 'first__test_same.py')]
+        loader = ipyenv._TestModuleLoader(paths, dict((path, context) for path in paths))
+        self.assertEqual([loader.module_name(path) for path in paths],
+                         ['first__test_same', 'first__test_same_2'])
+
+    def test_run(self):
+        test_runner = ipyenv.TestRunner(
+            test_paths=(os.path.join(self.work_dir, 'tests'),),
+            sitelib_paths=(),
+            cache_dir=None,
+            isolate=True,
+        )
+        summary = test_runner.execute_all()
+        self.assertEqual(summary.tests_run, 2)
+        self.assertEqual(summary.exit_code, 0)
+        self.assertEqual(sorted(summary.durations['tests']),
+                         ['first__test_same.SameNameCase.test_sibling',
+                          'second__test_same.SameNameCase.test_sibling'])
+
+
+class StreamingTest(unittest.TestCase):
+    """Assert test files are loaded, run & unloaded one by one."""
+
+    test_source = (
+        'import os\n'
+        'import sys\n'
+        'import unittest\n'
+        'class StreamedCase{0}(unittest.TestCase):\n'
+        '    def test_alone(self):\n'
+        '        loaded = [name for name in sys.modules if name.startswith("test_streamed_")]\n'
+        '        self.assertEqual(loaded, ["test_streamed_{0}"])\n'
+        '    def test_pid(self):\n'
+        '        with open(os.path.join({1!r}, "pid_{0}"), "w") as f:\n'
+        '            f.write(str(os.getpid()))\n'
+    )
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.work_dir, 'tests'))
+        for index in range(3):
+            path = os.path.join(self.work_dir, 'tests', 'test_streamed_{}.py'.format(index))
+            with open(path, 'w') as f:
+                f.write(self.test_source.format(index, self.work_dir))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def execute(self, **kwargs):
+        test_runner = ipyenv.TestRunner(
+            test_paths=(os.path.join(self.work_dir, 'tests'),),
+            sitelib_paths=(),
+            cache_dir=None,
+            **kwargs
+        )
+        summary = test_runner.execute_all()
+        self.assertEqual(summary.exit_code, 0)
+        self.assertEqual(summary.tests_run, 6)
+        self.assertEqual(len(summary.executed), 3)
+        pids = []
+        for index in range(3):
+            with open(os.path.join(self.work_dir, 'pid_{}'.format(index))) as f:
+                pids.append(int(f.read()))
+        return pids
+
+    def test_streaming(self):
+        self.assertEqual(self.execute(streaming=True), [os.getpid()] * 3)
+        self.assertFalse([name for name in sys.modules if name.startswith('test_streamed_')])
+
+    @unittest.skipIf(ipyenv.multiprocessing is None or
+                     not hasattr(ipyenv.multiprocessing, 'get_context'),
+                     'spawning workers not available')
+    def test_max_rss(self):
+        # Always over the limit: each file left to a fresh worker.
+        pids = self.execute(max_rss=1)
+        self.assertEqual(pids[0], os.getpid())
+        self.assertEqual(len(set(pids)), 3)
+
+    @unittest.skipIf(ipyenv.multiprocessing is None, 'multiprocessing not available')
+    def test_max_rss_jobs(self):
+        # Always over the limit: workers replaced after each file.
+        pids = self.execute(max_rss=1, jobs=2)
+        self.assertNotIn(os.getpid(), pids)
+        self.assertEqual(len(set(pids)), 3)
+
+    def test_fixtures(self):
+        fixture_source = (
+            'import os\n'
+            'import unittest\n'
+            'def count(name):\n'
+            '    with open(os.path.join({0!r}, "fixtures"), "a") as f:\n'
+            '        f.write(name + "\\n")\n'
+            'def setUpModule():\n'
+            '    count("setUpModule")\n'
+            'def tearDownModule():\n'
+            '    count("tearDownModule")\n'
+            'class FixtureCase(unittest.TestCase):\n'
+            '    @classmethod\n'
+            '    def setUpClass(cls):\n'
+            '        count("setUpClass")\n'
+            '    @classmethod\n'
+            '    def tearDownClass(cls):\n'
+            '        count("tearDownClass")\n'
+            '    def test_fixture(self):\n'
+            '        pass\n'
+        )
+        path = os.path.join(self.work_dir, 'tests', 'test_streamed_fixtures.py')
+        with open(path, 'w') as f:
+            f.write(fixture_source.format(self.work_dir))
+        test_runner = ipyenv.TestRunner(
+            test_paths=(os.path.join(self.work_dir, 'tests'),),
+            sitelib_paths=(),
+            cache_dir=None,
+            streaming=True,
+        )
+        summary = test_runner.execute_all()
+        self.assertEqual(summary.exit_code, 0)
+        with open(os.path.join(self.work_dir, 'fixtures')) as f:
+            calls = f.read().splitlines()
+        self.assertEqual(calls, ['setUpModule', 'setUpClass', 'tearDownClass', 'tearDownModule'])
+
+    def test_current_rss(self):
+        rss = ipyenv._current_rss()
+        if rss is not None:
+            self.assertTrue(rss > 1024 * 1024)
+
+
+class TimeoutTest(unittest.TestCase):
+    """Assert test scripts running over timeouts are killed with their children."""
+
+    test_source = (
+        'import os\n'
+        'import subprocess\n'
+        'import sys\n'
+        'import time\n'
+        'import unittest\n'
+        'class HangingCase(unittest.TestCase):\n'
+        '    def test_quick(self):\n'
+        '        pass\n'
+        '    def test_hang(self):\n'
+        '        child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])\n'
+        '        with open(os.path.join({0!r}, "child_pid"), "w") as f:\n'
+        '            f.write(str(child.pid))\n'
+        '        time.sleep(60)\n'
+    )
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.work_dir, 'tests'))
+        with open(os.path.join(self.work_dir, 'tests', 'test_hanging.py'), 'w') as f:
+            f.write(self.test_source.format(self.work_dir))
+        with open(os.path.join(self.work_dir, 'tests', 'test_passing.py'), 'w') as f:
+            f.write(ReportersTest.test_source.split('    def test_fail')[0])
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def execute(self, **kwargs):
+        test_runner = ipyenv.TestRunner(
+            test_paths=(os.path.join(self.work_dir, 'tests'),),
+            sitelib_paths=(),
+            cache_dir=None,
+            suite_autoload=False,
+            append_main=True,
+            **kwargs
+        )
+        started = time.time()
+        summary = test_runner.execute_all()
+        self.assertTrue(time.time() - started < 30)
+        self.assertNotEqual(summary.exit_code, 0)
+        self.assertEqual(len(summary.executed), 2)
+        self.assert_child_killed()
+        return summary
+
+    def assert_child_killed(self):
+        with open(os.path.join(self.work_dir, 'child_pid')) as f:
+            pid = int(f.read())
+        for _ in range(100):
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                return
+            time.sleep(0.05)
+        self.fail('child of the test left running: {}'.format(pid))
+
+    @unittest.skipIf(os.name != 'posix', 'process groups not available')
+    def test_timeout(self):
+        summary = self.execute(timeout=2)
+        hanging_path = [path for path in summary.executed if 'hanging' in path][0]
+        self.assertEqual(summary.timeouts, [hanging_path])
+        self.assertEqual(set(summary.resources), set(summary.executed))
+
+    @unittest.skipIf(os.name != 'posix', 'process groups not available')
+    def test_test_timeout(self):
+        summary = self.execute(test_timeout=1)
+        self.assertEqual(summary.timeouts, [])
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'fork not available')
+    def test_fork_worker(self):
+        summary = self.execute(timeout=2, fork_worker=True)
+        self.assertEqual(len(summary.timeouts), 1)
+
+    @unittest.skipIf(not hasattr(os, 'wait4'), 'resource usage not available')
+    def test_resources(self):
+        os.remove(os.path.join(self.work_dir, 'tests', 'test_hanging.py'))
+        test_runner = ipyenv.TestRunner(
+            test_paths=(os.path.join(self.work_dir, 'tests'),),
+            sitelib_paths=(),
+            cache_dir=None,
+            suite_autoload=False,
+            append_main=True,
+        )
+        summary = test_runner.execute_all()
+        self.assertEqual(summary.exit_code, 0)
+        resources = list(summary.resources.values())
+        self.assertEqual(len(resources), 1)
+        self.assertEqual(sorted(resources[0]), ['cpu', 'maxrss', 'wall'])
+        self.assertTrue(resources[0]['maxrss'] > 1024 * 1024)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, ipyenv.TestRunner, timeout=0)
+        self.assertRaises(ValueError, ipyenv.TestRunner, test_timeout=-1)
+
+
+class ReportersTest(unittest.TestCase):
+    """Assert test events are reported as JSON lines & JUnit XML."""
+
+    test_source = (
+        'import unittest\n'
+        'class ReportedCase(unittest.TestCase):\n'
+        '    def test_pass(self):\n'
+        '        print("captured")\n'
+        '    def test_fail(self):\n'
+        '        self.fail("expected")\n'
+        '    @unittest.skip("skipped")\n'
+        '    def test_skip(self):\n'
+        '        pass\n'
+    )
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.work_dir, 'tests'))
+        with open(os.path.join(self.work_dir, 'tests', 'test_reported.py'), 'w') as f:
+            f.write(self.test_source)
+        self.jsonl_path = os.path.join(self.work_dir, 'events.jsonl')
+        self.junit_path = os.path.join(self.work_dir, 'junit.xml')
+
+    def tearDown(self):
+        sys.modules.pop('test_reported', None)
+        shutil.rmtree(self.work_dir)
+
+    def execute(self, **kwargs):
+        test_runner = ipyenv.TestRunner(
+            test_paths=(os.path.join(self.work_dir, 'tests'),),
+            sitelib_paths=(),
+            cache_dir=None,
+            reporters=('jsonl:' + self.jsonl_path, 'junit:' + self.junit_path),
+            **kwargs
+        )
+        summary = test_runner.execute_all()
+        self.assertEqual(summary.exit_code, 1)
+        with open(self.jsonl_path) as f:
+            events = [json.loads(line) for line in f]
+        return dict((event.get('test'), event) for event in events
+                    if event['event'] not in ('start', 'file'))
+
+    def assert_reported(self, events, module_name):
+        test_id = module_name + '.ReportedCase.test_'
+        self.assertEqual(events[test_id + 'pass']['event'], 'pass')
+        self.assertEqual(events[test_id + 'pass']['output'], 'captured\n')
+        self.assertIn('expected', events[test_id + 'fail']['message'])
+        self.assertEqual(events[test_id + 'skip']['event'], 'skip')
+        from xml.dom import minidom
+        suites = minidom.parse(self.junit_path).getElementsByTagName('testsuite')
+        self.assertEqual(len(suites), 1)
+        self.assertEqual(suites[0].getAttribute('tests'), '3')
+        self.assertEqual(suites[0].getAttribute('failures'), '1')
+        self.assertEqual(suites[0].getAttribute('skipped'), '1')
+        classnames = [case.getAttribute('classname')
+                      for case in suites[0].getElementsByTagName('testcase')]
+        self.assertEqual(classnames, ['test_reported.ReportedCase'] * 3)
+
+    def test_suite(self):
+        self.assert_reported(self.execute(), 'test_reported')
+
+    def test_subprocess(self):
+        events = self.execute(suite_autoload=False, append_main=True)
+        self.assert_reported(events, '__main__')
+
+    @unittest.skipIf(not hasattr(os, 'fork') or not os.path.isdir('/proc/self/fdinfo'),
+                     'fork or /proc not available')
+    def test_fork_worker_pipes(self):
+        """Children forked by workers hold no write ends of the others' pipes."""
+        pipes_source = (
+            'import os\n'
+            'import unittest\n'
+            'class PipesCase(unittest.TestCase):\n'
+            '    def test_pipes(self):\n'
+            '        event_pipes = os.environ["TEST_EVENT_PIPES"].split(",")\n'
+            '        write_ends = []\n'
+            '        for fd in os.listdir("/proc/self/fd"):\n'
+            '            try:\n'
+            '                target = os.readlink("/proc/self/fd/" + fd)\n'
+            '                with open("/proc/self/fdinfo/" + fd) as f:\n'
+            '                    flags = int(f.read().split("flags:")[1].split()[0], 8)\n'
+            '            except (IOError, OSError):\n'
+            '                continue\n'
+            '            if target in event_pipes and flags & 1:\n'
+            '                write_ends.append(target)\n'
+            '        # Only of its own pipe.\n'
+            '        self.assertEqual(len(write_ends), 1)\n'
+        )
+        os.remove(os.path.join(self.work_dir, 'tests', 'test_reported.py'))
+        for index in range(8):
+            path = os.path.join(self.work_dir, 'tests', 'test_pipes_{}.py'.format(index))
+            with open(path, 'w') as f:
+                f.write(pipes_source)
+        orig_pipe = os.pipe
+        def event_pipe():
+            # Pipes of events created by workers, known to children forked after.
+            fds = orig_pipe()
+            if threading.current_thread().name != 'MainThread':
+                os.environ['TEST_EVENT_PIPES'] += ',pipe:[{}]'.format(os.fstat(fds[0]).st_ino)
+                time.sleep(0.05)
+            return fds
+        os.environ['TEST_EVENT_PIPES'] = ''
+        os.pipe = event_pipe
+        try:
+            test_runner = ipyenv.TestRunner(
+                test_paths=(os.path.join(self.work_dir, 'tests'),),
+                sitelib_paths=(),
+                cache_dir=None,
+                suite_autoload=False,
+                append_main=True,
+                fork_worker=True,
+                jobs=4,
+                reporters=('jsonl:' + self.jsonl_path,),
+            )
+            summary = test_runner.execute_all()
+        finally:
+            os.pipe = orig_pipe
+            del os.environ['TEST_EVENT_PIPES']
+        self.assertEqual(summary.failures, [])
+        self.assertEqual(len(summary.executed), 8)
+
+    def test_console(self):
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
+        stream = StringIO()
+        test_runner = ipyenv.TestRunner(
+            test_paths=(os.path.join(self.work_dir, 'tests'),),
+            sitelib_paths=(),
+            cache_dir=None,
+            reporters=(ipyenv.ConsoleReporter(stream),),
+        )
+        test_runner.execute_all()
+        lines = stream.getvalue().splitlines()
+        self.assertIn('FAIL', lines[0])
+        self.assertTrue(lines[0].endswith('test_reported.ReportedCase.test_fail'))
+        self.assertIn('AssertionError: expected', lines)
+        self.assertTrue(lines[-1].startswith('FAILED (exit status 1)'))
+
+    def test_streams(self):
+        """Output captured is replayed into the stream written."""
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
+        with open(os.path.join(self.work_dir, 'tests', 'test_reported.py'), 'w') as f:
+            f.write('import sys\n'
+                    'import unittest\n'
+                    'class ReportedCase(unittest.TestCase):\n'
+                    '    def test_streams(self):\n'
+                    '        sys.stdout.write("out\\n")\n'
+                    '        sys.stderr.write("err\\n")\n')
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            test_runner = ipyenv.TestRunner(
+                test_paths=(os.path.join(self.work_dir, 'tests'),),
+                sitelib_paths=(),
+                cache_dir=None,
+                reporters=('jsonl:' + self.jsonl_path,),
+            )
+            test_runner.execute_all()
+            out, err = sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        self.assertEqual(out, 'out\n')
+        self.assertIn('err\n', err)
+        with open(self.jsonl_path) as f:
+            events = [json.loads(line) for line in f]
+        outputs = [event['output'] for event in events if event['event'] == 'pass']
+        self.assertEqual(outputs, ['out\nerr\n'])
+
+
+class ShardTest(unittest.TestCase):
+    """Assert test files are split into shards."""
+
+    paths = [os.path.abspath('test_{}.py'.format(i)) for i in range(20)]
+
+    def assert_partitioned(self, shards):
+        selected = []
+        for shard in shards:
+            selected.extend(shard)
+        self.assertEqual(sorted(selected), sorted(self.paths))
+
+    def test_hashed(self):
+        """Without durations, split by hashes of paths."""
+        shards = [ipyenv._select_shard(self.paths, (i, 3)) for i in (1, 2, 3)]
+        self.assert_partitioned(shards)
+        self.assertEqual(shards[0], ipyenv._select_shard(list(reversed(self.paths)), (1, 3))[::-1])
+
+    def test_balanced(self):
+        """With durations, balanced by them."""
+        durations = dict((path, 1.0) for path in self.paths)
+        durations[self.paths[0]] = 19.0
+        shards = [ipyenv._select_shard(self.paths, (i, 2), durations) for i in (1, 2)]
+        self.assert_partitioned(shards)
+        self.assertEqual(shards[0], [self.paths[0]])
+        self.assertEqual(len(shards[1]), 19)
+
+    def test_runner(self):
+        """Shards of the runner execute all tests found."""
+        executed = []
+        for i in (1, 2):
+            test_runner = ipyenv.TestRunner(
+                test_paths=(helper.get_abspath_from('tests'),),
+                sitelib_paths=(helper.get_abspath_from('sitelib'),),
+                suite_autoload=False,
+                cache_dir=None,
+                shard=(i, 2),
+            )
+            executed.extend(test_runner.execute_all().executed)
+        os.remove('./testlog')
+        self.assertEqual(len(executed), 7)
+        self.assertEqual(len(set(executed)), 7)
+
+    def test_runner_caches(self):
+        """Shards of runners with different caches of durations still execute all tests."""
+        cache_dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        try:
+            # The longest of the 2nd shard by hashes, which the 1st would take if balanced.
+            test_paths = []
+            for dir_path, _, filenames in os.walk(helper.get_abspath_from('tests')):
+                test_paths.extend(os.path.join(dir_path, filename) for filename in filenames
+                                  if ipyenv.TestRunner.RE_TEST_SCRIPT_NAME.match(filename))
+            longest = ipyenv._select_shard(test_paths, (2, 2))[0]
+            with open(os.path.join(cache_dirs[1], 'durations.json'), 'w') as f:
+                json.dump({'files': {longest: 100.0}}, f)
+            executed = []
+            for i, cache_dir in zip((1, 2), cache_dirs):
+                test_runner = ipyenv.TestRunner(
+                    test_paths=(helper.get_abspath_from('tests'),),
+                    sitelib_paths=(helper.get_abspath_from('sitelib'),),
+                    suite_autoload=False,
+                    cache_dir=cache_dir,
+                    shard=(i, 2),
+                )
+                executed.extend(test_runner.execute_all().executed)
+        finally:
+            for cache_dir in cache_dirs:
+                shutil.rmtree(cache_dir)
+        os.remove('./testlog')
+        self.assertEqual(sorted(executed), sorted(set(executed)))
+        self.assertEqual(len(executed), 7)
+
+    def test_notation(self):
+        self.assertEqual(ipyenv.shard_notation('2/4'), (2, 4))
+        for notation in ('0/4', '5/4', '1', 'a/b'):
+            with self.assertRaises(ValueError):
+                ipyenv.shard_notation(notation)
+
+
+class ExtPathsTest(unittest.TestCase):
+    """Assert extension paths are kept as resolved across executions."""
+
+    def test_not_growing(self):
+        test_runner = ipyenv.TestRunner(
+            test_paths=(helper.get_abspath_from('tests'),),
+            sitelib_paths=(helper.get_abspath_from('sitelib'),),
+            suite_autoload=False,
+            cache_dir=None,
+        )
+        ext_paths = test_runner.ext_paths
+        self.assertEqual(len(set(ext_paths)), len(ext_paths))
+        test_runner.execute_all()
+        test_runner.execute_by_path(helper.get_abspath_from('tests/test_toplevel.py'))
+        os.remove('./testlog')
+        self.assertEqual(test_runner.ext_paths, ext_paths)
+
+
+class TestSummaryTest(unittest.TestCase):
+    """Assert `ipyenv.TestSummary` merges results."""
+
+    def test_merge_failures(self):
+        passed = ipyenv.TestSummary()
+        passed.add_file_result('test_a.py', 0)
+        failed = ipyenv.TestSummary()
+        failed.add_file_result('test_b.py', 1)
+        self.assertEqual(passed.exit_code, 0)
+        merged = ipyenv.TestSummary().merge(passed).merge(failed)
+        self.assertEqual(merged.executed, ['test_a.py', 'test_b.py'])
+        self.assertEqual(merged.failures, [('test_b.py', None)])
+        self.assertEqual(merged.exit_code, 1)
+
+
 class RCTestSuiteAutoload(TestAppendingMain):
 
     def setUp(self):